@@ -0,0 +1,146 @@
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Dict, Hashable, Optional
+
+from metrics import ADMISSIONS
+
+logger = logging.getLogger(__name__)
+
+ADMITTED = "admitted"
+# Queue full or no chance to finish before the deadline: degrade right away
+REJECTED = "rejected"
+# Replaced by a newer request with the same key before it started
+SUPERSEDED = "superseded"
+# Deadline passed, or too close to do the work, while waiting for a slot
+EXPIRED = "expired"
+
+
+class Ticket:
+    """Admission decision for one request, with the deadline its work must meet"""
+    __slots__ = ("key", "deadline", "outcome", "admitted_at", "_future")
+
+    def __init__(self, key: Hashable, deadline: float):
+        self.key = key
+        self.deadline = deadline
+        self.outcome: Optional[str] = None
+        self.admitted_at = 0.0
+        self._future: Optional[asyncio.Future] = None
+
+    @property
+    def admitted(self) -> bool:
+        return self.outcome == ADMITTED
+
+    def remaining(self) -> float:
+        """Seconds left until the deadline"""
+        return max(0.0, self.deadline - time.monotonic())
+
+    def _resolve(self, outcome: str):
+        self.outcome = outcome
+        if outcome == ADMITTED:
+            self.admitted_at = time.monotonic()
+        if self._future is not None and not self._future.done():
+            self._future.set_result(outcome)
+
+
+class AdmissionController:
+    """
+    Bounded concurrency for expensive per-user requests.
+
+    At most `max_concurrent` requests run at once and at most `max_queue`
+    wait, in arrival order; anything beyond that is rejected immediately so
+    the caller can degrade instead of timing out. Each key (a chat) has at
+    most one waiting request: a newer one supersedes it.
+
+    Every request gets a deadline and admitted work should be bounded by
+    `Ticket.remaining()`. An average of how long slots are held estimates
+    whether a request can still finish in time: requests that would not are
+    rejected on arrival, and waiters are expired instead of being admitted
+    with too little time left.
+    """
+    def __init__(self, max_concurrent: Optional[int] = None, max_queue: Optional[int] = None,
+                 deadline: Optional[float] = None):
+        self.max_concurrent = max_concurrent if max_concurrent is not None else int(os.getenv('ADMISSION_MAX_CONCURRENT', '16'))
+        self.max_queue = max_queue if max_queue is not None else int(os.getenv('ADMISSION_MAX_QUEUE', '64'))
+        self.deadline = deadline if deadline is not None else float(os.getenv('ADMISSION_DEADLINE', '20'))
+
+        self.active = 0
+        self._waiting: "OrderedDict[Hashable, Ticket]" = OrderedDict()
+        # Exponentially weighted average of how long a slot is held, seconds
+        self.service_time = 0.0
+
+    def queue_size(self) -> int:
+        """Get number of requests waiting for a slot"""
+        return len(self._waiting)
+
+    def stats(self) -> Dict[str, float]:
+        stats = {"active": self.active, "waiting": len(self._waiting), "service_time": round(self.service_time, 3)}
+        for outcome in (ADMITTED, REJECTED, SUPERSEDED, EXPIRED):
+            stats[outcome] = ADMISSIONS.get(outcome=outcome)
+        return stats
+
+    async def acquire(self, key: Hashable) -> Ticket:
+        """
+        Wait for a slot. Only an admitted ticket holds one, and it must be
+        given back with release().
+        """
+        ticket = Ticket(key, time.monotonic() + self.deadline)
+
+        previous = self._waiting.pop(key, None)
+        if previous is not None:
+            self._finish(previous, SUPERSEDED)
+
+        if self.active < self.max_concurrent and not self._waiting:
+            self.active += 1
+            self._finish(ticket, ADMITTED)
+            return ticket
+
+        # Waiters ahead of this one are served max_concurrent at a time, then it needs a slot itself
+        expected = (len(self._waiting) // self.max_concurrent + 2) * self.service_time
+        if len(self._waiting) >= self.max_queue or expected > self.deadline:
+            self._finish(ticket, REJECTED)
+            return ticket
+
+        ticket._future = asyncio.get_running_loop().create_future()
+        self._waiting[key] = ticket
+        try:
+            await asyncio.wait_for(asyncio.shield(ticket._future), ticket.remaining())
+        except asyncio.TimeoutError:
+            if ticket.outcome is None:
+                self._waiting.pop(key, None)
+                self._finish(ticket, EXPIRED)
+            elif ticket.admitted:
+                # Admitted at the deadline: no time left to use the slot
+                self._free_slot()
+                ticket.outcome = EXPIRED
+        except asyncio.CancelledError:
+            if ticket.outcome is None:
+                self._waiting.pop(key, None)
+            elif ticket.admitted:
+                self._free_slot()
+            raise
+        return ticket
+
+    def release(self, ticket: Ticket):
+        """Give back an admitted ticket's slot and admit the next waiter"""
+        held = time.monotonic() - ticket.admitted_at
+        self.service_time = held if not self.service_time else 0.8 * self.service_time + 0.2 * held
+        self._free_slot()
+
+    def _free_slot(self):
+        self.active -= 1
+        while self._waiting and self.active < self.max_concurrent:
+            _, ticket = self._waiting.popitem(last=False)
+            if ticket.remaining() <= self.service_time:
+                self._finish(ticket, EXPIRED)
+                continue
+            self.active += 1
+            self._finish(ticket, ADMITTED)
+
+    def _finish(self, ticket: Ticket, outcome: str):
+        ticket._resolve(outcome)
+        ADMISSIONS.inc(outcome=outcome)
+        if outcome != ADMITTED:
+            logger.info("Request for %s %s (active %s, waiting %s)", ticket.key, outcome, self.active, len(self._waiting))
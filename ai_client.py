@@ -1,13 +1,59 @@
+import asyncio
 import logging
 import os
-from openai_client import FactGenerator as OpenAIFactGenerator
-from openrouter_client import OpenRouterFactGenerator
+import time
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+from fact_cache import GeoFactCache
+from fact_result import FactResult
+from gazetteer import Gazetteer
+from metrics import FALLBACKS, HEDGES, HEDGE_WINS
+from provider_router import ProviderRouter
+from single_flight import SingleFlight
 
 logger = logging.getLogger(__name__)
 
+ALL_FAILED_MESSAGE = "Извините, не удалось получить информацию об этом месте. Все сервисы временно недоступны."
+UNAVAILABLE_MESSAGE = "Извините, не удалось получить информацию об этом месте. Сервис временно недоступен."
+
+class SharedStream:
+    """Chunks of a fact being streamed, readable from the start by every request that joins it"""
+    def __init__(self):
+        self.chunks: List[str] = []
+        self.done = False
+        self._changed = asyncio.Event()
+    
+    def append(self, chunk: str):
+        self.chunks.append(chunk)
+        self._changed.set()
+    
+    def finish(self):
+        self.done = True
+        self._changed.set()
+    
+    async def follow(self) -> AsyncIterator[str]:
+        """Yield every chunk, past and future, until the stream is finished"""
+        index = 0
+        while True:
+            while index < len(self.chunks):
+                yield self.chunks[index]
+                index += 1
+            if self.done:
+                return
+            self._changed.clear()
+            await self._changed.wait()
+    
+    def first_chunk(self) -> asyncio.Task:
+        """Task that completes when the stream has text or is finished"""
+        async def wait():
+            while not self.chunks and not self.done:
+                self._changed.clear()
+                await self._changed.wait()
+        return asyncio.ensure_future(wait())
+
 class UnifiedFactGenerator:
     """
-    A unified client that tries OpenAI first and falls back to OpenRouter if OpenAI fails
+    A unified client that routes requests to the fastest healthy provider
+    and falls back to the others if it fails
     """
     def __init__(self):
         # Check if OpenAI key is available
@@ -20,63 +66,411 @@ class UnifiedFactGenerator:
         self.openai_client = None
         self.openrouter_client = None
         
+        # Provider modules are imported only when their key is set: the openai SDK
+        # alone takes a large share of startup time
         if self.openai_available:
             try:
+                from openai_client import FactGenerator as OpenAIFactGenerator
                 self.openai_client = OpenAIFactGenerator()
                 logger.info("✅ OpenAI client initialized")
             except Exception as e:
-                logger.error(f"❌ Failed to initialize OpenAI client: {e}")
+                logger.error("❌ Failed to initialize OpenAI client: %s", e)
                 self.openai_available = False
         
         if self.openrouter_available:
             try:
+                from openrouter_client import OpenRouterFactGenerator
                 self.openrouter_client = OpenRouterFactGenerator()
                 logger.info("✅ OpenRouter client initialized")
             except Exception as e:
-                logger.error(f"❌ Failed to initialize OpenRouter client: {e}")
+                logger.error("❌ Failed to initialize OpenRouter client: %s", e)
                 self.openrouter_available = False
         
         if not self.openai_available and not self.openrouter_available:
             logger.error("❌ No AI services are available. Set either OPENAI_API_KEY or OPENROUTER_API_KEY.")
             raise ValueError("No AI services are available")
+        
+        # Providers in static priority order; the router reorders them by observed health
+        providers = {}
+        if self.openai_client:
+            providers["openai"] = self.openai_client
+        if self.openrouter_client:
+            providers["openrouter"] = self.openrouter_client
+        self.router = ProviderRouter(providers)
+        
+        # Facts for nearby coordinates are served from memory
+        self.cache = GeoFactCache()
+        
+        # Optional offline reverse geocoding: readings near a known place share its
+        # coordinates (and so its cache entries) and the prompt names the place
+        self.gazetteer = Gazetteer.from_env()
+        
+        # When a fact cannot be generated in time, a cached one from this far away will do
+        self.fallback_radius_m = float(os.getenv('FACT_FALLBACK_RADIUS_M', '5000'))
+        
+        # Concurrent requests for the same rounded coordinates share one upstream call
+        self.single_flight = SingleFlight()
+        self.coalesce_precision = int(os.getenv('FACT_COALESCE_PRECISION', '3'))
+        # Streams of single-flight calls in flight, so requests joining a call can follow its text
+        self._streams: Dict[asyncio.Task, SharedStream] = {}
+        
+        # Hedging: start the next provider in parallel if the first is slower than the delay.
+        # FACT_HEDGE_DELAY is a number of seconds or "auto" for the observed p90.
+        hedge_delay = os.getenv('FACT_HEDGE_DELAY', '').strip().lower()
+        self.hedge_enabled = bool(hedge_delay) and len(providers) > 1
+        self.hedge_auto = hedge_delay == 'auto'
+        self.hedge_delay = float(os.getenv('FACT_HEDGE_INITIAL_DELAY', '3')) if self.hedge_auto or not hedge_delay else float(hedge_delay)
+    
+    async def start(self):
+        """Open long-lived connections for the configured providers"""
+        if self.openrouter_client:
+            await self.openrouter_client.start()
+    
+    async def prewarm(self):
+        """Connect to every configured provider so the first request skips the handshakes"""
+        providers = self.router.providers
+        results = await asyncio.gather(*(client.prewarm() for client in providers.values()),
+                                       return_exceptions=True)
+        for name, result in zip(providers, results):
+            if isinstance(result, Exception):
+                logger.warning("Could not prewarm %s connection: %s", name, result)
+    
+    async def close(self):
+        """Release provider connections"""
+        if self.openai_client:
+            try:
+                await self.openai_client.close()
+            except Exception as e:
+                logger.error("Error closing OpenAI client: %s", e)
+        if self.openrouter_client:
+            try:
+                await self.openrouter_client.close()
+            except Exception as e:
+                logger.error("Error closing OpenRouter client: %s", e)
+    
+    def _canonical(self, latitude: float, longitude: float) -> Tuple[float, float, Optional[str]]:
+        """Snap coordinates to the nearest named place, if the gazetteer knows one"""
+        if self.gazetteer is None:
+            return latitude, longitude, None
+        place = self.gazetteer.nearest(latitude, longitude)
+        if place is None:
+            return latitude, longitude, None
+        return place.latitude, place.longitude, place.name
+    
+    def cached_fact(self, latitude: float, longitude: float) -> Optional[str]:
+        """Get a cached fact for the location without any upstream request"""
+        latitude, longitude, _ = self._canonical(latitude, longitude)
+        return self.cache.get(latitude, longitude)
+    
+    def has_cached_fact(self, latitude: float, longitude: float) -> bool:
+        """Whether cached_fact() would find a fact; not counted as a cache lookup"""
+        latitude, longitude, _ = self._canonical(latitude, longitude)
+        return self.cache.peek(latitude, longitude)
+    
+    def nearby_fact(self, latitude: float, longitude: float) -> Optional[str]:
+        """Get the closest cached fact within fallback_radius_m, for degraded replies"""
+        latitude, longitude, _ = self._canonical(latitude, longitude)
+        return self.cache.nearest(latitude, longitude, self.fallback_radius_m)
     
     async def get_location_fact(self, latitude: float, longitude: float) -> str:
         """
-        Get a location fact using available AI services
+        Get a location fact, reusing a cached fact for nearby coordinates
         """
-        # Try OpenAI first if available
-        if self.openai_available and self.openai_client:
-            try:
-                logger.info("Trying to get fact using OpenAI...")
-                fact = await self.openai_client.get_location_fact(latitude, longitude)
-                
-                # If we got a generic error message, consider it a failure and try OpenRouter
-                if any(error_msg in fact for error_msg in [
-                    "Извините, не удалось получить информацию",
-                    "Извините, произошла ошибка",
-                    "Извините, сервис временно"
-                ]):
-                    logger.warning("OpenAI returned an error message, trying OpenRouter...")
-                    raise Exception("OpenAI returned error message")
-                
-                return fact
-            except Exception as e:
-                logger.warning(f"OpenAI request failed: {e}")
-                
-                # If OpenRouter is available, try it as fallback
-                if self.openrouter_available and self.openrouter_client:
-                    logger.info("Falling back to OpenRouter...")
-                else:
-                    return "Извините, не удалось получить информацию об этом месте. Сервис временно недоступен."
-        
-        # Use OpenRouter if OpenAI is not available or failed
-        if self.openrouter_available and self.openrouter_client:
+        latitude, longitude, place = self._canonical(latitude, longitude)
+        cached = self.cache.get(latitude, longitude)
+        if cached is not None:
+            logger.info("Serving cached fact for coordinates: %s, %s", latitude, longitude)
+            return cached
+        
+        key = self._coalesce_key(latitude, longitude)
+        result = await self.single_flight.do(key, lambda: self._fetch_and_cache(latitude, longitude, place))
+        return result.text
+    
+    def _coalesce_key(self, latitude: float, longitude: float) -> Tuple[float, float]:
+        return round(latitude, self.coalesce_precision), round(longitude, self.coalesce_precision)
+    
+    async def stream_location_fact(self, latitude: float, longitude: float) -> AsyncIterator[str]:
+        """
+        Stream a location fact as text chunks.
+        Concurrent requests for the same rounded coordinates share one upstream
+        stream; a request that joins a non-streaming call in flight gets the
+        fact in one piece. Yields nothing if every provider fails.
+        """
+        latitude, longitude, place = self._canonical(latitude, longitude)
+        cached = self.cache.get(latitude, longitude)
+        if cached is not None:
+            logger.info("Serving cached fact for coordinates: %s, %s", latitude, longitude)
+            yield cached
+            return
+        
+        key = self._coalesce_key(latitude, longitude)
+        shared = SharedStream()
+        # join() registers the call at once, so the stream is only ever followed
+        # by requests that joined the streaming call itself
+        flight, started = self.single_flight.join(
+            key, lambda: self._stream_and_cache(latitude, longitude, place, shared)
+        )
+        if started:
+            self._streams[flight] = shared
+            flight.add_done_callback(self._stream_done)
+        else:
+            # None when the call in flight is a non-streaming one
+            shared = self._streams.get(flight)
+        streamed = False
+        try:
+            if shared is not None:
+                async for chunk in shared.follow():
+                    streamed = True
+                    yield chunk
+            result = await asyncio.shield(flight)
+            if not streamed and result.ok:
+                yield result.fact
+        finally:
+            self.single_flight.leave(key, flight)
+    
+    def _stream_done(self, flight: asyncio.Task):
+        # Also ends the stream of a call cancelled before it started running
+        shared = self._streams.pop(flight, None)
+        if shared is not None:
+            shared.finish()
+    
+    async def _stream_and_cache(self, latitude: float, longitude: float, place: Optional[str],
+                                shared: "SharedStream") -> FactResult:
+        try:
+            result = await self._stream_fact(latitude, longitude, place, shared)
+        finally:
+            shared.finish()
+        if result.ok:
+            self.cache.put(latitude, longitude, result.fact)
+        return result
+    
+    async def _stream_fact(self, latitude: float, longitude: float, place: Optional[str],
+                           shared: "SharedStream") -> FactResult:
+        """
+        Stream from providers in routing order until one produces text; once text
+        has been streamed a failure ends the stream instead of switching provider.
+        With hedging, a provider that has sent no text within the hedge delay is
+        raced against the next one and the first to send text wins.
+        """
+        order = self.router.order()
+        if not order:
+            logger.warning("All providers are unavailable (circuit breakers open)")
+            return FactResult(provider="none", error="no provider available", user_message=UNAVAILABLE_MESSAGE)
+        
+        result = None
+        while order:
+            names = order[:2] if self.hedge_enabled and len(order) > 1 else order[:1]
+            order = order[len(names):]
+            result = await self._stream_race(names, latitude, longitude, place, shared)
+            if result.ok or shared.chunks:
+                return result
+            if order:
+                FALLBACKS.inc(provider=result.provider)
+        
+        result.user_message = ALL_FAILED_MESSAGE
+        return result
+    
+    async def _stream_race(self, names: List[str], latitude: float, longitude: float, place: Optional[str],
+                           shared: "SharedStream") -> FactResult:
+        """Stream from names[0], hedged by names[1] if given; chunks of the first provider to send text go to `shared`"""
+        winner: List[str] = []
+        tasks: Dict[str, asyncio.Task] = {}
+        
+        async def stream_from(name: str) -> FactResult:
+            parts = []
+            started = time.monotonic()
+            self.router.begin(name)
             try:
-                logger.info("Getting fact using OpenRouter...")
-                return await self.openrouter_client.get_location_fact(latitude, longitude)
+                async for chunk in self.router.providers[name].stream_fact(latitude, longitude, place):
+                    if not winner:
+                        winner.append(name)
+                        for other, task in tasks.items():
+                            if other != name:
+                                task.cancel()
+                        if name != names[0]:
+                            HEDGE_WINS.inc(provider=name)
+                    parts.append(chunk)
+                    shared.append(chunk)
             except Exception as e:
-                logger.error(f"OpenRouter request also failed: {e}")
-                return "Извините, не удалось получить информацию об этом месте. Все сервисы временно недоступны."
+                logger.warning("%s streaming request failed: %s", name, e)
+                result = FactResult(provider=name, error=str(e), latency=time.monotonic() - started)
+                self.router.record(name, result)
+                return result
+            except BaseException:
+                self.router.health[name].probe_in_flight = False
+                raise
+            
+            fact = "".join(parts).strip()
+            result = FactResult(provider=name, fact=fact, latency=time.monotonic() - started,
+                                error=None if fact else "empty completion")
+            self.router.record(name, result)
+            return result
         
-        # This point should only be reached if OpenAI wasn't available and was the only option
-        return "Извините, не удалось получить информацию об этом месте. Сервис временно недоступен." 
\ No newline at end of file
+        tasks[names[0]] = asyncio.create_task(stream_from(names[0]))
+        first_chunk = shared.first_chunk()
+        try:
+            if len(names) > 1:
+                await asyncio.wait([tasks[names[0]], first_chunk], return_when=asyncio.FIRST_COMPLETED,
+                                   timeout=self._current_hedge_delay(names[0]))
+                if not winner and not (tasks[names[0]].done() and tasks[names[0]].result().ok):
+                    logger.info("%s is slow or failed, starting %s in parallel...", names[0], names[1])
+                    HEDGES.inc(provider=names[1])
+                    tasks[names[1]] = asyncio.create_task(stream_from(names[1]))
+            
+            results = await asyncio.gather(*tasks.values(), return_exceptions=True)
+            results = [result for result in results if isinstance(result, FactResult)]
+            for result in results:
+                if result.provider in winner or result.ok:
+                    return result
+            return results[-1]
+        finally:
+            first_chunk.cancel()
+            for task in tasks.values():
+                task.cancel()
+    
+    async def get_location_facts(self, coordinates: List[Tuple[float, float]]) -> List[str]:
+        """
+        Get facts for several locations, asking for all cache misses in one batch request.
+        Locations the batch does not cover fall back to single requests.
+        """
+        canonical = [self._canonical(latitude, longitude) for latitude, longitude in coordinates]
+        facts = [self.cache.get(latitude, longitude) for latitude, longitude, _ in canonical]
+        misses = [index for index, fact in enumerate(facts) if fact is None]
+        
+        if len(misses) > 1:
+            batch = [canonical[index][:2] for index in misses]
+            places = [canonical[index][2] for index in misses]
+            for name in self.router.order():
+                result = await self.router.call_batch(name, batch, places)
+                if result.ok:
+                    for index, fact in zip(misses, result.facts):
+                        if fact:
+                            facts[index] = fact
+                            self.cache.put(*canonical[index][:2], fact)
+                    break
+                logger.warning("%s batch request failed: %s", name, result.error)
+        
+        # Single requests for whatever is still missing
+        remaining = [index for index, fact in enumerate(facts) if fact is None]
+        if remaining:
+            singles = await asyncio.gather(*[self.get_location_fact(*coordinates[index]) for index in remaining])
+            for index, fact in zip(remaining, singles):
+                facts[index] = fact
+        return facts
+    
+    async def try_location_fact(self, latitude: float, longitude: float) -> Optional[str]:
+        """
+        Get a location fact for background work; returns None instead of an
+        apology message if no provider produced one
+        """
+        latitude, longitude, place = self._canonical(latitude, longitude)
+        cached = self.cache.get(latitude, longitude)
+        if cached is not None:
+            return cached
+        
+        result = await self._fetch_fact(latitude, longitude, place)
+        if not result.ok:
+            return None
+        self.cache.put(latitude, longitude, result.fact)
+        return result.fact
+    
+    def token_stats(self) -> Dict[str, Dict[str, float]]:
+        """Token accounting of each configured provider"""
+        return {name: client.tokens.stats() for name, client in self.router.providers.items()}
+    
+    def has_spare_capacity(self, reserve: float = 0.5) -> bool:
+        """True if the preferred provider's rate budget has room beyond `reserve`"""
+        order = self.router.order()
+        if not order:
+            return False
+        provider = self.router.providers[order[0]]
+        limiter = getattr(provider, 'rate_limiter', None)
+        if limiter is None:
+            return True
+        return limiter.has_headroom(getattr(provider, 'max_tokens', 0) + 100, reserve)
+    
+    async def _fetch_and_cache(self, latitude: float, longitude: float, place: Optional[str] = None) -> FactResult:
+        result = await self._fetch_fact(latitude, longitude, place)
+        if result.ok:
+            self.cache.put(latitude, longitude, result.fact)
+        return result
+    
+    def _current_hedge_delay(self, provider: str) -> float:
+        """Delay before the secondary provider is started"""
+        if self.hedge_auto:
+            p90 = self.router.health[provider].p90_latency()
+            if p90 is not None:
+                return p90
+        return self.hedge_delay
+    
+    async def _fetch_hedged(self, order, latitude: float, longitude: float, place: Optional[str] = None) -> FactResult:
+        """
+        Race the best provider against the next one, started after the hedge delay
+        """
+        primary_name, secondary_name = order[0], order[1]
+        primary = asyncio.create_task(self.router.call(primary_name, latitude, longitude, place))
+        tasks = {primary}
+        last_result = None
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=self._current_hedge_delay(primary_name))
+            if done:
+                last_result = primary.result()
+                if last_result.ok:
+                    return last_result
+            
+            logger.info("%s is slow or failed, starting %s in parallel...", primary_name, secondary_name)
+            HEDGES.inc(provider=secondary_name)
+            tasks.add(asyncio.create_task(self.router.call(secondary_name, latitude, longitude, place)))
+            tasks -= done
+            
+            # Return the first valid fact; the loser is cancelled in finally
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    last_result = task.result()
+                    if last_result.ok:
+                        HEDGE_WINS.inc(provider=last_result.provider)
+                        return last_result
+            
+            return FactResult(provider=secondary_name, error="all providers failed", user_message=ALL_FAILED_MESSAGE)
+        finally:
+            for task in tasks:
+                task.cancel()
+    
+    async def _fetch_fact(self, latitude: float, longitude: float, place: Optional[str] = None) -> FactResult:
+        """
+        Get a location fact using available AI services
+        """
+        order = self.router.order()
+        if not order:
+            logger.warning("All providers are unavailable (circuit breakers open)")
+            return FactResult(provider="none", error="no provider available", user_message=UNAVAILABLE_MESSAGE)
+        
+        if self.hedge_enabled and len(order) > 1:
+            return await self._fetch_hedged(order, latitude, longitude, place)
+        
+        # Try providers one after another, best first
+        result = None
+        for name in order:
+            logger.info("Trying to get fact using %s...", name)
+            result = await self.router.call(name, latitude, longitude, place)
+            if result.ok:
+                logger.info("Got fact from %s", name, extra={
+                    "provider": name,
+                    "latency_ms": round(result.latency * 1000, 1),
+                    "prompt_tokens": result.prompt_tokens,
+                    "completion_tokens": result.completion_tokens
+                })
+                return result
+            logger.warning("%s request failed: %s", name, result.error,
+                           extra={"provider": name, "latency_ms": round(result.latency * 1000, 1)})
+            if name != order[-1]:
+                FALLBACKS.inc(provider=name)
+        
+        if len(order) > 1:
+            result.user_message = ALL_FAILED_MESSAGE
+        return result
+    
+    def get_provider_stats(self):
+        """Get per-provider routing statistics"""
+        return self.router.stats()
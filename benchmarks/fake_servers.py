@@ -0,0 +1,232 @@
+"""
+Local stand-ins for the Telegram Bot API and OpenAI/OpenRouter chat completions.
+
+Both run in one aiohttp application. Latency, error rate and 429 behaviour
+are configurable. The /_bench/* endpoints let the load generator inject
+updates and read back what the bot sent.
+"""
+import asyncio
+import json
+import random
+import re
+import time
+from typing import Any, Dict, List, Optional
+
+from aiohttp import web
+
+
+class FakeLLM:
+    """OpenAI-compatible /chat/completions with configurable latency and failures"""
+    def __init__(self, latency: float, jitter: float, error_rate: float, rate_limit_rate: float,
+                 retry_after: float = 1.0, stream_chunks: int = 8):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.stream_chunks = stream_chunks
+        self.requests = 0
+        self.errors = 0
+        self.rate_limited = 0
+        self.cancelled = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def _delay(self) -> float:
+        return max(0.0, random.gauss(self.latency, self.jitter))
+
+    def _content(self, body: Dict[str, Any]) -> str:
+        prompt = body["messages"][-1]["content"]
+        fact = f"Факт №{random.randrange(10 ** 9)}: здесь когда-то произошло что-то очень интересное."
+        # Batch prompts ask for a JSON array of N facts
+        match = re.search(r"JSON-массив из (\d+) строк", prompt)
+        if match:
+            return json.dumps([f"{fact} ({index})" for index in range(int(match.group(1)))], ensure_ascii=False)
+        return fact
+
+    async def handle(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        self.requests += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            roll = random.random()
+            if roll < self.rate_limit_rate:
+                self.rate_limited += 1
+                return web.json_response(
+                    {"error": {"message": "Rate limit reached", "type": "rate_limit_error"}},
+                    status=429, headers={"Retry-After": str(self.retry_after)}
+                )
+            await asyncio.sleep(self._delay())
+            if roll < self.rate_limit_rate + self.error_rate:
+                self.errors += 1
+                return web.json_response({"error": {"message": "Internal error", "type": "server_error"}}, status=500)
+
+            content = self._content(body)
+            prompt_tokens = sum(len(message["content"]) for message in body["messages"]) // 3
+            usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(content) // 3,
+                     "total_tokens": prompt_tokens + len(content) // 3}
+            if body.get("stream"):
+                return await self._stream(request, body, content, usage)
+            return web.json_response({
+                "id": "chatcmpl-bench",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": body.get("model", "bench"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content},
+                             "finish_reason": "stop"}],
+                "usage": usage,
+            })
+        finally:
+            self.in_flight -= 1
+
+    async def _stream(self, request: web.Request, body: Dict[str, Any], content: str,
+                      usage: Dict[str, int]) -> web.StreamResponse:
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        size = max(1, len(content) // self.stream_chunks)
+        try:
+            await response.prepare(request)
+            for start in range(0, len(content), size):
+                chunk = {
+                    "id": "chatcmpl-bench",
+                    "object": "chat.completion.chunk",
+                    "created": int(time.time()),
+                    "model": body.get("model", "bench"),
+                    "choices": [{"index": 0, "delta": {"content": content[start:start + size]}, "finish_reason": None}],
+                }
+                await response.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode())
+                await asyncio.sleep(0.02)
+            # Final event with the finish reason and usage, as OpenAI (include_usage) and OpenRouter send it
+            final = {"id": "chatcmpl-bench", "object": "chat.completion.chunk", "created": int(time.time()),
+                     "model": body.get("model", "bench"),
+                     "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}], "usage": usage}
+            await response.write(f"data: {json.dumps(final)}\n\n".encode())
+            await response.write(b"data: [DONE]\n\n")
+            await response.write_eof()
+        except ConnectionResetError:
+            # The client gave up (deadline, hedging)
+            self.cancelled += 1
+        return response
+
+    def stats(self) -> Dict[str, int]:
+        return {"requests": self.requests, "errors": self.errors, "rate_limited": self.rate_limited,
+                "cancelled": self.cancelled, "max_in_flight": self.max_in_flight}
+
+
+class FakeTelegram:
+    """Bot API subset used by the bot, with long polling fed from injected updates"""
+    def __init__(self, latency: float, rate_limit_rate: float, retry_after: int = 1):
+        self.latency = latency
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.updates: List[Dict[str, Any]] = []
+        self.next_update_id = 1
+        self.new_updates = asyncio.Event()
+        self.next_message_id = 1000
+        # (time, chat_id, method, text, message_id)
+        self.deliveries: List[List[Any]] = []
+        # (time, update_id, chat_id, kind)
+        self.injected: List[List[Any]] = []
+        self.calls = 0
+        self.rate_limited = 0
+
+    def inject(self, kind: str, payload: Dict[str, Any]) -> int:
+        update_id = self.next_update_id
+        self.next_update_id += 1
+        self.updates.append({"update_id": update_id, kind: payload})
+        self.injected.append([time.time(), update_id, payload["chat"]["id"], kind])
+        self.new_updates.set()
+        return update_id
+
+    async def _get_updates(self, params: Dict[str, str]):
+        offset = int(params.get("offset") or 0)
+        timeout = float(params.get("timeout") or 0)
+        self.updates = [update for update in self.updates if update["update_id"] >= offset]
+        if not self.updates and timeout:
+            self.new_updates.clear()
+            try:
+                await asyncio.wait_for(self.new_updates.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        limit = int(params.get("limit") or 100)
+        return self.updates[:limit]
+
+    def _message(self, chat_id: int, text: str, message_id: Optional[int] = None) -> Dict[str, Any]:
+        if message_id is None:
+            message_id = self.next_message_id
+            self.next_message_id += 1
+        return {"message_id": message_id, "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"}, "text": text}
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params = dict(await request.post())
+        if method == "getUpdates":
+            return web.json_response({"ok": True, "result": await self._get_updates(params)})
+
+        self.calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if method in ("sendMessage", "editMessageText", "sendChatAction") and random.random() < self.rate_limit_rate:
+            self.rate_limited += 1
+            return web.json_response({
+                "ok": False, "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after},
+            }, status=429)
+
+        if method == "getMe":
+            result: Any = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        elif method in ("sendMessage", "editMessageText"):
+            chat_id = int(params["chat_id"])
+            text = params.get("text", "")
+            message_id = int(params["message_id"]) if method == "editMessageText" else None
+            result = self._message(chat_id, text, message_id)
+            self.deliveries.append([time.time(), chat_id, method, text, result["message_id"]])
+        else:
+            # sendChatAction, deleteWebhook, setWebhook, ...
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    def stats(self) -> Dict[str, int]:
+        return {"calls": self.calls, "rate_limited": self.rate_limited, "deliveries": len(self.deliveries)}
+
+
+def create_app(telegram: FakeTelegram, openai: FakeLLM, openrouter: FakeLLM) -> web.Application:
+    app = web.Application()
+    app.router.add_post("/bot{token}/{method}", telegram.handle)
+    app.router.add_post("/openai/v1/chat/completions", openai.handle)
+    app.router.add_post("/openrouter/api/v1/chat/completions", openrouter.handle)
+
+    async def models(request: web.Request) -> web.Response:
+        # Hit by the bot's connection warm-up at startup
+        return web.json_response({"object": "list", "data": []})
+
+    app.router.add_get("/openai/v1/models", models)
+    app.router.add_get("/openrouter/api/v1/models", models)
+
+    async def inject(request: web.Request) -> web.Response:
+        body = await request.json()
+        return web.json_response({"update_id": telegram.inject(body["kind"], body["payload"])})
+
+    async def results(request: web.Request) -> web.Response:
+        return web.json_response({
+            "deliveries": telegram.deliveries,
+            "injected": telegram.injected,
+            "telegram": telegram.stats(),
+            "openai": openai.stats(),
+            "openrouter": openrouter.stats(),
+        })
+
+    app.router.add_post("/_bench/inject", inject)
+    app.router.add_get("/_bench/results", results)
+    return app
+
+
+def serve(port: int, config: Dict[str, Any]):
+    """Process entry point: run the fake servers until terminated"""
+    telegram = FakeTelegram(config["tg_latency"], config["tg_429_rate"])
+    openai = FakeLLM(config["llm_latency"], config["llm_jitter"], config["llm_error_rate"], config["llm_429_rate"])
+    openrouter = FakeLLM(config["llm_latency"], config["llm_jitter"], config["llm_error_rate"], config["llm_429_rate"])
+    web.run_app(create_app(telegram, openai, openrouter), host="127.0.0.1", port=port,
+                print=None, handle_signals=True)
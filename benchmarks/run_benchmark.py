@@ -0,0 +1,422 @@
+"""
+Offline load test: the real dispatcher, fact generator and live location
+manager against local fake Telegram and LLM servers.
+
+    python benchmarks/run_benchmark.py --users 50 --duration 30
+
+Reports throughput, reply latency percentiles, event-loop lag and memory,
+and exits with status 1 if a --max-*/--min-* gate is not met.
+"""
+import argparse
+import asyncio
+import json
+import math
+import multiprocessing
+import os
+import random
+import resource
+import socket
+import sys
+import time
+import tracemalloc
+import urllib.request
+from typing import Dict, List, Optional, Tuple
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fake_servers  # noqa: E402
+
+# Cities the simulated users are spread around, so some requests share cache entries
+HOTSPOTS = [(55.7539, 37.6208), (59.9398, 30.3146), (56.8389, 60.6057), (43.5855, 39.7231), (55.7961, 49.1064)]
+
+FACT_HEADER = "Интересный факт о месте рядом с вами"
+ERROR_TEXT = "Произошла ошибка при обработке"
+# Overload replies: a cached fact from nearby or a busy notice
+DEGRADED_TEXTS = ("поэтому вот факт о месте неподалёку", "Сейчас очень много запросов")
+PERIODIC_HEADER = "Новый факт"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=50, help="simulated users")
+    parser.add_argument("--live-fraction", type=float, default=0.3, help="share of users sharing live location")
+    parser.add_argument("--duration", type=float, default=30, help="seconds of load")
+    parser.add_argument("--think-time", type=float, default=15, help="mean seconds between static locations per user")
+    parser.add_argument("--update-interval", type=float, default=2, help="seconds between live location updates")
+    parser.add_argument("--live-interval", type=float, default=10, help="seconds between periodic live facts")
+    parser.add_argument("--speed", type=float, default=15, help="live user speed, m/s")
+    parser.add_argument("--llm-latency", type=float, default=0.8)
+    parser.add_argument("--llm-jitter", type=float, default=0.3)
+    parser.add_argument("--llm-error-rate", type=float, default=0.02)
+    parser.add_argument("--llm-429-rate", type=float, default=0.01)
+    parser.add_argument("--tg-latency", type=float, default=0.03)
+    parser.add_argument("--tg-429-rate", type=float, default=0.0)
+    parser.add_argument("--single-provider", action="store_true", help="configure only OpenAI")
+    parser.add_argument("--grace", type=float, default=30, help="seconds to wait for outstanding replies")
+    parser.add_argument("--tracemalloc", action="store_true", help="report Python heap peak (slower)")
+    parser.add_argument("--json", help="write the report to this file")
+    parser.add_argument("--log-level", default="WARNING", help="bot log level during the run")
+    parser.add_argument("--max-p99", type=float, help="fail if reply p99 exceeds this many seconds")
+    parser.add_argument("--max-loop-lag", type=float, help="fail if event-loop lag p99 exceeds this many seconds")
+    parser.add_argument("--min-throughput", type=float, help="fail if completed replies/s is lower")
+    parser.add_argument("--max-startup", type=float, help="fail if startup takes longer than this many seconds")
+    return parser.parse_args()
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, math.ceil(q * len(ordered)) - 1))
+    return ordered[index]
+
+
+def summarize(values: List[float]) -> Dict[str, Optional[float]]:
+    return {
+        "count": len(values),
+        "p50": percentile(values, 0.5),
+        "p90": percentile(values, 0.9),
+        "p99": percentile(values, 0.99),
+        "max": max(values) if values else None,
+    }
+
+
+def configure_environment(base_url: str, args):
+    """Point the bot at the fake servers; existing variables win so runs can tune the bot"""
+    defaults = {
+        "TELEGRAM_TOKEN": "123456:BENCHMARK",
+        "TELEGRAM_API_URL": base_url,
+        "OPENAI_API_KEY": "bench",
+        "OPENAI_BASE_URL": f"{base_url}/openai/v1",
+        "OPENROUTER_BASE_URL": f"{base_url}/openrouter/api/v1",
+        "STATE_BACKEND": "none",
+        "BOT_MODE": "polling",
+        "METRICS_PORT": "0",
+        "OPENAI_RPM": "100000",
+        "OPENROUTER_RPM": "100000",
+        "LIVE_MIN_INTERVAL": str(args.live_interval / 2),
+        "LIVE_MAX_INTERVAL": str(args.live_interval * 3),
+        "LIVE_MIN_DISTANCE_M": "50",
+    }
+    if not args.single_provider:
+        defaults["OPENROUTER_API_KEY"] = "bench"
+    for name, value in defaults.items():
+        os.environ.setdefault(name, value)
+
+
+class LoadGenerator:
+    def __init__(self, base_url: str, args):
+        self.base_url = base_url
+        self.args = args
+        self.next_message_id = 1
+
+    def _post(self, kind: str, payload: Dict):
+        request = urllib.request.Request(
+            f"{self.base_url}/_bench/inject",
+            data=json.dumps({"kind": kind, "payload": payload}).encode(),
+            headers={"Content-Type": "application/json"},
+        )
+        urllib.request.urlopen(request).read()
+
+    async def inject(self, kind: str, payload: Dict):
+        await asyncio.to_thread(self._post, kind, payload)
+
+    def _message(self, chat_id: int, message_id: int, latitude: float, longitude: float,
+                 live_period: Optional[int] = None) -> Dict:
+        location = {"latitude": latitude, "longitude": longitude}
+        if live_period:
+            location["live_period"] = live_period
+        return {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": chat_id, "is_bot": False, "first_name": f"User{chat_id}"},
+            "location": location,
+        }
+
+    def _start_point(self):
+        latitude, longitude = random.choice(HOTSPOTS)
+        return latitude + random.uniform(-0.02, 0.02), longitude + random.uniform(-0.02, 0.02)
+
+    async def static_user(self, chat_id: int, deadline: float):
+        await asyncio.sleep(random.uniform(0, min(2.0, self.args.think_time)))
+        while time.monotonic() < deadline:
+            message_id = self.next_message_id
+            self.next_message_id += 1
+            await self.inject("message", self._message(chat_id, message_id, *self._start_point()))
+            await asyncio.sleep(min(random.expovariate(1 / self.args.think_time),
+                                    max(0.0, deadline - time.monotonic())))
+
+    async def live_user(self, chat_id: int, deadline: float):
+        await asyncio.sleep(random.uniform(0, 2.0))
+        message_id = self.next_message_id
+        self.next_message_id += 1
+        latitude, longitude = self._start_point()
+        heading = random.uniform(0, 2 * math.pi)
+        live_period = int(self.args.duration + self.args.grace + 60)
+        await self.inject("message", self._message(chat_id, message_id, latitude, longitude, live_period))
+
+        while time.monotonic() + self.args.update_interval < deadline:
+            await asyncio.sleep(self.args.update_interval)
+            step = self.args.speed * self.args.update_interval
+            latitude += step * math.cos(heading) / 111320
+            longitude += step * math.sin(heading) / (111320 * math.cos(math.radians(latitude)))
+            payload = self._message(chat_id, message_id, latitude, longitude, live_period)
+            payload["edit_date"] = int(time.time())
+            await self.inject("edited_message", payload)
+
+    async def run(self):
+        deadline = time.monotonic() + self.args.duration
+        live_users = int(round(self.args.users * self.args.live_fraction))
+        tasks = []
+        for index in range(self.args.users):
+            chat_id = 10000 + index
+            if index < live_users:
+                tasks.append(asyncio.create_task(self.live_user(chat_id, deadline)))
+            else:
+                tasks.append(asyncio.create_task(self.static_user(chat_id, deadline)))
+        await asyncio.gather(*tasks)
+
+
+async def monitor_loop_lag(samples: List[float], interval: float = 0.05):
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        samples.append(max(0.0, loop.time() - expected))
+
+
+def fetch_results(base_url: str) -> Dict:
+    with urllib.request.urlopen(f"{base_url}/_bench/results") as response:
+        return json.loads(response.read())
+
+
+def reply_kind(text: str) -> str:
+    if ERROR_TEXT in text:
+        return "error"
+    if any(marker in text for marker in DEGRADED_TEXTS):
+        return "degraded"
+    return "fact"
+
+
+def match_replies(results: Dict):
+    """
+    Pair each reply with the location message it answers in the same chat,
+    and time its first visible text and its final text.
+    Returns latencies of all final replies, of first visible text, and
+    counts of periodic facts and of replies by kind.
+    """
+    # chat_id -> replies in order: [start time, first text time, final time, kind]
+    replies: Dict[int, List[list]] = {}
+    by_message: Dict[Tuple[int, int], list] = {}
+    periodic = 0
+    for sent_at, chat_id, method, text, message_id in results["deliveries"]:
+        if PERIODIC_HEADER in text:
+            periodic += 1
+            continue
+        reply = by_message.get((chat_id, message_id))
+        if reply is None:
+            if method != "sendMessage" or (FACT_HEADER not in text and reply_kind(text) == "fact"):
+                continue
+            reply = by_message[(chat_id, message_id)] = [sent_at, None, None, None]
+            replies.setdefault(chat_id, []).append(reply)
+        if reply[1] is None and not text.endswith(":\n\n⏳"):
+            reply[1] = sent_at
+        if reply[2] is None and not text.endswith("⏳"):
+            reply[2] = sent_at
+            reply[3] = reply_kind(text)
+
+    injected: Dict[int, List[float]] = {}
+    for injected_at, _, chat_id, kind in results["injected"]:
+        if kind == "message":
+            injected.setdefault(chat_id, []).append(injected_at)
+
+    reply_latency, first_text_latency = [], []
+    kinds = {"fact": 0, "degraded": 0, "error": 0}
+    for chat_id, chat_replies in replies.items():
+        pending = injected.get(chat_id, [])
+        for started_at, first_text_at, final_at, reply_type in chat_replies:
+            # The newest location sent before the reply started: older waiting ones are superseded
+            candidates = [injected_at for injected_at in pending if injected_at <= started_at]
+            if not candidates or final_at is None:
+                continue
+            injected_at = candidates[-1]
+            pending.remove(injected_at)
+            kinds[reply_type] += 1
+            if reply_type != "error":
+                reply_latency.append(final_at - injected_at)
+                first_text_latency.append(first_text_at - injected_at)
+    return reply_latency, first_text_latency, periodic, kinds
+
+
+async def wait_for_replies(base_url: str, grace: float) -> Dict:
+    deadline = time.monotonic() + grace
+    while True:
+        results = await asyncio.to_thread(fetch_results, base_url)
+        expected = sum(1 for entry in results["injected"] if entry[3] == "message")
+        if sum(match_replies(results)[3].values()) >= expected or time.monotonic() >= deadline:
+            return results
+        await asyncio.sleep(0.5)
+
+
+async def run(args, base_url: str) -> Dict:
+    import main as bot_main
+    from metrics import HANDLER_STAGE_LATENCY, TELEGRAM_QUEUE_LATENCY, UPSTREAM_LATENCY
+
+    os.environ["LOG_LEVEL"] = args.log_level
+    app = bot_main.create_app()
+
+    manager = app.live_location_manager
+    manager.update_interval = args.live_interval
+
+    lag_samples: List[float] = []
+    lag_task = asyncio.create_task(monitor_loop_lag(lag_samples))
+    if args.tracemalloc:
+        tracemalloc.start()
+
+    await app.startup()
+    startup_seconds = time.monotonic() - bot_main.STARTED_AT
+    polling = asyncio.create_task(app.dp.start_polling(
+        app.bot, handle_signals=False, close_bot_session=False, polling_timeout=1
+    ))
+
+    started = time.monotonic()
+    await LoadGenerator(base_url, args).run()
+    load_seconds = time.monotonic() - started
+    results = await wait_for_replies(base_url, args.grace)
+    sessions_at_end = manager.get_active_sessions_count()
+
+    await app.dp.stop_polling()
+    await asyncio.gather(polling, return_exceptions=True)
+    await app.shutdown()
+    lag_task.cancel()
+
+    reply_latency, first_text_latency, periodic, kinds = match_replies(results)
+    expected = sum(1 for entry in results["injected"] if entry[3] == "message")
+    report = {
+        "config": vars(args),
+        # From importing the bot to polling, with the time of each phase
+        "startup_seconds": round(startup_seconds, 3),
+        "startup_phases": {phase: round(seconds, 3) for phase, seconds in app.startup_phases.items()},
+        "load_seconds": round(load_seconds, 2),
+        "requests": expected,
+        "completed": kinds["fact"],
+        "degraded": kinds["degraded"],
+        "errors": kinds["error"],
+        # Includes requests superseded by a newer location from the same chat
+        "unanswered": expected - sum(kinds.values()),
+        "throughput_rps": round(kinds["fact"] / load_seconds, 2),
+        "reply_latency": summarize(reply_latency),
+        "first_text_latency": summarize(first_text_latency),
+        "periodic_facts": periodic,
+        "live_sessions_at_end": sessions_at_end,
+        "loop_lag": summarize(lag_samples),
+        "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "upstream_p99": {name: UPSTREAM_LATENCY.quantile(0.99, provider=name, outcome="ok")
+                         for name in app.fact_generator.router.providers},
+        "telegram_queue_p99": TELEGRAM_QUEUE_LATENCY.quantile(0.99, priority="interactive"),
+        "handler_total_p99": HANDLER_STAGE_LATENCY.quantile(0.99, stage="total"),
+        "cache": app.fact_generator.cache.stats(),
+        "tokens": app.fact_generator.token_stats(),
+        "admission": app.admission.stats(),
+        "servers": {name: results[name] for name in ("telegram", "openai", "openrouter")},
+    }
+    if args.tracemalloc:
+        report["python_heap_peak_mb"] = round(tracemalloc.get_traced_memory()[1] / 2 ** 20, 1)
+        tracemalloc.stop()
+    return report
+
+
+def format_seconds(value: Optional[float]) -> str:
+    return "-" if value is None else f"{value * 1000:.0f} ms"
+
+
+def print_report(report: Dict):
+    print()
+    phases = ", ".join(f"{phase} {seconds * 1000:.0f} ms" for phase, seconds in report["startup_phases"].items())
+    print(f"Startup: {report['startup_seconds'] * 1000:.0f} ms ({phases})")
+    print(f"Requests: {report['requests']}, completed: {report['completed']}, degraded: {report['degraded']}, "
+          f"errors: {report['errors']}, unanswered: {report['unanswered']}, "
+          f"throughput: {report['throughput_rps']} replies/s over {report['load_seconds']}s")
+    for name in ("reply_latency", "first_text_latency", "loop_lag"):
+        stats = report[name]
+        print(f"{name:20} p50 {format_seconds(stats['p50']):>9}  p90 {format_seconds(stats['p90']):>9}  "
+              f"p99 {format_seconds(stats['p99']):>9}  max {format_seconds(stats['max']):>9}")
+    print(f"Periodic facts: {report['periodic_facts']}, live sessions at end: {report['live_sessions_at_end']}")
+    print(f"Max RSS: {report['max_rss_mb']} MB" +
+          (f", Python heap peak: {report['python_heap_peak_mb']} MB" if "python_heap_peak_mb" in report else ""))
+    print(f"Cache: {report['cache']}")
+    print(f"Admission: {report['admission']}")
+    print(f"Tokens: {json.dumps(report['tokens'])}")
+    print(f"Servers: {json.dumps(report['servers'])}")
+
+
+def check_gates(report: Dict, args) -> List[str]:
+    failures = []
+    p99 = report["reply_latency"]["p99"]
+    if args.max_p99 is not None and (p99 is None or p99 > args.max_p99):
+        failures.append(f"reply p99 {p99} > {args.max_p99}")
+    lag = report["loop_lag"]["p99"]
+    if args.max_loop_lag is not None and lag is not None and lag > args.max_loop_lag:
+        failures.append(f"loop lag p99 {lag} > {args.max_loop_lag}")
+    if args.min_throughput is not None and report["throughput_rps"] < args.min_throughput:
+        failures.append(f"throughput {report['throughput_rps']} < {args.min_throughput}")
+    if args.max_startup is not None and report["startup_seconds"] > args.max_startup:
+        failures.append(f"startup {report['startup_seconds']}s > {args.max_startup}s")
+    if report["errors"]:
+        failures.append(f"{report['errors']} requests failed")
+    return failures
+
+
+def main():
+    args = parse_args()
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    server_config = {
+        "llm_latency": args.llm_latency, "llm_jitter": args.llm_jitter,
+        "llm_error_rate": args.llm_error_rate, "llm_429_rate": args.llm_429_rate,
+        "tg_latency": args.tg_latency, "tg_429_rate": args.tg_429_rate,
+    }
+    # Separate process so the fake servers do not add to the bot's event-loop lag
+    server = multiprocessing.get_context("spawn").Process(
+        target=fake_servers.serve, args=(port, server_config), daemon=True
+    )
+    server.start()
+    try:
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                fetch_results(base_url)
+                break
+            except OSError:
+                if time.monotonic() > deadline or not server.is_alive():
+                    raise RuntimeError("fake servers did not start")
+                time.sleep(0.2)
+
+        configure_environment(base_url, args)
+        report = asyncio.run(run(args, base_url))
+    finally:
+        server.terminate()
+        server.join(5)
+
+    print_report(report)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+
+    failures = check_gates(report, args)
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
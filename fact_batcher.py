@@ -0,0 +1,86 @@
+import asyncio
+import logging
+import os
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class FactBatcher:
+    """
+    Collect fact requests for a short window and resolve them with one batch call.
+
+    Requests for the same rounded coordinates within a window share a result.
+    The generator's get_location_facts() falls back to single requests for any
+    location the batch response did not cover.
+    """
+    def __init__(self, fact_generator, window: Optional[float] = None, max_batch: Optional[int] = None):
+        self.fact_generator = fact_generator
+        self.window = window if window is not None else float(os.getenv('FACT_BATCH_WINDOW', '0.5'))
+        self.max_batch = max_batch if max_batch is not None else int(os.getenv('FACT_BATCH_MAX', '5'))
+        self.precision = int(os.getenv('FACT_COALESCE_PRECISION', '3'))
+
+        self._pending: Dict[Tuple[float, float], Tuple[float, float, List[asyncio.Future]]] = {}
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._flushes = set()
+
+    @property
+    def enabled(self) -> bool:
+        return self.window > 0 and self.max_batch > 1
+
+    async def get_location_fact(self, latitude: float, longitude: float) -> str:
+        """Get a location fact, possibly as part of a batch"""
+        if not self.enabled:
+            return await self.fact_generator.get_location_fact(latitude, longitude)
+
+        # Cache hits do not need to wait for the window. The generator canonicalizes
+        # the coordinates; a miss is counted once, by the batch lookup.
+        if self.fact_generator.has_cached_fact(latitude, longitude):
+            return self.fact_generator.cached_fact(latitude, longitude)
+
+        future = asyncio.get_running_loop().create_future()
+        key = (round(latitude, self.precision), round(longitude, self.precision))
+        if key in self._pending:
+            self._pending[key][2].append(future)
+        else:
+            self._pending[key] = (latitude, longitude, [future])
+
+        if len(self._pending) >= self.max_batch:
+            self._flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.window, self._flush)
+
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return
+        batch = list(self._pending.values())
+        self._pending = {}
+        task = asyncio.create_task(self._resolve(batch))
+        self._flushes.add(task)
+        task.add_done_callback(self._flushes.discard)
+
+    async def _resolve(self, batch):
+        coordinates = [(latitude, longitude) for latitude, longitude, _ in batch]
+        try:
+            if len(batch) == 1:
+                facts = [await self.fact_generator.get_location_fact(*coordinates[0])]
+            else:
+                logger.info("Resolving batch of %s fact requests", len(batch))
+                facts = await self.fact_generator.get_location_facts(coordinates)
+        except Exception as e:
+            logger.error("Error resolving fact batch: %s", e)
+            for _, _, futures in batch:
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(e)
+            return
+
+        for (_, _, futures), fact in zip(batch, facts):
+            for future in futures:
+                if not future.done():
+                    future.set_result(fact)
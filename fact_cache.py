@@ -0,0 +1,212 @@
+import logging
+import math
+import os
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+EARTH_RADIUS_M = 6371000.0
+METERS_PER_DEGREE = 111320.0
+
+
+def haversine_m(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """Great-circle distance between two points in meters"""
+    phi1 = math.radians(lat1)
+    phi2 = math.radians(lat2)
+    d_phi = phi2 - phi1
+    d_lambda = math.radians(lon2 - lon1)
+    a = math.sin(d_phi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(d_lambda / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(min(1.0, math.sqrt(a)))
+
+
+@dataclass
+class CachedFact:
+    latitude: float
+    longitude: float
+    fact: str
+    created_at: float
+
+
+class GeoFactCache:
+    """
+    In-memory cache of location facts keyed by a spatial grid.
+
+    The grid cell size is at least the reuse radius in both directions, so every
+    cached fact within the radius of a point lies in that point's cell or one of
+    its 8 neighbours. Cells are evicted in LRU order once the total number of
+    stored facts exceeds the cap; individual facts expire after the TTL.
+    """
+    def __init__(self, radius_m: Optional[float] = None, ttl: Optional[float] = None,
+                 max_entries: Optional[int] = None, facts_per_cell: Optional[int] = None):
+        self.radius_m = radius_m if radius_m is not None else float(os.getenv('FACT_CACHE_RADIUS_M', '500'))
+        self.ttl = ttl if ttl is not None else float(os.getenv('FACT_CACHE_TTL', '86400'))
+        self.max_entries = max_entries if max_entries is not None else int(os.getenv('FACT_CACHE_MAX_ENTRIES', '10000'))
+        self.facts_per_cell = facts_per_cell if facts_per_cell is not None else int(os.getenv('FACT_CACHE_FACTS_PER_CELL', '3'))
+
+        # Cell height in degrees of latitude
+        self.lat_step = max(self.radius_m, 1.0) / METERS_PER_DEGREE
+
+        self.cells: "OrderedDict[Tuple[int, int], List[CachedFact]]" = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._rotation: Dict[Tuple[int, int], int] = {}
+
+        # Called with each newly stored fact (e.g. to persist it)
+        self.on_store: Optional[Callable[[CachedFact], None]] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0 and self.facts_per_cell > 0
+
+    def _lon_step(self, row: int) -> float:
+        """Cell width in degrees of longitude for a latitude row"""
+        # Use the pole-side edge of the row so the cell is never narrower than the radius
+        edge_lat = max(abs(row * self.lat_step), abs((row + 1) * self.lat_step))
+        cos_lat = max(math.cos(math.radians(min(edge_lat, 90.0))), 1e-3)
+        return min(self.lat_step / cos_lat, 360.0)
+
+    def _cell(self, latitude: float, longitude: float, row: Optional[int] = None) -> Tuple[int, int]:
+        if row is None:
+            row = math.floor(latitude / self.lat_step)
+        return row, math.floor(longitude / self._lon_step(row))
+
+    def _neighbour_cells(self, latitude: float, longitude: float):
+        row = math.floor(latitude / self.lat_step)
+        for d_row in (-1, 0, 1):
+            r, col = self._cell(latitude, longitude, row + d_row)
+            for d_col in (-1, 0, 1):
+                yield r, col + d_col
+
+    def _drop_expired(self, key: Tuple[int, int], now: float) -> List[CachedFact]:
+        entries = self.cells.get(key)
+        if not entries:
+            return []
+        fresh = [entry for entry in entries if now - entry.created_at < self.ttl]
+        if len(fresh) != len(entries):
+            self.size -= len(entries) - len(fresh)
+            if fresh:
+                self.cells[key] = fresh
+            else:
+                del self.cells[key]
+                self._rotation.pop(key, None)
+        return fresh
+
+    def get(self, latitude: float, longitude: float) -> Optional[str]:
+        """
+        Return a cached fact within the radius, or None on a miss.
+
+        Until `facts_per_cell` unexpired facts lie within the radius (searched
+        across the 3x3 neighbourhood of cells) this reports a miss, so repeat
+        visitors of a popular place still get new facts.
+        """
+        if not self.enabled:
+            return None
+
+        candidates = self._candidates(latitude, longitude)
+        if len(candidates) < self.facts_per_cell:
+            self.misses += 1
+            return None
+
+        # Rotate through the available facts for variety
+        own_key = self._cell(latitude, longitude)
+        index = self._rotation.get(own_key, 0)
+        self._rotation[own_key] = index + 1
+        if own_key in self.cells:
+            self.cells.move_to_end(own_key)
+
+        self.hits += 1
+        return candidates[index % len(candidates)].fact
+
+    def peek(self, latitude: float, longitude: float) -> bool:
+        """Whether get() would return a fact, without counting a lookup or rotating"""
+        return self.enabled and len(self._candidates(latitude, longitude)) >= self.facts_per_cell
+
+    def _candidates(self, latitude: float, longitude: float) -> List[CachedFact]:
+        now = time.monotonic()
+        candidates = []
+        for key in self._neighbour_cells(latitude, longitude):
+            for entry in self._drop_expired(key, now):
+                if haversine_m(latitude, longitude, entry.latitude, entry.longitude) <= self.radius_m:
+                    candidates.append(entry)
+        return candidates
+
+    def nearest(self, latitude: float, longitude: float, max_distance_m: float) -> Optional[str]:
+        """
+        Closest cached fact within max_distance_m, ignoring the per-cell minimum.
+        Used to answer with a fact about somewhere nearby when fresh generation
+        is not possible; does not count as a hit or miss.
+        """
+        if not self.enabled or not self.cells:
+            return None
+
+        now = time.monotonic()
+        row = math.floor(latitude / self.lat_step)
+        reach = math.ceil(max_distance_m / METERS_PER_DEGREE / self.lat_step)
+        best, best_distance = None, max_distance_m
+        for r in range(row - reach, row + reach + 1):
+            lon_step = self._lon_step(r)
+            col = math.floor(longitude / lon_step)
+            # Row width shrinks towards the poles, so more columns cover the distance
+            cos_lat = max(math.cos(math.radians(min(abs(latitude), 89.0))), 1e-3)
+            col_reach = min(math.ceil(max_distance_m / (METERS_PER_DEGREE * cos_lat) / lon_step), int(360 / lon_step))
+            for c in range(col - col_reach, col + col_reach + 1):
+                for entry in self._drop_expired((r, c), now):
+                    distance = haversine_m(latitude, longitude, entry.latitude, entry.longitude)
+                    if distance <= best_distance:
+                        best, best_distance = entry, distance
+        return best.fact if best is not None else None
+
+    def put(self, latitude: float, longitude: float, fact: str):
+        """Store a freshly generated fact"""
+        if not self.enabled:
+            return
+
+        key = self._cell(latitude, longitude)
+        entries = self._drop_expired(key, time.monotonic())
+        if any(entry.fact == fact for entry in entries):
+            return
+
+        cached = CachedFact(latitude, longitude, fact, time.monotonic())
+        self._store(key, entries, cached)
+        if self.on_store is not None:
+            self.on_store(cached)
+
+    def load(self, facts: Iterable[CachedFact]):
+        """Restore previously stored facts, oldest first"""
+        if not self.enabled:
+            return
+        now = time.monotonic()
+        for cached in facts:
+            if now - cached.created_at >= self.ttl:
+                continue
+            key = self._cell(cached.latitude, cached.longitude)
+            entries = self.cells.get(key, [])
+            if any(entry.fact == cached.fact for entry in entries):
+                continue
+            self._store(key, entries, cached)
+
+    def _store(self, key: Tuple[int, int], entries: List[CachedFact], cached: CachedFact):
+        entries.append(cached)
+        self.size += 1
+
+        # Keep only the newest facts for the cell
+        if len(entries) > self.facts_per_cell:
+            self.size -= len(entries) - self.facts_per_cell
+            entries = entries[-self.facts_per_cell:]
+
+        self.cells[key] = entries
+        self.cells.move_to_end(key)
+
+        # Evict least recently used cells when over the memory cap
+        while self.size > self.max_entries and self.cells:
+            old_key, old_entries = self.cells.popitem(last=False)
+            self._rotation.pop(old_key, None)
+            self.size -= len(old_entries)
+
+    def stats(self) -> Dict[str, int]:
+        """Get cache counters"""
+        return {"cells": len(self.cells), "facts": self.size, "hits": self.hits, "misses": self.misses}
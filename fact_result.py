@@ -0,0 +1,34 @@
+from dataclasses import dataclass
+from typing import List, Optional
+
+# Error of a batch request whose completion was not the expected JSON array.
+# The provider did answer, so this is not held against its health.
+UNPARSEABLE_BATCH = "unparseable batch response"
+
+@dataclass
+class FactResult:
+    """Outcome of a single fact request to one provider"""
+    provider: str
+    fact: Optional[str] = None
+    error: Optional[str] = None
+    user_message: Optional[str] = None
+    latency: float = 0.0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    # Per-location facts of a batch request, in request order
+    facts: Optional[List[Optional[str]]] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None and bool(self.fact)
+
+    @property
+    def unparseable(self) -> bool:
+        return self.error == UNPARSEABLE_BATCH
+
+    @property
+    def text(self) -> str:
+        """Fact text, or the apology message to show the user on failure"""
+        if self.ok:
+            return self.fact
+        return self.user_message or "Извините, не удалось получить информацию об этом месте. Попробуйте отправить локацию ещё раз."
@@ -0,0 +1,186 @@
+import bisect
+import logging
+import math
+import mmap
+import os
+import struct
+import sys
+from typing import List, NamedTuple, Optional, Tuple
+
+from fact_cache import METERS_PER_DEGREE, haversine_m
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"GZT1"
+# magic, record count, cell count, name blob size, cell size in degrees
+HEADER = struct.Struct("<4sIIId")
+HEADER_SIZE = 32
+
+
+class Place(NamedTuple):
+    name: str
+    latitude: float
+    longitude: float
+    distance_m: float
+
+
+class Gazetteer:
+    """
+    Memory-mapped offline index of named places for reverse geocoding.
+
+    The file holds columns sorted by grid cell (see build_gazetteer):
+    sorted cell ids, the first record of each cell, float32 coordinates,
+    name offsets and a UTF-8 name blob. Lookups binary-search the cell ids
+    of the neighbouring cells and scan their records; nothing is loaded
+    into memory up front, and worker processes share the OS page cache.
+    """
+    def __init__(self, path: str, max_distance_m: Optional[float] = None):
+        self.path = path
+        self.max_distance_m = max_distance_m if max_distance_m is not None else float(os.getenv('GAZETTEER_MAX_DISTANCE_M', '1000'))
+
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count, cell_count, names_size, self.cell_deg = HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a gazetteer file")
+
+        self.cols = int(round(360 / self.cell_deg))
+        view = memoryview(self._mmap)
+        offset = HEADER_SIZE
+        self._cells = view[offset:offset + 8 * cell_count].cast("Q")
+        offset += 8 * cell_count
+        self._cell_starts = view[offset:offset + 4 * (cell_count + 1)].cast("I")
+        offset += 4 * (cell_count + 1)
+        self._name_offsets = view[offset:offset + 4 * (self.count + 1)].cast("I")
+        offset += 4 * (self.count + 1)
+        self._lats = view[offset:offset + 4 * self.count].cast("f")
+        offset += 4 * self.count
+        self._lons = view[offset:offset + 4 * self.count].cast("f")
+        offset += 4 * self.count
+        self._names = view[offset:offset + names_size]
+
+    @classmethod
+    def from_env(cls) -> Optional["Gazetteer"]:
+        """Open the file at GAZETTEER_PATH, or return None if it is not configured"""
+        path = os.getenv('GAZETTEER_PATH', '')
+        if not path:
+            return None
+        try:
+            gazetteer = cls(path)
+        except (OSError, ValueError) as e:
+            logger.error("Failed to open gazetteer %s: %s", path, e)
+            return None
+        logger.info("Gazetteer loaded: %s places from %s", gazetteer.count, path)
+        return gazetteer
+
+    def _cell_id(self, row: int, col: int) -> int:
+        return row * self.cols + col % self.cols
+
+    def _cell_range(self, cell_id: int) -> Tuple[int, int]:
+        index = bisect.bisect_left(self._cells, cell_id)
+        if index == len(self._cells) or self._cells[index] != cell_id:
+            return 0, 0
+        return self._cell_starts[index], self._cell_starts[index + 1]
+
+    def nearest(self, latitude: float, longitude: float) -> Optional[Place]:
+        """Nearest named place within max_distance_m, or None"""
+        radius_deg = self.max_distance_m / METERS_PER_DEGREE
+        cos_lat = max(math.cos(math.radians(latitude)), 1e-3)
+        row = math.floor((latitude + 90) / self.cell_deg)
+        col = math.floor((longitude + 180) / self.cell_deg)
+        d_row = math.ceil(radius_deg / self.cell_deg)
+        d_col = min(math.ceil(radius_deg / cos_lat / self.cell_deg), self.cols // 2)
+
+        best_index = -1
+        best_score = float('inf')
+        for r in range(max(row - d_row, 0), min(row + d_row, int(round(180 / self.cell_deg)) - 1) + 1):
+            for c in range(col - d_col, col + d_col + 1):
+                start, end = self._cell_range(self._cell_id(r, c))
+                for index in range(start, end):
+                    # Equirectangular distance is enough to rank nearby points
+                    d_lat = self._lats[index] - latitude
+                    d_lon = (self._lons[index] - longitude + 180) % 360 - 180
+                    score = d_lat * d_lat + (d_lon * cos_lat) ** 2
+                    if score < best_score:
+                        best_score = score
+                        best_index = index
+
+        if best_index < 0:
+            return None
+        place_lat, place_lon = self._lats[best_index], self._lons[best_index]
+        distance = haversine_m(latitude, longitude, place_lat, place_lon)
+        if distance > self.max_distance_m:
+            return None
+        start, end = self._name_offsets[best_index], self._name_offsets[best_index + 1]
+        return Place(bytes(self._names[start:end]).decode("utf-8"), round(place_lat, 6), round(place_lon, 6), distance)
+
+    def close(self):
+        for view in (self._cells, self._cell_starts, self._name_offsets, self._lats, self._lons, self._names):
+            view.release()
+        self._mmap.close()
+
+
+def read_places(source: str) -> List[Tuple[str, float, float]]:
+    """
+    Read places from a GeoNames dump (e.g. cities500.txt, RU.txt) or a
+    tab-separated file of name, latitude, longitude
+    """
+    places = []
+    with open(source, encoding="utf-8") as f:
+        for line in f:
+            fields = line.rstrip("\n").split("\t")
+            try:
+                if len(fields) >= 6:
+                    name, latitude, longitude = fields[1], float(fields[4]), float(fields[5])
+                else:
+                    name, latitude, longitude = fields[0], float(fields[1]), float(fields[2])
+            except (IndexError, ValueError):
+                continue
+            if name:
+                places.append((name, latitude, longitude))
+    return places
+
+
+def build_gazetteer(places: List[Tuple[str, float, float]], path: str, cell_deg: float = 0.1):
+    """Write places to a gazetteer file readable by Gazetteer"""
+    cols = int(round(360 / cell_deg))
+    rows = int(round(180 / cell_deg))
+
+    def cell_id(latitude: float, longitude: float) -> int:
+        row = min(math.floor((latitude + 90) / cell_deg), rows - 1)
+        col = math.floor((longitude + 180) / cell_deg) % cols
+        return row * cols + col
+
+    records = sorted((cell_id(latitude, longitude), name, latitude, longitude)
+                     for name, latitude, longitude in places)
+
+    cells, cell_starts = [], []
+    names = bytearray()
+    name_offsets = []
+    for index, (cell, name, _, _) in enumerate(records):
+        if not cells or cells[-1] != cell:
+            cells.append(cell)
+            cell_starts.append(index)
+        name_offsets.append(len(names))
+        names += name.encode("utf-8")
+    cell_starts.append(len(records))
+    name_offsets.append(len(names))
+
+    with open(path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, len(records), len(cells), len(names), cell_deg).ljust(HEADER_SIZE, b"\0"))
+        f.write(struct.pack(f"<{len(cells)}Q", *cells))
+        f.write(struct.pack(f"<{len(cell_starts)}I", *cell_starts))
+        f.write(struct.pack(f"<{len(name_offsets)}I", *name_offsets))
+        f.write(struct.pack(f"<{len(records)}f", *(record[2] for record in records)))
+        f.write(struct.pack(f"<{len(records)}f", *(record[3] for record in records)))
+        f.write(names)
+
+
+if __name__ == "__main__":
+    # python gazetteer.py cities500.txt gazetteer.bin
+    if len(sys.argv) != 3:
+        print("Usage: python gazetteer.py <geonames.txt> <output.bin>")
+        sys.exit(1)
+    source_places = read_places(sys.argv[1])
+    build_gazetteer(source_places, sys.argv[2])
+    print(f"Wrote {len(source_places)} places to {sys.argv[2]}")
@@ -1,39 +1,92 @@
-import asyncio
 import logging
-from typing import Dict, Optional
-from dataclasses import dataclass
-from datetime import datetime, timedelta
+import os
+from typing import Optional
 import time
+from fact_batcher import FactBatcher
+from fact_cache import haversine_m
+from persistence import StateBackend
+from prefetcher import TrajectoryPrefetcher
+from session_scheduler import SessionScheduler
+from session_store import LiveLocationSession, SessionKey, SessionStore
+from structured_logging import request_context
+from telegram_sender import PRIORITY_PERIODIC
 
 logger = logging.getLogger(__name__)
 
-@dataclass
-class LiveLocationSession:
-    chat_id: int
-    message_id: int
-    latitude: float
-    longitude: float
-    live_period: int
-    start_time: datetime
-    last_update: datetime
-    task: Optional[asyncio.Task] = None
-
 class LiveLocationManager:
-    def __init__(self, fact_generator, bot):
+    def __init__(self, fact_generator, sender):
         self.fact_generator = fact_generator
-        self.bot = bot
-        self.sessions: Dict[str, LiveLocationSession] = {}
+        # Outbound queue (OutboundSender) used for all messages to users
+        self.sender = sender
+        self.sessions = SessionStore()
         self.update_interval = 600  # 10 minutes in seconds
+        
+        # Movement-aware refresh: stationary users are checked less often,
+        # fast-moving users more often
+        self.min_distance_m = float(os.getenv('LIVE_MIN_DISTANCE_M', '200'))
+        self.fast_speed_mps = float(os.getenv('LIVE_FAST_SPEED_MPS', '8'))
+        self.min_interval = float(os.getenv('LIVE_MIN_INTERVAL', '300'))
+        self.max_interval = float(os.getenv('LIVE_MAX_INTERVAL', '1800'))
+        self.idle_backoff = float(os.getenv('LIVE_IDLE_BACKOFF', '2'))
+        
+        # Periodic facts that come due together are generated in one request
+        self.batcher = FactBatcher(fact_generator)
+        
+        # Next periodic facts are generated ahead of time along the user's path
+        self.prefetcher = TrajectoryPrefetcher(fact_generator, self.min_distance_m)
+        
+        # One timer for all sessions: periodic facts and expiry
+        self.scheduler = SessionScheduler(self._process_session)
+        
+        # Write-behind persistence of sessions (no-op unless a backend is attached)
+        self.state = StateBackend()
+    
+    def start(self):
+        """Start the session scheduler"""
+        self.scheduler.start()
+    
+    async def stop(self, timeout: float = 0.0):
+        """Stop the session scheduler, letting in-progress facts finish within `timeout` seconds"""
+        await self.scheduler.stop(timeout)
+        await self.prefetcher.stop()
+    
+    def _schedule(self, session: LiveLocationSession, run_at: float):
+        """Schedule the next run, never past the end of the session"""
+        self.sessions.set_next_run(session, min(run_at, session.expires_at))
+        self.scheduler.schedule(session.key, session.next_run_at)
+        self.state.save_session(session)
     
-    def _get_session_key(self, chat_id: int, message_id: int) -> str:
-        """Generate unique session key"""
-        return f"{chat_id}_{message_id}"
+    def restore_sessions(self, sessions) -> int:
+        """Re-add sessions loaded from the state backend; returns the number restored"""
+        now = time.monotonic()
+        restored = 0
+        for session in sessions:
+            if session.expires_at <= now:
+                self.state.delete_session(session.key)
+                continue
+            self.sessions.add(session)
+            self._schedule(session, max(now, session.last_fact_at + session.interval))
+            restored += 1
+        if restored:
+            logger.info("Restored %s live location sessions", restored)
+        return restored
+    
+    def _distance_from_last_fact(self, session: LiveLocationSession) -> float:
+        """Distance in meters between the current position and the last fact's position"""
+        if session.fact_latitude is None:
+            return float('inf')
+        return haversine_m(session.fact_latitude, session.fact_longitude,
+                           session.latitude, session.longitude)
+    
+    def _target_interval(self, session: LiveLocationSession) -> float:
+        """Interval between facts for a moving user"""
+        if session.speed >= self.fast_speed_mps:
+            return self.min_interval
+        return self.update_interval
     
     async def start_live_session(self, chat_id: int, message_id: int, 
                                 latitude: float, longitude: float, live_period: int):
         """Start a new live location session"""
-        session_key = self._get_session_key(chat_id, message_id)
-        
         # Stop existing session if any
         await self.stop_live_session(chat_id, message_id)
         
@@ -44,134 +97,177 @@ class LiveLocationManager:
             latitude=latitude,
             longitude=longitude,
             live_period=live_period,
-            start_time=datetime.now(),
-            last_update=datetime.now()
+            # The handler sends the first fact for the starting position
+            fact_latitude=latitude,
+            fact_longitude=longitude,
+            last_fact_at=time.monotonic(),
+            interval=self.update_interval
         )
         
-        # Start periodic task
-        session.task = asyncio.create_task(
-            self._periodic_fact_sender(session)
-        )
+        self.sessions.add(session)
         
-        self.sessions[session_key] = session
+        # Schedule first periodic fact (or expiry, if the session is shorter)
+        self._schedule(session, time.monotonic() + self.update_interval)
         
-        logger.info(f"Started live location session for chat {chat_id}, "
-                   f"message {message_id}, live_period: {live_period}s")
+        logger.info("Started live location session for chat %s, "
+                   "message %s, live_period: %ss", chat_id, message_id, live_period)
         
         # Send initial message
-        await self.bot.send_message(
+        await self.sender.send_message(
             chat_id,
             f"🔄 Начал отслеживание вашего местоположения!\n"
-            f"Буду отправлять новые факты каждые 10 минут в течение {live_period // 60} минут."
+            f"Пока вы двигаетесь, буду присылать новые факты о местах по пути "
+            f"(примерно раз в {self.min_interval // 60:.0f}–{self.update_interval // 60:.0f} минут) "
+            f"в течение {live_period // 60} минут. Если вы остаётесь на месте, факты приходят реже."
         )
     
     async def update_live_session(self, chat_id: int, message_id: int, 
                                  latitude: float, longitude: float):
         """Update existing live location session with new coordinates"""
-        session_key = self._get_session_key(chat_id, message_id)
+        session = self.sessions.get(chat_id, message_id)
         
-        if session_key in self.sessions:
-            session = self.sessions[session_key]
+        if session is not None:
+            now = time.monotonic()
+            
+            # Estimate speed from consecutive updates
+            elapsed = now - session.last_update_at
+            if elapsed > 0:
+                speed = haversine_m(session.latitude, session.longitude, latitude, longitude) / elapsed
+                session.speed = 0.5 * session.speed + 0.5 * speed
+            
             session.latitude = latitude
             session.longitude = longitude
-            session.last_update = datetime.now()
+            session.last_update_at = now
+            
+            # Bring the next fact forward if the user started moving after an idle
+            # backoff, or is now moving fast
+            if self._distance_from_last_fact(session) >= self.min_distance_m:
+                session.interval = self._target_interval(session)
+                run_at = max(now, session.last_fact_at + session.interval)
+                if run_at < session.next_run_at:
+                    self._schedule(session, run_at)
+            self.state.save_session(session)
+            self.prefetcher.observe(session)
             
-            logger.info(f"Updated live location session for chat {chat_id}: "
-                       f"{latitude}, {longitude}")
+            logger.info("Updated live location session for chat %s: "
+                       "%s, %s", chat_id, latitude, longitude)
         else:
-            logger.warning(f"Attempted to update non-existent live session: {session_key}")
+            logger.warning("Attempted to update non-existent live session: %s, %s", chat_id, message_id)
     
-    async def stop_live_session(self, chat_id: int, message_id: int):
+    async def stop_live_session(self, chat_id: int, message_id: int, priority: Optional[int] = None):
         """Stop live location session"""
-        session_key = self._get_session_key(chat_id, message_id)
+        session = self.sessions.remove(chat_id, message_id)
         
-        if session_key in self.sessions:
-            session = self.sessions[session_key]
-            
-            # Cancel the periodic task
-            if session.task and not session.task.done():
-                session.task.cancel()
-                try:
-                    await session.task
-                except asyncio.CancelledError:
-                    pass
-            
-            # Remove session
-            del self.sessions[session_key]
+        if session is not None:
+            # Remove its pending timer
+            self.scheduler.cancel(session.key)
+            self.state.delete_session(session.key)
+            self.prefetcher.forget(session.key)
             
-            logger.info(f"Stopped live location session for chat {chat_id}")
+            logger.info("Stopped live location session for chat %s", chat_id)
             
             # Send stop message
-            await self.bot.send_message(
+            kwargs = {} if priority is None else {"priority": priority}
+            await self.sender.send_message(
                 chat_id,
-                "⏹️ Отслеживание местоположения завершено!"
+                "⏹️ Отслеживание местоположения завершено!",
+                **kwargs
             )
     
-    async def _periodic_fact_sender(self, session: LiveLocationSession):
-        """Periodically send facts for live location session"""
+    async def stop_chat_sessions(self, chat_id: int) -> int:
+        """Stop all live sessions of a chat; returns the number stopped"""
+        sessions = self.sessions.by_chat(chat_id)
+        for session in sessions:
+            await self.stop_live_session(session.chat_id, session.message_id)
+        return len(sessions)
+    
+    async def _expire_sessions(self):
+        """Stop every session whose live period is over"""
+        expired = self.sessions.expire()
+        # Clean up all of them before sending anything, so a failed message cannot skip the rest
+        for session in expired:
+            self.scheduler.cancel(session.key)
+            self.state.delete_session(session.key)
+            self.prefetcher.forget(session.key)
+            logger.info("Live session expired for chat %s", session.chat_id)
+        for session in expired:
+            try:
+                await self.sender.send_message(
+                    session.chat_id,
+                    "⏹️ Отслеживание местоположения завершено!",
+                    priority=PRIORITY_PERIODIC
+                )
+            except Exception as e:
+                logger.error("Error sending session end message to chat %s: %s", session.chat_id, e)
+    
+    async def _process_session(self, session_key: SessionKey) -> Optional[float]:
+        """Run a due session with its log records tagged by the session"""
+        with request_context(f"live-{session_key[0]}-{session_key[1]}"):
+            return await self._run_session(session_key)
+    
+    async def _run_session(self, session_key: SessionKey) -> Optional[float]:
+        """
+        Handle a due session: expire it or send a new fact.
+        Returns the monotonic time of the next run, or None if the session is over.
+        """
+        await self._expire_sessions()
+        
+        session = self.sessions.get(*session_key)
+        if session is None:
+            return None
+        
+        # Check if session is still valid
+        if time.monotonic() - session.last_update_at > session.live_period:
+            logger.info("Live session stopped - no updates for chat %s", session.chat_id)
+            await self.stop_live_session(session.chat_id, session.message_id, PRIORITY_PERIODIC)
+            return None
+        
+        # Skip the tick if the user has not moved, checking back less often
+        if self._distance_from_last_fact(session) < self.min_distance_m:
+            session.interval = min(max(session.interval, self.update_interval) * self.idle_backoff,
+                                   self.max_interval)
+            logger.info("Skipping periodic fact for chat %s: not moved, "
+                        "next check in %.0fs", session.chat_id, session.interval)
+            self._schedule(session, time.monotonic() + session.interval)
+            return session.next_run_at
+        
+        # Generate and send new fact
+        latitude, longitude = session.latitude, session.longitude
+        started = time.monotonic()
         try:
-            # Wait for first interval
-            await asyncio.sleep(self.update_interval)
+            await self.sender.send_chat_action(session.chat_id, "typing", priority=PRIORITY_PERIODIC)
+            
+            fact = await self.prefetcher.take(session_key, latitude, longitude)
+            if fact is None:
+                fact = await self.batcher.get_location_fact(latitude, longitude)
+            
+            # The session may have been stopped or replaced while generating
+            if self.sessions.get(*session_key) is not session:
+                return None
+            
+            await self.sender.send_message(
+                session.chat_id,
+                f"🌍 Новый факт о вашем текущем местоположении:\n\n{fact}",
+                priority=PRIORITY_PERIODIC
+            )
+            
+            session.fact_latitude = latitude
+            session.fact_longitude = longitude
+            
+            logger.info("Sent periodic fact to chat %s", session.chat_id,
+                        extra={"duration_ms": round((time.monotonic() - started) * 1000, 1)})
             
-            while True:
-                # Check if session is still valid
-                current_time = datetime.now()
-                session_duration = (current_time - session.start_time).total_seconds()
-                
-                if session_duration >= session.live_period:
-                    logger.info(f"Live session expired for chat {session.chat_id}")
-                    break
-                
-                # Check if location was updated recently
-                time_since_update = (current_time - session.last_update).total_seconds()
-                if time_since_update > session.live_period:
-                    logger.info(f"Live session stopped - no updates for chat {session.chat_id}")
-                    break
-                
-                # Generate and send new fact
-                try:
-                    await self.bot.send_chat_action(session.chat_id, "typing")
-                    
-                    fact = await self.fact_generator.get_location_fact(
-                        session.latitude, session.longitude
-                    )
-                    
-                    await self.bot.send_message(
-                        session.chat_id,
-                        f"🌍 Новый факт о вашем текущем местоположении:\n\n{fact}"
-                    )
-                    
-                    logger.info(f"Sent periodic fact to chat {session.chat_id}")
-                    
-                except Exception as e:
-                    logger.error(f"Error sending periodic fact: {e}")
-                
-                # Wait for next interval
-                await asyncio.sleep(self.update_interval)
-                
-        except asyncio.CancelledError:
-            logger.info(f"Periodic fact sender cancelled for chat {session.chat_id}")
         except Exception as e:
-            logger.error(f"Error in periodic fact sender: {e}")
-        finally:
-            # Clean up session
-            session_key = self._get_session_key(session.chat_id, session.message_id)
-            if session_key in self.sessions:
-                del self.sessions[session_key]
-    
-    async def cleanup_expired_sessions(self):
-        """Clean up expired sessions"""
-        current_time = datetime.now()
-        expired_sessions = []
-        
-        for session_key, session in self.sessions.items():
-            session_duration = (current_time - session.start_time).total_seconds()
-            if session_duration >= session.live_period:
-                expired_sessions.append(session_key)
-        
-        for session_key in expired_sessions:
-            session = self.sessions[session_key]
-            await self.stop_live_session(session.chat_id, session.message_id)
+            logger.error("Error sending periodic fact: %s", e)
+        
+        if self.sessions.get(*session_key) is not session:
+            return None
+        
+        # Next fact, or expiry if the session ends first
+        session.last_fact_at = time.monotonic()
+        session.interval = self._target_interval(session)
+        self._schedule(session, session.last_fact_at + session.interval)
+        return session.next_run_at
     
     def get_active_sessions_count(self) -> int:
         """Get number of active live sessions"""
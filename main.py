@@ -1,24 +1,45 @@
+import time
+# Cold start is measured from here: imports, construction and startup
+STARTED_AT = time.monotonic()
 import asyncio
 import logging
 import os
 import sys
+from typing import Callable, Dict, Optional
 from dotenv import load_dotenv
-from aiogram import Bot, Dispatcher, types, F
+from aiogram import Bot, Dispatcher, Router, F
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.filters import Command
-from aiogram.types import Message
+from aiogram.types import Message, Update
+from admission import SUPERSEDED, AdmissionController
 from ai_client import UnifiedFactGenerator
 from live_location_manager import LiveLocationManager
+from metrics import (HANDLER_STAGE_LATENCY, REGISTRY, SCHEDULER_LAG, STARTUP_SECONDS, TELEGRAM_API_LATENCY,
+                     UPSTREAM_LATENCY, MetricsServer)
+from persistence import create_state_backend
+from rate_limiter import scale_rate_limiters
+from sharding import HashRing, ShardingDispatcher, consume_updates, ignore_shutdown_signals, start_workers
+from structured_logging import request_context, setup_logging
+from telegram_sender import OutboundSender
+from webhook_server import WebhookServer
 
 # Load environment variables
 load_dotenv()
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
 logger = logging.getLogger(__name__)
 
+# "polling" or "webhook"
+BOT_MODE = os.getenv('BOT_MODE', 'polling').lower()
+# Seconds to let in-flight updates and live-session facts finish on shutdown
+SHUTDOWN_DRAIN_TIMEOUT = float(os.getenv('SHUTDOWN_DRAIN_TIMEOUT', '10'))
+# Worker processes sharing live sessions by chat_id; 1 runs everything in this process
+SHARD_WORKERS = int(os.getenv('SHARD_WORKERS', '1'))
+# Seconds from process start to serving updates before a warning is logged
+STARTUP_TARGET_SECONDS = float(os.getenv('STARTUP_TARGET_SECONDS', '5'))
+# Seconds startup waits for provider and Bot API connections to be warmed up
+STARTUP_PREWARM_TIMEOUT = float(os.getenv('STARTUP_PREWARM_TIMEOUT', '5'))
+
 # Validate environment variables
 def validate_environment():
     """Validate that all required environment variables are set"""
@@ -38,75 +59,326 @@ def validate_environment():
         logger.error("In Railway: Go to your project → Variables tab → Add OPENAI_API_KEY or OPENROUTER_API_KEY")
         sys.exit(1)
     
+    if BOT_MODE == 'webhook' and not os.getenv('WEBHOOK_URL'):
+        logger.error("❌ BOT_MODE=webhook requires WEBHOOK_URL (public HTTPS base URL of the bot)")
+        sys.exit(1)
+    
     logger.info("✅ Environment variables validated successfully")
     return telegram_token
 
-# Validate environment before initializing bot
-telegram_token = validate_environment()
+def create_bot(telegram_token: str) -> Bot:
+    """Bot API client; TELEGRAM_API_URL selects a local Bot API server (or a benchmark stand-in)"""
+    telegram_api_url = os.getenv('TELEGRAM_API_URL')
+    return Bot(
+        token=telegram_token,
+        session=AiohttpSession(api=TelegramAPIServer.from_base(telegram_api_url)) if telegram_api_url else None
+    )
+
+class BotApp:
+    """
+    One bot process: the Bot API client, the dispatcher and the long-lived services.
+    Construction only configures objects; connections, background tasks and
+    restored state are handled by startup() and shutdown().
+    """
+    def __init__(self, telegram_token: str):
+        created = time.monotonic()
+        self.bot = create_bot(telegram_token)
+        # Handlers receive this object as their `app` argument
+        self.dp = Dispatcher(app=self)
+        self.dp.update.outer_middleware(log_update)
+        self.dp.include_router(create_router())
+        
+        # All outgoing messages go through a rate-limited queue
+        self.sender = OutboundSender(self.bot)
+        
+        # Initialize fact generator and live location manager
+        self.fact_generator = UnifiedFactGenerator()
+        self.live_location_manager = LiveLocationManager(self.fact_generator, self.sender)
+        
+        # Bounded concurrency, per-chat debouncing and deadlines for location requests
+        self.admission = AdmissionController()
+        
+        # Sessions and cached facts survive restarts
+        self.state = create_state_backend()
+        
+        # Prometheus metrics on a local port (METRICS_PORT, 0 disables)
+        self.metrics_server = MetricsServer()
+        
+        # Telegram user ids allowed to use /stats
+        self.admin_ids = {int(user_id) for user_id in os.getenv('ADMIN_CHAT_IDS', '').replace(' ', '').split(',') if user_id}
+        
+        self.log_handler = setup_logging()
+        self.startup_phases: Dict[str, float] = {
+            "imports": created - STARTED_AT,
+            "create": time.monotonic() - created
+        }
+    
+    async def startup(self, owns_chat: Optional[Callable[[int], bool]] = None):
+        """Open connections, restore state and start the background services"""
+        started = time.monotonic()
+        
+        # Start the outbound message queue
+        self.sender.start()
+        
+        # Connection warm-up and state loading are independent, so they overlap
+        await asyncio.gather(self._prewarm(), self._restore_state(owns_chat))
+        
+        # Start the live session scheduler (periodic facts and expiry)
+        self.live_location_manager.start()
+        
+        self.register_metrics()
+        await self.metrics_server.start()
+        
+        self.startup_phases["startup"] = time.monotonic() - started
+        self._report_startup()
+    
+    async def _prewarm(self):
+        """Open provider pools and connect to the providers and the Bot API ahead of the first update"""
+        await self.fact_generator.start()
+        prewarm = asyncio.gather(self.fact_generator.prewarm(), self.bot.get_me(), return_exceptions=True)
+        try:
+            results = await asyncio.wait_for(prewarm, STARTUP_PREWARM_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning("Connection warm-up did not finish in %.1fs", STARTUP_PREWARM_TIMEOUT)
+            return
+        if isinstance(results[1], Exception):
+            logger.warning("Bot API warm-up failed: %s", results[1])
+    
+    async def _restore_state(self, owns_chat: Optional[Callable[[int], bool]]):
+        """Restore state from the previous run, then persist changes in the background"""
+        await self.state.open()
+        facts, sessions = await asyncio.gather(self.state.load_facts(), self.state.load_sessions())
+        self.fact_generator.cache.load(facts)
+        self.fact_generator.cache.on_store = self.state.save_fact
+        self.live_location_manager.state = self.state
+        if owns_chat is not None:
+            sessions = [session for session in sessions if owns_chat(session.chat_id)]
+        self.live_location_manager.restore_sessions(sessions)
+        self.state.start()
+    
+    def _report_startup(self):
+        for phase, seconds in self.startup_phases.items():
+            STARTUP_SECONDS.set(seconds, phase=phase)
+        total = sum(self.startup_phases.values())
+        logger.info("Started in %.2fs", total, extra={
+            "startup_ms": {phase: round(seconds * 1000, 1) for phase, seconds in self.startup_phases.items()}
+        })
+        if total > STARTUP_TARGET_SECONDS:
+            logger.warning("Startup took %.2fs, over the %.1fs target", total, STARTUP_TARGET_SECONDS)
+    
+    async def shutdown(self):
+        """Let live-session work finish, then flush state and queued messages and close connections"""
+        # Stop the live session scheduler
+        await self.live_location_manager.stop(SHUTDOWN_DRAIN_TIMEOUT)
+        
+        # Write out pending session and fact changes
+        await self.state.close()
+        
+        # Flush queued messages before closing the bot session
+        await self.sender.stop()
+        
+        await self.fact_generator.close()
+        await self.metrics_server.stop()
+        await self.bot.session.close()
+    
+    def register_metrics(self):
+        """Expose counters the components already keep"""
+        cache = self.fact_generator.cache
+        REGISTRY.callback("bot_live_sessions", "Active live location sessions", "gauge",
+                          self.live_location_manager.get_active_sessions_count)
+        REGISTRY.callback("bot_scheduler_pending", "Live sessions waiting for their next run", "gauge",
+                          self.live_location_manager.scheduler.pending)
+        REGISTRY.callback("bot_fact_cache_requests_total", "Fact cache lookups", "counter",
+                          lambda: [(("hit",), cache.hits), (("miss",), cache.misses)], ("result",))
+        REGISTRY.callback("bot_fact_cache_entries", "Facts held in the cache", "gauge", lambda: cache.size)
+        REGISTRY.callback("bot_telegram_queue_size", "Telegram calls waiting in the outbound queue", "gauge",
+                          self.sender.queue_size)
+        REGISTRY.callback("bot_telegram_retries_total", "Telegram calls retried after flood control", "counter",
+                          lambda: self.sender.retried)
+        REGISTRY.callback("bot_telegram_coalesced_actions_total", "Chat actions skipped as duplicates", "counter",
+                          lambda: self.sender.coalesced_actions)
+        REGISTRY.callback("bot_prefetch_total", "Trajectory prefetch outcomes", "counter",
+                          lambda: [((name,), value) for name, value in self.live_location_manager.prefetcher.stats().items()],
+                          ("result",))
+        REGISTRY.callback("bot_admission_active", "Location requests holding an admission slot", "gauge",
+                          lambda: self.admission.active)
+        REGISTRY.callback("bot_admission_waiting", "Location requests waiting for an admission slot", "gauge",
+                          self.admission.queue_size)
+        REGISTRY.callback("bot_log_records_dropped_total", "Log records dropped because the writer fell behind",
+                          "counter", lambda: self.log_handler.dropped)
+        REGISTRY.callback("bot_provider_available", "1 if the provider's circuit breaker lets requests through", "gauge",
+                          lambda: [((name,), 1 if name in self.fact_generator.router.order() else 0)
+                                   for name in self.fact_generator.router.providers], ("provider",))
+        REGISTRY.callback("bot_fact_max_tokens", "Current max_tokens requested per fact", "gauge",
+                          lambda: [((name,), stats["max_tokens"]) for name, stats in self.fact_generator.token_stats().items()],
+                          ("provider",))
+        REGISTRY.callback("bot_fact_truncated_total", "Completions that used the whole max_tokens", "counter",
+                          lambda: [((name,), stats["truncated"]) for name, stats in self.fact_generator.token_stats().items()],
+                          ("provider",))
+    
+    def stats_text(self) -> str:
+        """Summary of the main latency and cache metrics for /stats"""
+        cache = self.fact_generator.cache
+        lookups = cache.hits + cache.misses
+        admission_stats = self.admission.stats()
+        lines = [
+            "📊 Статистика бота",
+            f"Live-сессий: {self.live_location_manager.get_active_sessions_count()}",
+            f"Кэш фактов: {cache.size} фактов, попаданий {cache.hits}/{lookups}",
+            f"Очередь Telegram: {self.sender.queue_size()}, отправлено {self.sender.sent}",
+            f"Задержка планировщика p99: {format_seconds(SCHEDULER_LAG.quantile(0.99))}",
+            f"Запросы локаций: выполняется {admission_stats['active']}, в очереди {admission_stats['waiting']}, "
+            f"отклонено {admission_stats['rejected']:.0f}, просрочено {admission_stats['expired']:.0f}, "
+            f"заменено новыми {admission_stats['superseded']:.0f}",
+            "",
+            "Провайдеры (p50 / p99, запросов):",
+        ]
+        for name in self.fact_generator.router.providers:
+            count = UPSTREAM_LATENCY.count(provider=name, outcome="ok")
+            errors = UPSTREAM_LATENCY.count(provider=name, outcome="error")
+            lines.append(f"• {name}: {format_seconds(UPSTREAM_LATENCY.quantile(0.5, provider=name, outcome='ok'))} / "
+                         f"{format_seconds(UPSTREAM_LATENCY.quantile(0.99, provider=name, outcome='ok'))}, "
+                         f"{count} ок, {errors} ошибок")
+        lines.append("")
+        lines.append("Токены (промпт / ответ, на факт, max_tokens):")
+        for name, tokens in self.fact_generator.token_stats().items():
+            lines.append(f"• {name}: {tokens['prompt_tokens']} / {tokens['completion_tokens']}, "
+                         f"{tokens['tokens_per_fact']}, {tokens['max_tokens']}")
+        lines.append("")
+        lines.append("Этапы обработки локации (p50 / p99):")
+        for stage in ("admission", "placeholder", "first_chunk", "fact", "send", "total"):
+            if HANDLER_STAGE_LATENCY.count(stage=stage):
+                lines.append(f"• {stage}: {format_seconds(HANDLER_STAGE_LATENCY.quantile(0.5, stage=stage))} / "
+                             f"{format_seconds(HANDLER_STAGE_LATENCY.quantile(0.99, stage=stage))}")
+        lines.append(f"Telegram API p99: "
+                     f"{format_seconds(TELEGRAM_API_LATENCY.quantile(0.99, priority='interactive', outcome='ok'))}")
+        return "\n".join(lines)
+
+def create_app() -> BotApp:
+    """Validate the environment and build the application; nothing is started yet"""
+    setup_logging()
+    return BotApp(validate_environment())
 
-# Initialize bot and dispatcher
-bot = Bot(token=telegram_token)
-dp = Dispatcher()
+def format_seconds(value) -> str:
+    return "—" if value is None else f"{value:.2f}s"
 
-# Initialize fact generator and live location manager
-fact_generator = UnifiedFactGenerator()
-live_location_manager = LiveLocationManager(fact_generator, bot)
+async def log_update(handler, update: Update, data: dict):
+    """Tag log records with the update id and log how long handling took"""
+    started = time.monotonic()
+    with request_context(f"update-{update.update_id}"):
+        try:
+            return await handler(update, data)
+        finally:
+            logger.info("Update handled", extra={
+                "update_type": update.event_type,
+                "duration_ms": round((time.monotonic() - started) * 1000, 1)
+            })
 
-@dp.message(Command("start"))
-async def cmd_start(message: Message):
+async def cmd_start(message: Message, app: "BotApp"):
     """Handle /start command"""
-    await message.answer(
+    await app.sender.send_message(
+        message.chat.id,
         "Привет! 👋 Я бот, который расскажет интересные факты о местах рядом с вами.\n\n"
         "🔹 **Статическая локация**: Отправьте геолокацию и получите интересный факт\n"
-        "🔹 **Live Location**: Поделитесь live-локацией и получайте новые факты каждые 10 минут!\n\n"
+        "🔹 **Live Location**: Поделитесь live-локацией и получайте новые факты по мере движения!\n\n"
         "📍 Чтобы отправить локацию, нажмите на скрепку и выберите 'Геопозиция'."
     )
 
-@dp.message(Command("ping"))
-async def cmd_ping(message: Message):
+async def cmd_ping(message: Message, app: "BotApp"):
     """Handle /ping command for testing"""
-    active_sessions = live_location_manager.get_active_sessions_count()
-    await message.answer(f"Pong! 🏓 Бот работает!\nАктивных live-сессий: {active_sessions}")
+    active_sessions = app.live_location_manager.get_active_sessions_count()
+    await app.sender.send_message(message.chat.id, f"Pong! 🏓 Бот работает!\nАктивных live-сессий: {active_sessions}")
+
+def is_admin(message: Message, app: "BotApp") -> bool:
+    return message.from_user is not None and message.from_user.id in app.admin_ids
+
+async def cmd_stats(message: Message, app: "BotApp"):
+    """Handle /stats admin command with latency and cache metrics"""
+    await app.sender.send_message(message.chat.id, app.stats_text())
 
-@dp.message(Command("stop"))
-async def cmd_stop(message: Message):
+async def cmd_stop(message: Message, app: "BotApp"):
     """Handle /stop command to stop live location tracking"""
-    # Try to stop any active live sessions for this chat
-    # Since we don't have message_id here, we'll need to iterate through sessions
-    stopped_sessions = 0
-    sessions_to_stop = []
-    
-    for session_key, session in live_location_manager.sessions.items():
-        if session.chat_id == message.chat.id:
-            sessions_to_stop.append((session.chat_id, session.message_id))
-    
-    for chat_id, message_id in sessions_to_stop:
-        await live_location_manager.stop_live_session(chat_id, message_id)
-        stopped_sessions += 1
+    stopped_sessions = await app.live_location_manager.stop_chat_sessions(message.chat.id)
     
     if stopped_sessions > 0:
-        await message.answer(f"⏹️ Остановлено {stopped_sessions} активных сессий отслеживания.")
+        await app.sender.send_message(message.chat.id, f"⏹️ Остановлено {stopped_sessions} активных сессий отслеживания.")
     else:
-        await message.answer("Нет активных сессий для остановки.")
+        await app.sender.send_message(message.chat.id, "Нет активных сессий для остановки.")
+
+# Stream facts into a placeholder message that is edited as text arrives
+FACT_STREAMING = os.getenv('FACT_STREAMING', '1') == '1'
+# Minimum seconds between edits of the same message (Telegram limits edit rate)
+STREAM_EDIT_INTERVAL = float(os.getenv('FACT_STREAM_EDIT_INTERVAL', '1.0'))
+
+BUSY_MESSAGE = ("⏳ Сейчас очень много запросов, и я не успеваю подготовить факт. "
+                "Пожалуйста, отправьте локацию ещё раз через минуту.")
 
-@dp.message(F.location)
-async def handle_location(message: Message):
+async def send_streamed_fact(app: "BotApp", message: Message, header: str, latitude: float, longitude: float,
+                             timeout: float, degraded: Callable[[], str]):
+    """
+    Send a placeholder and progressively edit it with the streamed fact.
+    If the fact is not ready within `timeout` seconds the placeholder gets the degraded reply.
+    """
+    with HANDLER_STAGE_LATENCY.time(stage="placeholder"):
+        placeholder = await app.sender.send_message(message.chat.id, f"{header}⏳")
+    
+    loop = asyncio.get_running_loop()
+    started = time.monotonic()
+    
+    async def stream() -> str:
+        text = ""
+        shown = ""
+        last_edit = 0.0
+        async for chunk in app.fact_generator.stream_location_fact(latitude, longitude):
+            if not text:
+                HANDLER_STAGE_LATENCY.observe(time.monotonic() - started, stage="first_chunk")
+            text += chunk
+            now = loop.time()
+            if now - last_edit >= STREAM_EDIT_INTERVAL and text.strip() != shown:
+                shown = text.strip()
+                last_edit = now
+                await app.sender.edit_message_text(placeholder.chat.id, placeholder.message_id, f"{header}{shown} ⏳")
+        
+        # Nothing streamed: fall back to a regular request (cached, coalesced, hedged)
+        if not text.strip():
+            text = await app.fact_generator.get_location_fact(latitude, longitude)
+        return text
+    
+    try:
+        text = f"{header}{(await asyncio.wait_for(stream(), timeout)).strip()}"
+    except asyncio.TimeoutError:
+        logger.warning("Fact for chat %s not ready in %.1fs, sending degraded reply", message.chat.id, timeout)
+        text = degraded()
+    HANDLER_STAGE_LATENCY.observe(time.monotonic() - started, stage="fact")
+    
+    with HANDLER_STAGE_LATENCY.time(stage="send"):
+        await app.sender.edit_message_text(placeholder.chat.id, placeholder.message_id, text)
+
+def degraded_text(app: "BotApp", location_type: str, latitude: float, longitude: float) -> str:
+    """Reply for an overloaded bot: a cached fact about somewhere nearby, or a busy notice"""
+    fact = app.fact_generator.nearby_fact(latitude, longitude)
+    if fact is None:
+        return BUSY_MESSAGE
+    return f"{location_type} получена!\n\n🌍 Сейчас много запросов, поэтому вот факт о месте неподалёку:\n\n{fact}"
+
+async def handle_location(message: Message, app: "BotApp"):
     """Handle location messages (both static and live)"""
+    started = time.monotonic()
     try:
         location = message.location
         latitude = location.latitude
         longitude = location.longitude
         live_period = location.live_period if hasattr(location, 'live_period') and location.live_period else None
         
-        logger.info(f"Received location from user {message.from_user.id}: "
-                   f"{latitude}, {longitude}, live_period: {live_period}")
+        logger.info("Received location from user %s: "
+                   "%s, %s, live_period: %s", message.from_user.id, latitude, longitude, live_period)
         
         # Send "typing" action to show bot is working
-        await bot.send_chat_action(message.chat.id, "typing")
+        await app.sender.send_chat_action(message.chat.id, "typing")
         
         # Handle live location
         if live_period and live_period > 0:
-            await live_location_manager.start_live_session(
+            await app.live_location_manager.start_live_session(
                 chat_id=message.chat.id,
                 message_id=message.message_id,
                 latitude=latitude,
@@ -114,31 +386,66 @@ async def handle_location(message: Message):
                 live_period=live_period
             )
         
+        location_type = "🔄 Live-локация" if live_period else "📍 Локация"
+        header = f"{location_type} получена!\n\n🌍 Интересный факт о месте рядом с вами:\n\n"
+        degraded = lambda: degraded_text(app, location_type, latitude, longitude)
+        
+        # Cached facts need no upstream request, so they skip admission.
+        # Misses are counted once, by the lookup in the fact generator.
+        if app.fact_generator.has_cached_fact(latitude, longitude):
+            cached = app.fact_generator.cached_fact(latitude, longitude)
+            with HANDLER_STAGE_LATENCY.time(stage="send"):
+                await app.sender.send_message(message.chat.id, f"{header}{cached}")
+            HANDLER_STAGE_LATENCY.observe(time.monotonic() - started, stage="total")
+            return
+        
+        with HANDLER_STAGE_LATENCY.time(stage="admission"):
+            ticket = await app.admission.acquire(message.chat.id)
+        if ticket.outcome == SUPERSEDED:
+            # The chat sent a newer location, which gets the answer instead
+            return
+        if not ticket.admitted:
+            await app.sender.send_message(message.chat.id, degraded())
+            return
+        
         # Get and send fact for current location
-        fact = await fact_generator.get_location_fact(latitude, longitude)
+        try:
+            if FACT_STREAMING:
+                await send_streamed_fact(app, message, header, latitude, longitude, ticket.remaining(), degraded)
+            else:
+                try:
+                    with HANDLER_STAGE_LATENCY.time(stage="fact"):
+                        fact = await asyncio.wait_for(app.fact_generator.get_location_fact(latitude, longitude),
+                                                      ticket.remaining())
+                    text = f"{header}{fact}"
+                except asyncio.TimeoutError:
+                    text = degraded()
+                with HANDLER_STAGE_LATENCY.time(stage="send"):
+                    await app.sender.send_message(message.chat.id, text)
+        finally:
+            app.admission.release(ticket)
         
-        location_type = "🔄 Live-локация" if live_period else "📍 Локация"
-        await message.answer(f"{location_type} получена!\n\n🌍 Интересный факт о месте рядом с вами:\n\n{fact}")
+        HANDLER_STAGE_LATENCY.observe(time.monotonic() - started, stage="total")
         
     except Exception as e:
-        logger.error(f"Error handling location: {e}")
-        await message.answer(
+        logger.error("Error handling location: %s", e)
+        await app.sender.send_message(
+        message.chat.id,
             "Произошла ошибка при обработке вашей локации. Попробуйте ещё раз."
         )
 
-@dp.edited_message(F.location)
-async def handle_edited_location(message: Message):
+async def handle_edited_location(message: Message, app: "BotApp"):
     """Handle edited location messages (live location updates)"""
     try:
         location = message.location
         latitude = location.latitude
         longitude = location.longitude
         
-        logger.info(f"Received location update from user {message.from_user.id}: "
-                   f"{latitude}, {longitude}")
+        logger.info("Received location update from user %s: "
+                   "%s, %s", message.from_user.id, latitude, longitude)
         
         # Update live location session
-        await live_location_manager.update_live_session(
+        await app.live_location_manager.update_live_session(
             chat_id=message.chat.id,
             message_id=message.message_id,
             latitude=latitude,
@@ -146,12 +453,12 @@ async def handle_edited_location(message: Message):
         )
         
     except Exception as e:
-        logger.error(f"Error handling edited location: {e}")
+        logger.error("Error handling edited location: %s", e)
 
-@dp.message()
-async def handle_other_messages(message: Message):
+async def handle_other_messages(message: Message, app: "BotApp"):
     """Handle other messages"""
-    await message.answer(
+    await app.sender.send_message(
+        message.chat.id,
         "Я умею работать только с геолокацией! 📍\n\n"
         "Отправьте мне свою геолокацию, чтобы получить интересный факт о месте рядом с вами.\n\n"
         "Команды:\n"
@@ -160,35 +467,117 @@ async def handle_other_messages(message: Message):
         "/stop - Остановить отслеживание"
     )
 
-async def periodic_cleanup():
-    """Periodic cleanup of expired sessions"""
-    while True:
-        try:
-            await asyncio.sleep(300)  # Run every 5 minutes
-            await live_location_manager.cleanup_expired_sessions()
-        except Exception as e:
-            logger.error(f"Error in periodic cleanup: {e}")
+def create_router() -> Router:
+    """Register the bot's handlers on a new router"""
+    router = Router()
+    router.message.register(cmd_start, Command("start"))
+    router.message.register(cmd_ping, Command("ping"))
+    router.message.register(cmd_stats, Command("stats"), is_admin)
+    router.message.register(cmd_stop, Command("stop"))
+    router.message.register(handle_location, F.location)
+    router.edited_message.register(handle_edited_location, F.location)
+    router.message.register(handle_other_messages)
+    return router
+
+async def receive_updates(bot: Bot, dispatcher: Dispatcher, health_info: Callable[[], dict]):
+    """Receive updates by polling or webhook until shutdown is requested"""
+    if BOT_MODE != 'webhook':
+        # Polling fails while a webhook is registered
+        await bot.delete_webhook()
+        await dispatcher.start_polling(bot, close_bot_session=False)
+        return
+    
+    webhook_server = WebhookServer(bot, dispatcher, health_info=health_info)
+    try:
+        await webhook_server.start()
+        await webhook_server.serve()
+    finally:
+        # Stop taking updates and let handlers that are already running finish
+        await webhook_server.stop(SHUTDOWN_DRAIN_TIMEOUT)
+        await webhook_server.cleanup()
 
 async def main():
     """Main function to start the bot"""
     logger.info("Starting Location Facts Bot v1.1...")
     
-    # Start periodic cleanup task
-    cleanup_task = asyncio.create_task(periodic_cleanup())
+    app = create_app()
+    await app.startup()
+    try:
+        await receive_updates(app.bot, app.dp, lambda: {
+            "active_sessions": app.live_location_manager.get_active_sessions_count(),
+            "outbound_queue": app.sender.queue_size()
+        })
+    except Exception as e:
+        logger.error("Error occurred: %s", e)
+    finally:
+        await app.shutdown()
+
+async def shard_worker_main(index: int, count: int, update_queue):
+    """Worker process: handle the updates and live sessions of one shard"""
+    ring = HashRing(count)
+    app = create_app()
     
+    # Each process serves its own metrics on the next port
+    if app.metrics_server.enabled:
+        app.metrics_server.port += index + 1
+    
+    # Bot-wide and per-key API limits are shared by all workers
+    app.sender.scale_global_rate(1 / count)
+    scale_rate_limiters(1 / count)
+    
+    await app.startup(owns_chat=lambda chat_id: ring.shard_for(chat_id) == index)
+    logger.info("Shard worker %s/%s ready", index, count)
     try:
-        await dp.start_polling(bot)
+        await consume_updates(update_queue, app.dp, app.bot, SHUTDOWN_DRAIN_TIMEOUT)
+    finally:
+        await app.shutdown()
+
+def run_shard_worker(index: int, count: int, update_queue):
+    ignore_shutdown_signals()
+    asyncio.run(shard_worker_main(index, count, update_queue))
+
+async def front_main(queues, telegram_token: str):
+    """Front process: receive updates and route them to shard workers by chat_id"""
+    # Only the Bot API client is needed here; handlers and services live in the workers
+    bot = create_bot(telegram_token)
+    workers_dp = Dispatcher()
+    workers_dp.include_router(create_router())
+    front_dp = ShardingDispatcher(queues, workers_dp)
+    metrics_server = MetricsServer()
+    REGISTRY.callback("bot_shard_forwarded_total", "Updates forwarded to each shard worker", "counter",
+                      lambda: [((str(shard),), count) for shard, count in enumerate(front_dp.forwarded)], ("shard",))
+    await metrics_server.start()
+    try:
+        await receive_updates(bot, front_dp, lambda: {
+            "shard_workers": len(queues),
+            "forwarded": front_dp.forwarded
+        })
     except Exception as e:
-        logger.error(f"Error occurred: {e}")
+        logger.error("Error occurred: %s", e)
     finally:
-        # Cancel cleanup task
-        cleanup_task.cancel()
-        try:
-            await cleanup_task
-        except asyncio.CancelledError:
-            pass
-        
+        front_dp.close()
+        await metrics_server.stop()
         await bot.session.close()
 
+def run_sharded(count: int):
+    """Run a front process and `count` shard worker processes"""
+    telegram_token = validate_environment()
+    logger.info("Starting Location Facts Bot v1.1 with %s shard workers...", count)
+    processes, queues = start_workers(count, run_shard_worker)
+    try:
+        asyncio.run(front_main(queues, telegram_token))
+    finally:
+        for process in processes:
+            # Workers drain their updates and live sessions before exiting
+            process.join(SHUTDOWN_DRAIN_TIMEOUT * 2 + 5)
+            if process.is_alive():
+                logger.warning("Terminating %s", process.name)
+                process.terminate()
+
 if __name__ == "__main__":
-    asyncio.run(main()) 
\ No newline at end of file
+    # Configure logging: JSON records written by a background thread, off the event loop
+    setup_logging()
+    if SHARD_WORKERS > 1:
+        run_sharded(SHARD_WORKERS)
+    else:
+        asyncio.run(main())
@@ -0,0 +1,259 @@
+import bisect
+import logging
+import os
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+# Seconds; covers cache hits (~ms) up to slow LLM completions
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60)
+
+LabelValues = Tuple[str, ...]
+
+
+def escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help_text: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        return tuple(str(labels.get(name, "")) for name in self.labels)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self._samples())
+        return lines
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    """Monotonically increasing value per label set"""
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, labels: Sequence[str] = ()):
+        super().__init__(name, help_text, labels)
+        self.values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0.0) + amount
+
+    def get(self, **labels) -> float:
+        return self.values.get(self._key(labels), 0.0)
+
+    def _samples(self) -> List[str]:
+        return [f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}"
+                for key, value in self.values.items()]
+
+
+class Gauge(Counter):
+    """Value that can go up and down"""
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        self.values[self._key(labels)] = value
+
+
+class CallbackMetric(_Metric):
+    """
+    Counter or gauge read from existing state at scrape time, so hot paths
+    that already keep a count do not have to update a second one.
+    `callback` returns a number, or (label values, number) pairs.
+    """
+    def __init__(self, name: str, help_text: str, kind: str,
+                 callback: Callable[[], object], labels: Sequence[str] = ()):
+        super().__init__(name, help_text, labels)
+        self.kind = kind
+        self.callback = callback
+
+    def collect(self) -> Iterable[Tuple[LabelValues, float]]:
+        value = self.callback()
+        if isinstance(value, (int, float)):
+            return [((), value)]
+        return value
+
+    def _samples(self) -> List[str]:
+        try:
+            samples = list(self.collect())
+        except Exception as e:
+            logger.warning("Failed to collect %s: %s", self.name, e)
+            return []
+        return [f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}"
+                for key, value in samples]
+
+
+class Histogram(_Metric):
+    """Cumulative-bucket histogram per label set"""
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(buckets)
+        # label values -> [per-bucket counts (+Inf last), sum, count]
+        self.values: Dict[LabelValues, list] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        entry = self.values.get(key)
+        if entry is None:
+            entry = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the duration of a with-block"""
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - started, **labels)
+
+    def count(self, **labels) -> int:
+        entry = self.values.get(self._key(labels))
+        return entry[2] if entry else 0
+
+    def quantile(self, q: float, **labels) -> Optional[float]:
+        """Estimate a quantile by linear interpolation within the bucket that contains it"""
+        entry = self.values.get(self._key(labels))
+        if not entry or not entry[2]:
+            return None
+        rank = q * entry[2]
+        seen = 0
+        lower = 0.0
+        for index, bucket_count in enumerate(entry[0]):
+            upper = self.buckets[index] if index < len(self.buckets) else lower
+            if seen + bucket_count >= rank and bucket_count:
+                return lower + (upper - lower) * (rank - seen) / bucket_count
+            seen += bucket_count
+            lower = upper
+        return lower
+
+    def _samples(self) -> List[str]:
+        lines = []
+        for key, (counts, total, count) in self.values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: Dict[str, _Metric] = {}
+
+    def register(self, metric: _Metric) -> _Metric:
+        # Re-registering replaces the old metric (callbacks bound to new objects)
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help_text: str, labels: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, help_text, labels))
+
+    def gauge(self, name: str, help_text: str, labels: Sequence[str] = ()) -> Gauge:
+        return self.register(Gauge(name, help_text, labels))
+
+    def histogram(self, name: str, help_text: str, labels: Sequence[str] = (),
+                  buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help_text, labels, buckets))
+
+    def callback(self, name: str, help_text: str, kind: str, callback: Callable[[], object],
+                 labels: Sequence[str] = ()) -> CallbackMetric:
+        return self.register(CallbackMetric(name, help_text, kind, callback, labels))
+
+    def render(self) -> str:
+        """Prometheus text exposition format"""
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+UPSTREAM_LATENCY = REGISTRY.histogram(
+    "bot_upstream_request_seconds", "LLM provider request latency", ("provider", "outcome"))
+UPSTREAM_TOKENS = REGISTRY.counter(
+    "bot_upstream_tokens_total", "Tokens reported by LLM providers", ("provider", "kind"))
+FALLBACKS = REGISTRY.counter(
+    "bot_provider_fallbacks_total", "Requests retried on the next provider after a failure", ("provider",))
+HEDGES = REGISTRY.counter(
+    "bot_hedged_requests_total", "Secondary provider requests started by hedging", ("provider",))
+HEDGE_WINS = REGISTRY.counter(
+    "bot_hedge_wins_total", "Hedged requests answered first, by provider", ("provider",))
+RATE_LIMIT_WAIT = REGISTRY.histogram(
+    "bot_rate_limiter_wait_seconds", "Time spent waiting for provider rate budget", ("limiter",))
+TELEGRAM_QUEUE_LATENCY = REGISTRY.histogram(
+    "bot_telegram_queue_seconds", "Time Telegram calls wait in the outbound queue", ("priority",))
+TELEGRAM_API_LATENCY = REGISTRY.histogram(
+    "bot_telegram_api_seconds", "Telegram Bot API call latency", ("priority", "outcome"))
+HANDLER_STAGE_LATENCY = REGISTRY.histogram(
+    "bot_handler_stage_seconds", "Latency of location handler stages", ("stage",))
+ADMISSIONS = REGISTRY.counter(
+    "bot_admission_total", "Location requests by admission outcome", ("outcome",))
+SCHEDULER_LAG = REGISTRY.histogram(
+    "bot_scheduler_lag_seconds", "Delay between a live session's due time and its dispatch")
+STARTUP_SECONDS = REGISTRY.gauge(
+    "bot_startup_seconds", "Time spent in each startup phase of this process", ("phase",))
+
+
+class MetricsServer:
+    """Serves REGISTRY in Prometheus text format on a local HTTP port"""
+    def __init__(self, port: Optional[int] = None, host: Optional[str] = None):
+        self.port = port if port is not None else int(os.getenv('METRICS_PORT', '0'))
+        self.host = host or os.getenv('METRICS_HOST', '127.0.0.1')
+        self._runner: Optional[web.AppRunner] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.port > 0
+
+    async def _metrics(self, request: web.Request) -> web.Response:
+        return web.Response(text=REGISTRY.render(), content_type="text/plain", charset="utf-8")
+
+    async def start(self):
+        if not self.enabled:
+            return
+        app = web.Application()
+        app.router.add_get("/metrics", self._metrics)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        logger.info("Metrics available at http://%s:%s/metrics", self.host, self.port)
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
@@ -1,11 +1,14 @@
 import os
 import logging
 import sys
-import openai  # новый импорт
 import asyncio
 import time
+from typing import AsyncIterator, Optional
 
-from openai import RateLimitError, APIError
+from openai import AsyncOpenAI, RateLimitError, APIError
+from fact_result import UNPARSEABLE_BATCH, FactResult
+from prompts import TokenBudget, batch_messages, fact_messages, parse_batch_response
+from rate_limiter import estimate_text_tokens, estimate_tokens, get_rate_limiter, parse_retry_after
 
 logger = logging.getLogger(__name__)
 
@@ -18,61 +21,163 @@ class FactGenerator:
             logger.error("Please set OPENAI_API_KEY in your environment variables.")
             sys.exit(1)
         
-        openai.api_key = api_key  # задаём ключ глобально
-        self.last_request_time = 0
-        self.min_request_interval = 1  # Minimum 1 second between requests
+        # Native async client so requests never block the event loop.
+        # SDK retries are disabled: 429s are handled by the shared rate limiter
+        # and other failures by provider fallback.
+        # OPENAI_BASE_URL points the client at a compatible server (proxy, benchmark stand-in)
+        self.client = AsyncOpenAI(api_key=api_key, base_url=os.getenv('OPENAI_BASE_URL') or None,
+                                  timeout=30, max_retries=0)
         
-        logger.info("✅ OpenAI client initialized successfully")
-    
-    async def _rate_limit(self):
-        """Simple rate limiting to avoid hitting OpenAI limits"""
-        current_time = time.time()
-        time_since_last_request = current_time - self.last_request_time
+        # Shared requests/tokens per minute budget (OPENAI_RPM, OPENAI_TPM)
+        self.rate_limiter = get_rate_limiter('OPENAI')
+        # Token accounting and adaptive max_tokens (FACT_MAX_TOKENS is the ceiling)
+        self.tokens = TokenBudget()
         
-        if time_since_last_request < self.min_request_interval:
-            sleep_time = self.min_request_interval - time_since_last_request
-            await asyncio.sleep(sleep_time)
+        # Limit the number of requests in flight at the same time
+        self.max_concurrency = int(os.getenv('OPENAI_MAX_CONCURRENCY', '5'))
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
         
-        self.last_request_time = time.time()
+        logger.info("✅ OpenAI client initialized successfully")
+    
+    @property
+    def max_tokens(self) -> int:
+        """Completion limit for one fact"""
+        return self.tokens.max_tokens
     
     async def get_location_fact(self, latitude: float, longitude: float) -> str:
         """Get an interesting fact about a location using OpenAI GPT-4.1-mini"""
+        result = await self.generate_fact(latitude, longitude)
+        return result.text
+    
+    async def generate_fact(self, latitude: float, longitude: float, place: Optional[str] = None) -> FactResult:
+        """Request a fact and report the outcome as a FactResult"""
+        logger.info("Requesting fact for coordinates: %s, %s", latitude, longitude)
+        
+        return await self._complete(fact_messages(latitude, longitude, place), self.max_tokens)
+    
+    async def stream_fact(self, latitude: float, longitude: float, place: Optional[str] = None) -> AsyncIterator[str]:
+        """Stream a fact as text chunks; errors are raised to the caller"""
+        messages = fact_messages(latitude, longitude, place)
+        max_tokens = self.max_tokens
+        estimated_tokens = estimate_tokens(messages) + max_tokens
+        await self.rate_limiter.acquire(estimated_tokens)
+        
+        logger.info("Streaming fact for coordinates: %s, %s", latitude, longitude)
+        
+        parts = []
+        usage = None
+        finish_reason = None
+        async with self._semaphore:
+            try:
+                stream = await self.client.chat.completions.create(
+                    model="gpt-4-1106-preview",
+                    messages=messages,
+                    max_tokens=max_tokens,
+                    temperature=0.7,
+                    timeout=30,
+                    stream=True,
+                    # The last chunk then carries the usage (not a named argument in this SDK version)
+                    extra_body={"stream_options": {"include_usage": True}}
+                )
+                async for chunk in stream:
+                    usage = getattr(chunk, 'usage', None) or usage
+                    if chunk.choices and chunk.choices[0].finish_reason:
+                        finish_reason = chunk.choices[0].finish_reason
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        parts.append(chunk.choices[0].delta.content)
+                        yield chunk.choices[0].delta.content
+            except RateLimitError as e:
+                self.rate_limiter.retry_after(parse_retry_after(e.response.headers.get('retry-after')))
+                raise
+            finally:
+                if parts or usage:
+                    self._record_stream_usage(messages, estimated_tokens, max_tokens, "".join(parts), usage, finish_reason)
+    
+    def _record_stream_usage(self, messages, estimated_tokens: int, max_tokens: int, text: str, usage,
+                             finish_reason: Optional[str]):
+        """Account a streamed completion, estimating the usage if the provider did not report it"""
+        if isinstance(usage, dict):
+            prompt_tokens, completion_tokens = usage.get('prompt_tokens', 0), usage.get('completion_tokens', 0)
+        elif usage is not None:
+            prompt_tokens, completion_tokens = usage.prompt_tokens, usage.completion_tokens
+        else:
+            prompt_tokens, completion_tokens = estimate_tokens(messages), estimate_text_tokens(text)
+        self.rate_limiter.record_usage(estimated_tokens, prompt_tokens + completion_tokens)
+        self.tokens.record(prompt_tokens, completion_tokens, max_tokens,
+                           truncated=None if finish_reason is None else finish_reason == "length")
+    
+    async def generate_facts_batch(self, coordinates, places=None) -> FactResult:
+        """Request facts for several locations in one completion; parsed facts go to result.facts"""
+        messages = batch_messages(coordinates, places)
+        
+        logger.info("Requesting batch of %s facts", len(coordinates))
+        
+        result = await self._complete(messages, self.max_tokens * len(coordinates), len(coordinates))
+        if result.ok:
+            result.facts = parse_batch_response(result.fact, len(coordinates))
+            if result.facts is None:
+                result.error = UNPARSEABLE_BATCH
+        return result
+    
+    async def _complete(self, messages, max_tokens: int, facts: int = 1) -> FactResult:
+        """Run one chat completion and report the outcome as a FactResult"""
+        started = time.monotonic()
+        estimated_tokens = 0
         try:
-            await self._rate_limit()
+            estimated_tokens = estimate_tokens(messages) + max_tokens
+            await self.rate_limiter.acquire(estimated_tokens)
             
-            prompt = f"Ты экскурсовод. Дай 1 интересный факт о месте в пределах 1 км от координат {latitude}, {longitude}. Отвечай на русском языке, кратко и интересно."
-            
-            logger.info(f"Requesting fact for coordinates: {latitude}, {longitude}")
-            
-            response = openai.chat.completions.create(
-                model="gpt-4-1106-preview",
-                messages=[
-                    {"role": "system", "content": "Ты знающий экскурсовод, который знает интересные факты о местах по всему миру. Отвечай кратко, но интересно."},
-                    {"role": "user", "content": prompt}
-                ],
-                max_tokens=150,
-                temperature=0.7,
-                timeout=30
-            )
+            async with self._semaphore:
+                response = await self.client.chat.completions.create(
+                    model="gpt-4-1106-preview",
+                    messages=messages,
+                    max_tokens=max_tokens,
+                    temperature=0.7,
+                    timeout=30
+                )
             
-            fact = response.choices[0].message.content.strip()
+            fact = (response.choices[0].message.content or "").strip()
+            result = FactResult(provider="openai", fact=fact, latency=time.monotonic() - started)
             
-            if hasattr(response, 'usage'):
+            if getattr(response, 'usage', None):
                 usage = response.usage
-                logger.info(f"OpenAI tokens used - Prompt: {usage.prompt_tokens}, Completion: {usage.completion_tokens}, Total: {usage.total_tokens}")
+                result.prompt_tokens = usage.prompt_tokens
+                result.completion_tokens = usage.completion_tokens
+                self.rate_limiter.record_usage(estimated_tokens, usage.total_tokens)
+                self.tokens.record(usage.prompt_tokens, usage.completion_tokens, max_tokens, facts)
             
-            logger.info(f"Generated fact length: {len(fact)} characters")
+            logger.info("Generated fact length: %s characters", len(fact))
             
-            return fact
+            if not fact:
+                result.error = "empty completion"
+            return result
             
         except RateLimitError as e:
-            logger.error(f"OpenAI rate limit exceeded: {e}")
-            return "Извините, сервис временно перегружен. Попробуйте через несколько минут."
+            logger.error("OpenAI rate limit exceeded: %s", e)
+            self.rate_limiter.retry_after(parse_retry_after(e.response.headers.get('retry-after')))
+            return FactResult(
+                provider="openai", error=f"rate limit: {e}", latency=time.monotonic() - started,
+                user_message="Извините, сервис временно перегружен. Попробуйте через несколько минут."
+            )
             
         except APIError as e:
-            logger.error(f"OpenAI API error: {e}")
-            return "Извините, произошла ошибка при получении информации. Попробуйте ещё раз."
+            logger.error("OpenAI API error: %s", e)
+            return FactResult(
+                provider="openai", error=f"api error: {e}", latency=time.monotonic() - started,
+                user_message="Извините, произошла ошибка при получении информации. Попробуйте ещё раз."
+            )
             
         except Exception as e:
-            logger.error(f"Unexpected error generating fact: {e}")
-            return "Извините, не удалось получить информацию об этом месте. Попробуйте отправить локацию ещё раз."
+            logger.error("Unexpected error generating fact: %s", e)
+            return FactResult(
+                provider="openai", error=f"unexpected error: {e}", latency=time.monotonic() - started,
+                user_message="Извините, не удалось получить информацию об этом месте. Попробуйте отправить локацию ещё раз."
+            )
+    
+    async def prewarm(self):
+        """Open a pooled connection (DNS, TCP, TLS) before the first real request"""
+        await self.client.models.list()
+    
+    async def close(self):
+        """Close the underlying HTTP client"""
+        await self.client.close()
@@ -4,6 +4,11 @@ import sys
 import asyncio
 import time
 import aiohttp
+import json
+from typing import AsyncIterator, Optional
+from fact_result import UNPARSEABLE_BATCH, FactResult
+from prompts import TokenBudget, batch_messages, fact_messages, parse_batch_response
+from rate_limiter import estimate_text_tokens, estimate_tokens, get_rate_limiter, parse_retry_after
 
 logger = logging.getLogger(__name__)
 
@@ -17,78 +22,214 @@ class OpenRouterFactGenerator:
             sys.exit(1)
         
         self.api_key = api_key
-        self.last_request_time = 0
-        self.min_request_interval = 1  # Minimum 1 second between requests
+        
+        # OpenRouter endpoint
+        self.base_url = os.getenv('OPENROUTER_BASE_URL', 'https://openrouter.ai/api/v1').rstrip('/')
+        self.url = f"{self.base_url}/chat/completions"
+        
+        # Shared requests/tokens per minute budget (OPENROUTER_RPM, OPENROUTER_TPM)
+        self.rate_limiter = get_rate_limiter('OPENROUTER')
+        # Token accounting and adaptive max_tokens (FACT_MAX_TOKENS is the ceiling)
+        self.tokens = TokenBudget()
+        
+        # Connection pool settings
+        self.pool_size = int(os.getenv('OPENROUTER_POOL_SIZE', '100'))
+        self.pool_per_host = int(os.getenv('OPENROUTER_POOL_PER_HOST', '20'))
+        self.keepalive_timeout = float(os.getenv('OPENROUTER_KEEPALIVE_TIMEOUT', '60'))
+        self.session: Optional[aiohttp.ClientSession] = None
         
         logger.info("✅ OpenRouter client initialized successfully")
     
-    async def _rate_limit(self):
-        """Simple rate limiting to avoid hitting API limits"""
-        current_time = time.time()
-        time_since_last_request = current_time - self.last_request_time
+    async def start(self):
+        """Create the shared HTTP session used for all requests"""
+        if self.session is not None and not self.session.closed:
+            return
         
-        if time_since_last_request < self.min_request_interval:
-            sleep_time = self.min_request_interval - time_since_last_request
-            await asyncio.sleep(sleep_time)
-        
-        self.last_request_time = time.time()
+        connector = aiohttp.TCPConnector(
+            limit=self.pool_size,
+            limit_per_host=self.pool_per_host,
+            keepalive_timeout=self.keepalive_timeout,
+            ttl_dns_cache=300
+        )
+        self.session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=30)
+        )
+        logger.info("OpenRouter connection pool started (limit=%s, "
+                    "per_host=%s, keepalive=%ss)", self.pool_size, self.pool_per_host, self.keepalive_timeout)
+    
+    async def prewarm(self):
+        """Open a pooled connection (DNS, TCP, TLS) before the first real request"""
+        await self.start()
+        async with self.session.get(f"{self.base_url}/models") as response:
+            await response.read()
+    
+    async def close(self):
+        """Close the shared HTTP session"""
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
+    
+    @property
+    def max_tokens(self) -> int:
+        """Completion limit for one fact"""
+        return self.tokens.max_tokens
     
     async def get_location_fact(self, latitude: float, longitude: float) -> str:
         """Get an interesting fact about a location using OpenRouter API with GPT-4-Turbo"""
+        result = await self.generate_fact(latitude, longitude)
+        return result.text
+    
+    def _headers(self):
+        # Request headers
+        return {
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": "application/json",
+            "HTTP-Referer": "https://your-site-url.com",  # Update with your site
+            "X-Title": "Location Facts Bot"  # Your app name
+        }
+    
+    def _request_body(self, messages, max_tokens: int, stream: bool = False):
+        # Request body
+        data = {
+            "model": "anthropic/claude-3-haiku",  # You can also use "openai/gpt-4-turbo" or other models
+            "messages": messages,
+            "max_tokens": max_tokens,
+            "temperature": 0.7
+        }
+        if stream:
+            data["stream"] = True
+            # Report token usage in the last event
+            data["usage"] = {"include": True}
+        return data
+    
+    async def generate_fact(self, latitude: float, longitude: float, place: Optional[str] = None) -> FactResult:
+        """Request a fact and report the outcome as a FactResult"""
+        logger.info("Requesting fact via OpenRouter for coordinates: %s, %s", latitude, longitude)
+        
+        return await self._complete(fact_messages(latitude, longitude, place), self.max_tokens)
+    
+    async def stream_fact(self, latitude: float, longitude: float, place: Optional[str] = None) -> AsyncIterator[str]:
+        """Stream a fact as text chunks from server-sent events; errors are raised to the caller"""
+        messages = fact_messages(latitude, longitude, place)
+        max_tokens = self.max_tokens
+        estimated_tokens = estimate_tokens(messages) + max_tokens
+        await self.rate_limiter.acquire(estimated_tokens)
+        
+        logger.info("Streaming fact via OpenRouter for coordinates: %s, %s", latitude, longitude)
+        
+        if self.session is None or self.session.closed:
+            await self.start()
+        
+        parts = []
+        usage = None
+        finish_reason = None
+        data = self._request_body(messages, max_tokens, stream=True)
         try:
-            await self._rate_limit()
-            
-            prompt = f"Ты экскурсовод. Дай 1 интересный факт о месте в пределах 1 км от координат {latitude}, {longitude}. Отвечай на русском языке, кратко и интересно."
-            
-            logger.info(f"Requesting fact via OpenRouter for coordinates: {latitude}, {longitude}")
-            
-            # OpenRouter endpoint
-            url = "https://openrouter.ai/api/v1/chat/completions"
+            async with self.session.post(self.url, headers=self._headers(), json=data) as response:
+                if response.status != 200:
+                    error_text = await response.text()
+                    if response.status == 429:
+                        self.rate_limiter.retry_after(parse_retry_after(response.headers.get('Retry-After')))
+                    raise RuntimeError(f"OpenRouter API error: {response.status} - {error_text}")
+                
+                async for raw_line in response.content:
+                    line = raw_line.decode('utf-8').strip()
+                    # Skip keep-alive comments and blank lines between events
+                    if not line.startswith("data:"):
+                        continue
+                    payload = line[len("data:"):].strip()
+                    if payload == "[DONE]":
+                        break
+                    chunk = json.loads(payload)
+                    usage = chunk.get("usage") or usage
+                    choices = chunk.get("choices") or [{}]
+                    finish_reason = choices[0].get("finish_reason") or finish_reason
+                    content = (choices[0].get("delta") or {}).get("content")
+                    if content:
+                        parts.append(content)
+                        yield content
+        finally:
+            if parts or usage:
+                self._record_stream_usage(messages, estimated_tokens, max_tokens, "".join(parts), usage, finish_reason)
+    
+    def _record_stream_usage(self, messages, estimated_tokens: int, max_tokens: int, text: str, usage,
+                             finish_reason: Optional[str]):
+        """Account a streamed completion, estimating the usage if the provider did not report it"""
+        if usage:
+            prompt_tokens, completion_tokens = usage.get('prompt_tokens', 0), usage.get('completion_tokens', 0)
+        else:
+            prompt_tokens, completion_tokens = estimate_tokens(messages), estimate_text_tokens(text)
+        self.rate_limiter.record_usage(estimated_tokens, prompt_tokens + completion_tokens)
+        self.tokens.record(prompt_tokens, completion_tokens, max_tokens,
+                           truncated=None if finish_reason is None else finish_reason == "length")
+    
+    async def generate_facts_batch(self, coordinates, places=None) -> FactResult:
+        """Request facts for several locations in one completion; parsed facts go to result.facts"""
+        messages = batch_messages(coordinates, places)
+        
+        logger.info("Requesting batch of %s facts via OpenRouter", len(coordinates))
+        
+        result = await self._complete(messages, self.max_tokens * len(coordinates), len(coordinates))
+        if result.ok:
+            result.facts = parse_batch_response(result.fact, len(coordinates))
+            if result.facts is None:
+                result.error = UNPARSEABLE_BATCH
+        return result
+    
+    async def _complete(self, messages, max_tokens: int, facts: int = 1) -> FactResult:
+        """Run one chat completion and report the outcome as a FactResult"""
+        started = time.monotonic()
+        estimated_tokens = 0
+        try:
+            data = self._request_body(messages, max_tokens)
             
-            # Request headers
-            headers = {
-                "Authorization": f"Bearer {self.api_key}",
-                "Content-Type": "application/json",
-                "HTTP-Referer": "https://your-site-url.com",  # Update with your site
-                "X-Title": "Location Facts Bot"  # Your app name
-            }
+            estimated_tokens = estimate_tokens(messages) + max_tokens
+            await self.rate_limiter.acquire(estimated_tokens)
             
-            # Request body
-            data = {
-                "model": "anthropic/claude-3-haiku",  # You can also use "openai/gpt-4-turbo" or other models
-                "messages": [
-                    {"role": "system", "content": "Ты знающий экскурсовод, который знает интересные факты о местах по всему миру. Отвечай кратко, но интересно."},
-                    {"role": "user", "content": prompt}
-                ],
-                "max_tokens": 150,
-                "temperature": 0.7
-            }
+            # Start the pool lazily if start() was not called
+            if self.session is None or self.session.closed:
+                await self.start()
             
-            async with aiohttp.ClientSession() as session:
-                async with session.post(url, headers=headers, json=data, timeout=30) as response:
-                    if response.status != 200:
-                        error_text = await response.text()
-                        logger.error(f"OpenRouter API error: {response.status} - {error_text}")
-                        return "Извините, произошла ошибка при получении информации. Попробуйте ещё раз."
-                    
-                    response_data = await response.json()
-                    
-                    fact = response_data["choices"][0]["message"]["content"].strip()
-                    
-                    if "usage" in response_data:
-                        usage = response_data["usage"]
-                        logger.info(f"OpenRouter tokens used - Prompt: {usage.get('prompt_tokens', 0)}, "
-                                    f"Completion: {usage.get('completion_tokens', 0)}, "
-                                    f"Total: {usage.get('total_tokens', 0)}")
-                    
-                    logger.info(f"Generated fact length: {len(fact)} characters")
-                    
-                    return fact
+            async with self.session.post(self.url, headers=self._headers(), json=data) as response:
+                if response.status != 200:
+                    error_text = await response.text()
+                    logger.error("OpenRouter API error: %s - %s", response.status, error_text)
+                    if response.status == 429:
+                        self.rate_limiter.retry_after(parse_retry_after(response.headers.get('Retry-After')))
+                    return FactResult(
+                        provider="openrouter", error=f"http {response.status}", latency=time.monotonic() - started,
+                        user_message="Извините, произошла ошибка при получении информации. Попробуйте ещё раз."
+                    )
+                
+                response_data = await response.json()
+                
+                fact = (response_data["choices"][0]["message"]["content"] or "").strip()
+                result = FactResult(provider="openrouter", fact=fact, latency=time.monotonic() - started)
+                
+                if "usage" in response_data:
+                    usage = response_data["usage"]
+                    result.prompt_tokens = usage.get('prompt_tokens', 0)
+                    result.completion_tokens = usage.get('completion_tokens', 0)
+                    self.rate_limiter.record_usage(estimated_tokens, usage.get('total_tokens', 0))
+                    self.tokens.record(result.prompt_tokens, result.completion_tokens, max_tokens, facts)
+                
+                logger.info("Generated fact length: %s characters", len(fact))
+                
+                if not fact:
+                    result.error = "empty completion"
+                return result
             
         except asyncio.TimeoutError:
             logger.error("OpenRouter API request timed out")
-            return "Извините, сервис временно недоступен. Попробуйте через несколько минут."
+            return FactResult(
+                provider="openrouter", error="timeout", latency=time.monotonic() - started,
+                user_message="Извините, сервис временно недоступен. Попробуйте через несколько минут."
+            )
             
         except Exception as e:
-            logger.error(f"Unexpected error generating fact via OpenRouter: {e}")
-            return "Извините, не удалось получить информацию об этом месте. Попробуйте отправить локацию ещё раз." 
\ No newline at end of file
+            logger.error("Unexpected error generating fact via OpenRouter: %s", e)
+            return FactResult(
+                provider="openrouter", error=f"unexpected error: {e}", latency=time.monotonic() - started,
+                user_message="Извините, не удалось получить информацию об этом месте. Попробуйте отправить локацию ещё раз."
+            )
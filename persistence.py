@@ -0,0 +1,223 @@
+import asyncio
+import logging
+import os
+import sqlite3
+import time
+from typing import Dict, List, Optional, Tuple
+
+from fact_cache import CachedFact
+from session_store import LiveLocationSession, SessionKey
+
+logger = logging.getLogger(__name__)
+
+
+def to_wall(monotonic_time: float) -> float:
+    """Convert a time.monotonic() value to a Unix timestamp"""
+    return time.time() - (time.monotonic() - monotonic_time)
+
+
+def to_monotonic(wall_time: float) -> float:
+    """Convert a Unix timestamp to a time.monotonic() value"""
+    return time.monotonic() - (time.time() - wall_time)
+
+
+class StateBackend:
+    """
+    Persistence for live sessions and cached facts.
+
+    save_*/delete_* are called on the hot path and must not block; backends
+    buffer the changes and write them in the background (write-behind).
+    """
+    async def open(self):
+        pass
+
+    async def close(self):
+        pass
+
+    def start(self):
+        pass
+
+    async def load_sessions(self) -> List[LiveLocationSession]:
+        return []
+
+    async def load_facts(self) -> List[CachedFact]:
+        return []
+
+    def save_session(self, session: LiveLocationSession):
+        pass
+
+    def delete_session(self, key: SessionKey):
+        pass
+
+    def save_fact(self, fact: CachedFact):
+        pass
+
+
+class SQLiteStateBackend(StateBackend):
+    """SQLite backend; buffered changes are flushed every `flush_interval` seconds in a worker thread"""
+    def __init__(self, path: Optional[str] = None, flush_interval: Optional[float] = None,
+                 fact_ttl: Optional[float] = None, max_facts: Optional[int] = None):
+        self.path = path or os.getenv('STATE_DB_PATH', 'bot_state.db')
+        self.flush_interval = flush_interval if flush_interval is not None else float(os.getenv('STATE_FLUSH_INTERVAL', '2'))
+        self.fact_ttl = fact_ttl if fact_ttl is not None else float(os.getenv('FACT_CACHE_TTL', '86400'))
+        self.max_facts = max_facts if max_facts is not None else int(os.getenv('FACT_CACHE_MAX_ENTRIES', '10000'))
+        # Seconds a write waits for another process (shard workers share the file) to release its lock
+        self.busy_timeout = float(os.getenv('STATE_DB_BUSY_TIMEOUT', '5'))
+
+        self._db: Optional[sqlite3.Connection] = None
+        self._session_upserts: Dict[SessionKey, Tuple] = {}
+        self._session_deletes = set()
+        self._facts: List[Tuple] = []
+        self._flush_lock = asyncio.Lock()
+        self._stopping = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    async def open(self):
+        await asyncio.to_thread(self._open)
+        logger.info("State database opened: %s", self.path)
+
+    def _open(self):
+        # Only one flush runs at a time, so the connection is never used concurrently
+        self._db = sqlite3.connect(self.path, timeout=self.busy_timeout, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            "chat_id INTEGER NOT NULL, message_id INTEGER NOT NULL, "
+            "latitude REAL NOT NULL, longitude REAL NOT NULL, live_period INTEGER NOT NULL, "
+            "started_at REAL NOT NULL, last_update_at REAL NOT NULL, "
+            "fact_latitude REAL, fact_longitude REAL, last_fact_at REAL NOT NULL, "
+            "interval REAL NOT NULL, speed REAL NOT NULL, "
+            "PRIMARY KEY (chat_id, message_id))"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS facts ("
+            "latitude REAL NOT NULL, longitude REAL NOT NULL, fact TEXT NOT NULL, created_at REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS facts_created_at ON facts (created_at)")
+        self._db.commit()
+
+    def start(self):
+        """Start the background flush loop"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._flush_loop())
+
+    async def close(self):
+        """Flush pending changes and close the database"""
+        if self._task is not None:
+            # Let an in-progress flush finish rather than cancelling it mid-write
+            self._stopping.set()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self._db is not None:
+            await self.flush()
+            await asyncio.to_thread(self._db.close)
+            self._db = None
+
+    async def _flush_loop(self):
+        while not self._stopping.is_set():
+            try:
+                await asyncio.wait_for(self._stopping.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error("Error flushing state to %s: %s", self.path, e)
+
+    async def flush(self):
+        """Write buffered changes in one transaction"""
+        async with self._flush_lock:
+            if not (self._session_upserts or self._session_deletes or self._facts):
+                return
+            upserts = self._session_upserts
+            deletes = self._session_deletes
+            facts = self._facts
+            self._session_upserts = {}
+            self._session_deletes = set()
+            self._facts = []
+            try:
+                await asyncio.to_thread(self._write, list(upserts.values()), list(deletes), facts)
+            except BaseException:
+                self._requeue(upserts, deletes, facts)
+                raise
+
+    def _requeue(self, upserts: Dict[SessionKey, Tuple], deletes, facts: List[Tuple]):
+        """Put back changes of a failed flush so the next one retries them; changes made since win"""
+        for key, row in upserts.items():
+            if key not in self._session_upserts and key not in self._session_deletes:
+                self._session_upserts[key] = row
+        for key in deletes:
+            if key not in self._session_upserts:
+                self._session_deletes.add(key)
+        # Keep the buffer bounded if the database stays unavailable
+        self._facts = (facts + self._facts)[-self.max_facts:]
+
+    def _write(self, upserts, deletes, facts):
+        with self._db:
+            if deletes:
+                self._db.executemany("DELETE FROM sessions WHERE chat_id = ? AND message_id = ?", deletes)
+            if upserts:
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", upserts
+                )
+            if facts:
+                self._db.executemany("INSERT INTO facts VALUES (?, ?, ?, ?)", facts)
+                self._db.execute("DELETE FROM facts WHERE created_at < ?", (time.time() - self.fact_ttl,))
+
+    async def load_sessions(self) -> List[LiveLocationSession]:
+        rows = await asyncio.to_thread(lambda: self._db.execute("SELECT * FROM sessions").fetchall())
+        sessions = []
+        for (chat_id, message_id, latitude, longitude, live_period, started_at, last_update_at,
+             fact_latitude, fact_longitude, last_fact_at, interval, speed) in rows:
+            sessions.append(LiveLocationSession(
+                chat_id=chat_id,
+                message_id=message_id,
+                latitude=latitude,
+                longitude=longitude,
+                live_period=live_period,
+                started_at=to_monotonic(started_at),
+                last_update_at=to_monotonic(last_update_at),
+                fact_latitude=fact_latitude,
+                fact_longitude=fact_longitude,
+                last_fact_at=to_monotonic(last_fact_at),
+                interval=interval,
+                speed=speed
+            ))
+        return sessions
+
+    async def load_facts(self) -> List[CachedFact]:
+        rows = await asyncio.to_thread(lambda: self._db.execute(
+            "SELECT latitude, longitude, fact, created_at FROM facts WHERE created_at >= ? "
+            "ORDER BY created_at DESC LIMIT ?",
+            (time.time() - self.fact_ttl, self.max_facts)
+        ).fetchall())
+        # Oldest first, so the newest facts end up most recently used
+        return [CachedFact(latitude, longitude, fact, to_monotonic(created_at))
+                for latitude, longitude, fact, created_at in reversed(rows)]
+
+    def save_session(self, session: LiveLocationSession):
+        self._session_deletes.discard(session.key)
+        self._session_upserts[session.key] = (
+            session.chat_id, session.message_id, session.latitude, session.longitude, session.live_period,
+            to_wall(session.started_at), to_wall(session.last_update_at),
+            session.fact_latitude, session.fact_longitude, to_wall(session.last_fact_at),
+            session.interval, session.speed
+        )
+
+    def delete_session(self, key: SessionKey):
+        self._session_upserts.pop(key, None)
+        self._session_deletes.add(key)
+
+    def save_fact(self, fact: CachedFact):
+        self._facts.append((fact.latitude, fact.longitude, fact.fact, to_wall(fact.created_at)))
+
+
+def create_state_backend() -> StateBackend:
+    """Create the backend selected by STATE_BACKEND (sqlite or none)"""
+    backend = os.getenv('STATE_BACKEND', 'sqlite').lower()
+    if backend == 'sqlite':
+        return SQLiteStateBackend()
+    if backend != 'none':
+        logger.warning("Unknown STATE_BACKEND '%s', state will not be persisted", backend)
+    return StateBackend()
@@ -0,0 +1,164 @@
+import asyncio
+import logging
+import math
+import os
+import time
+from collections import deque
+from typing import Deque, Dict, Optional, Tuple
+
+from fact_cache import METERS_PER_DEGREE, haversine_m
+from session_store import LiveLocationSession, SessionKey
+
+logger = logging.getLogger(__name__)
+
+
+class _Prediction:
+    __slots__ = ("due_at", "latitude", "longitude", "fact", "task")
+
+    def __init__(self, due_at: float, latitude: float, longitude: float):
+        self.due_at = due_at
+        self.latitude = latitude
+        self.longitude = longitude
+        self.fact: Optional[str] = None
+        self.task: Optional[asyncio.Task] = None
+
+
+class TrajectoryPrefetcher:
+    """
+    Generate a live session's next periodic fact ahead of time.
+
+    Recent position updates give a velocity estimate; once the next run is
+    less than `lead` seconds away, the position at that run is extrapolated
+    and its fact is requested in the background, but only while the upstream
+    rate budget has spare room. At the run, the fact is used if the user ended
+    up within `max_miss_m` of the prediction and discarded otherwise.
+    """
+    def __init__(self, fact_generator, min_distance_m: float = 0.0):
+        self.fact_generator = fact_generator
+        # Predictions closer than this to the last fact would be skipped anyway
+        self.min_distance_m = min_distance_m
+        self.lead = float(os.getenv('PREFETCH_LEAD', '60'))
+        self.max_miss_m = float(os.getenv('PREFETCH_MAX_MISS_M', '300'))
+        self.max_concurrent = int(os.getenv('PREFETCH_MAX_CONCURRENT', '2'))
+        self.reserve = float(os.getenv('PREFETCH_RESERVE', '0.5'))
+
+        self._history: Dict[SessionKey, Deque[Tuple[float, float, float]]] = {}
+        self._predictions: Dict[SessionKey, _Prediction] = {}
+        self._running = 0
+
+        self.started = 0
+        self.hits = 0
+        self.misses = 0
+        self.skipped_budget = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.lead > 0 and self.max_concurrent > 0
+
+    def predict(self, key: SessionKey, at: float) -> Optional[Tuple[float, float]]:
+        """Extrapolated position at monotonic time `at`, or None without enough history"""
+        history = self._history.get(key)
+        if not history or len(history) < 2:
+            return None
+        (t0, lat0, lon0), (t1, lat1, lon1) = history[0], history[-1]
+        if t1 <= t0:
+            return None
+        cos_lat = max(math.cos(math.radians(lat1)), 1e-3)
+        # Velocity in meters per second, north and east
+        v_north = (lat1 - lat0) * METERS_PER_DEGREE / (t1 - t0)
+        v_east = (lon1 - lon0) * METERS_PER_DEGREE * cos_lat / (t1 - t0)
+        dt = max(at - t1, 0.0)
+        latitude = max(-90.0, min(90.0, lat1 + v_north * dt / METERS_PER_DEGREE))
+        longitude = (lon1 + v_east * dt / (METERS_PER_DEGREE * cos_lat) + 180) % 360 - 180
+        return latitude, longitude
+
+    def observe(self, session: LiveLocationSession):
+        """Record a position update and start a prefetch if the next run is close"""
+        if not self.enabled:
+            return
+        now = time.monotonic()
+        history = self._history.setdefault(session.key, deque(maxlen=5))
+        history.append((now, session.latitude, session.longitude))
+
+        if not session.next_run_at or session.next_run_at - now > self.lead:
+            return
+        predicted = self.predict(session.key, session.next_run_at)
+        if predicted is None:
+            return
+
+        # Skip if the user is not expected to move far enough for a new fact
+        if session.fact_latitude is not None and haversine_m(
+                session.fact_latitude, session.fact_longitude, *predicted) < self.min_distance_m:
+            return
+
+        # One prefetch per run, redone only if the prediction has moved a lot
+        current = self._predictions.get(session.key)
+        if current is not None and current.due_at == session.next_run_at and haversine_m(
+                current.latitude, current.longitude, *predicted) <= self.max_miss_m:
+            return
+
+        if self._running >= self.max_concurrent or not self.fact_generator.has_spare_capacity(self.reserve):
+            self.skipped_budget += 1
+            return
+
+        self._discard(session.key)
+        prediction = _Prediction(session.next_run_at, *predicted)
+        # Counted as soon as it is created, so several updates in one loop tick
+        # cannot all pass the limit check
+        self._running += 1
+        prediction.task = asyncio.create_task(self._fetch(prediction))
+        prediction.task.add_done_callback(self._fetch_done)
+        self._predictions[session.key] = prediction
+        self.started += 1
+
+    async def _fetch(self, prediction: _Prediction):
+        try:
+            prediction.fact = await self.fact_generator.try_location_fact(prediction.latitude, prediction.longitude)
+        except Exception as e:
+            logger.warning("Prefetch failed: %s", e)
+
+    def _fetch_done(self, task: asyncio.Task):
+        # A done callback rather than finally: a task cancelled before it starts never runs its body
+        self._running -= 1
+
+    async def take(self, key: SessionKey, latitude: float, longitude: float) -> Optional[str]:
+        """
+        Prefetched fact for the session if the prediction was close enough to
+        the actual position; waits for a prefetch that is still running
+        """
+        prediction = self._predictions.pop(key, None)
+        if prediction is None:
+            return None
+        if haversine_m(prediction.latitude, prediction.longitude, latitude, longitude) > self.max_miss_m:
+            prediction.task.cancel()
+            self.misses += 1
+            return None
+        if not prediction.task.done():
+            # Already ahead of a fresh request, so let it finish
+            await asyncio.gather(prediction.task, return_exceptions=True)
+        if prediction.fact is None:
+            return None
+        self.hits += 1
+        return prediction.fact
+
+    def _discard(self, key: SessionKey):
+        prediction = self._predictions.pop(key, None)
+        if prediction is not None and prediction.task is not None:
+            prediction.task.cancel()
+
+    def forget(self, key: SessionKey):
+        """Drop all state of a finished session"""
+        self._discard(key)
+        self._history.pop(key, None)
+
+    async def stop(self):
+        """Cancel prefetches in progress"""
+        tasks = [prediction.task for prediction in self._predictions.values() if prediction.task is not None]
+        self._predictions = {}
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stats(self) -> Dict[str, int]:
+        return {"started": self.started, "hits": self.hits, "misses": self.misses,
+                "skipped_budget": self.skipped_budget}
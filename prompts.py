@@ -0,0 +1,123 @@
+import json
+import math
+import os
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple
+
+# Instructions are the same for every request and come first, so providers that
+# cache prompt prefixes can reuse them; only the short location part varies.
+SYSTEM_PROMPT = ("Ты экскурсовод. Рассказывай по-русски интересные факты о местах в пределах 1 км "
+                 "от указанной точки: кратко, 2-3 предложения, без вступлений.")
+FACT_INSTRUCTION = "Дай 1 факт."
+BATCH_INSTRUCTION = "Дай по 1 факту для каждой точки. Верни только JSON-массив из {count} строк в том же порядке."
+
+# Decimal places of coordinates sent to the model; 3 is about 100 m, well within the 1 km radius
+COORDINATE_PRECISION = int(os.getenv('PROMPT_COORD_PRECISION', '3'))
+
+
+def format_location(latitude: float, longitude: float, place: Optional[str] = None) -> str:
+    """Compact location text: rounded coordinates, with the place name if known"""
+    coordinates = f"{round(latitude, COORDINATE_PRECISION)}, {round(longitude, COORDINATE_PRECISION)}"
+    return f"«{place}» ({coordinates})" if place else coordinates
+
+
+def fact_messages(latitude: float, longitude: float, place: Optional[str] = None):
+    """Chat messages asking for one fact about a location"""
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": f"{FACT_INSTRUCTION}\n{format_location(latitude, longitude, place)}"}
+    ]
+
+
+def batch_messages(coordinates: List[Tuple[float, float]], places: Optional[List[Optional[str]]] = None):
+    """Chat messages asking for one fact per location as a JSON array"""
+    places = places or [None] * len(coordinates)
+    points = "\n".join(
+        f"{index}. {format_location(latitude, longitude, place)}"
+        for index, ((latitude, longitude), place) in enumerate(zip(coordinates, places), 1)
+    )
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": f"{BATCH_INSTRUCTION.format(count=len(coordinates))}\n{points}"}
+    ]
+
+
+def parse_batch_response(text: str, expected: int) -> Optional[List[Optional[str]]]:
+    """
+    Split a batch completion into per-location facts.
+    Returns None if the response is not a JSON array of the expected length;
+    individual empty or non-string items become None.
+    """
+    start = text.find("[")
+    end = text.rfind("]")
+    if start == -1 or end <= start:
+        return None
+    try:
+        items = json.loads(text[start:end + 1])
+    except ValueError:
+        return None
+    if not isinstance(items, list) or len(items) != expected:
+        return None
+    return [item.strip() if isinstance(item, str) and item.strip() else None for item in items]
+
+
+class TokenBudget:
+    """
+    Per-provider token accounting and the max_tokens to request for one fact.
+
+    max_tokens starts at the configured ceiling and, once enough completions
+    have been seen, follows a high percentile of their lengths plus headroom.
+    A completion that uses the whole limit was probably cut off, so the limit
+    goes back up to the ceiling and adapts again from there.
+    """
+    def __init__(self, ceiling: Optional[int] = None, floor: Optional[int] = None,
+                 window: int = 200, min_samples: int = 20):
+        self.ceiling = ceiling if ceiling is not None else int(os.getenv('FACT_MAX_TOKENS', '150'))
+        self.floor = floor if floor is not None else int(os.getenv('FACT_MIN_TOKENS', '60'))
+        self.headroom = float(os.getenv('FACT_TOKENS_HEADROOM', '1.25'))
+        self.min_samples = min_samples
+        self.max_tokens = self.ceiling
+        # Completion tokens per fact of recent responses
+        self._completions: Deque[float] = deque(maxlen=window)
+
+        self.requests = 0
+        self.facts = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.truncated = 0
+
+    def record(self, prompt_tokens: int, completion_tokens: int, max_tokens: int, facts: int = 1,
+               truncated: Optional[bool] = None):
+        """
+        Account a completion of `facts` facts requested with `max_tokens`.
+        `truncated` is the provider's finish reason where known; otherwise a
+        completion of max_tokens tokens counts as cut off.
+        """
+        self.requests += 1
+        self.facts += facts
+        self.prompt_tokens += prompt_tokens
+        self.completion_tokens += completion_tokens
+        if not completion_tokens:
+            return
+        if truncated is None:
+            truncated = completion_tokens >= max_tokens
+        if truncated:
+            self.truncated += 1
+            self._completions.clear()
+            self.max_tokens = self.ceiling
+            return
+        self._completions.append(completion_tokens / facts)
+        if len(self._completions) >= self.min_samples:
+            lengths = sorted(self._completions)
+            p95 = lengths[min(len(lengths) - 1, int(len(lengths) * 0.95))]
+            self.max_tokens = min(self.ceiling, max(self.floor, math.ceil(p95 * self.headroom)))
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "requests": self.requests,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "tokens_per_fact": round((self.prompt_tokens + self.completion_tokens) / self.facts, 1) if self.facts else 0,
+            "max_tokens": self.max_tokens,
+            "truncated": self.truncated,
+        }
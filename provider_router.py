@@ -0,0 +1,188 @@
+import logging
+import os
+import time
+from collections import deque
+from typing import Awaitable, Dict, List, Optional, Tuple
+
+from fact_result import FactResult
+from metrics import UPSTREAM_LATENCY, UPSTREAM_TOKENS
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class ProviderHealth:
+    """
+    Latency/error statistics and circuit breaker for one provider.
+
+    The breaker opens after `failure_threshold` consecutive failures. Once
+    `open_seconds` have passed a single probe request is let through
+    (half-open); its success closes the breaker and its failure re-opens it.
+    """
+    def __init__(self, name: str, alpha: float, failure_threshold: int, open_seconds: float,
+                 half_life: float):
+        self.name = name
+        self.alpha = alpha
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.half_life = half_life
+
+        self.ewma_latency: Optional[float] = None
+        self.error_rate = 0.0
+        self.consecutive_failures = 0
+        self.state = CLOSED
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+        self.last_sample_at = 0.0
+        self.latencies = deque(maxlen=100)
+
+    def _update_state(self, now: float):
+        if self.state == OPEN and now - self.opened_at >= self.open_seconds:
+            self.state = HALF_OPEN
+            self.probe_in_flight = False
+
+    def is_available(self, now: float) -> bool:
+        """Check whether a request may be sent to the provider"""
+        self._update_state(now)
+        if self.state == CLOSED:
+            return True
+        if self.state == HALF_OPEN:
+            return not self.probe_in_flight
+        return False
+
+    def acquire(self, now: float):
+        """Mark a request as started; half-open allows only one probe"""
+        self._update_state(now)
+        if self.state == HALF_OPEN:
+            self.probe_in_flight = True
+
+    def score(self, now: float) -> float:
+        """Expected cost of a request, lower is better"""
+        # Providers without samples are tried first so they get measured
+        latency = self.ewma_latency if self.ewma_latency is not None else 0.0
+        # Old failures fade out so a deprioritized provider is eventually retried
+        error_rate = self.error_rate * 0.5 ** ((now - self.last_sample_at) / self.half_life)
+        # Penalize unreliable providers by the expected retry cost
+        return latency / max(1.0 - error_rate, 0.05)
+
+    def p90_latency(self) -> Optional[float]:
+        if len(self.latencies) < 10:
+            return None
+        latencies = sorted(self.latencies)
+        return latencies[int(len(latencies) * 0.9) - 1]
+
+    def record(self, result: FactResult, now: float, batch: bool = False):
+        """
+        Update statistics with the outcome of a request.
+        Batch requests take longer by design, so their latency is left out of
+        the EWMA and p90 that drive routing and hedging; a batch answer that
+        could not be parsed is not a provider failure.
+        """
+        self.probe_in_flight = False
+        if batch and result.unparseable:
+            return
+        self.last_sample_at = now
+        if not batch:
+            if self.ewma_latency is None:
+                self.ewma_latency = result.latency
+            else:
+                self.ewma_latency += self.alpha * (result.latency - self.ewma_latency)
+        self.error_rate += self.alpha * ((0.0 if result.ok else 1.0) - self.error_rate)
+
+        if result.ok:
+            if not batch:
+                self.latencies.append(result.latency)
+            self.consecutive_failures = 0
+            if self.state != CLOSED:
+                logger.info("Circuit breaker for %s closed", self.name)
+            self.state = CLOSED
+            return
+
+        self.consecutive_failures += 1
+        if self.state == HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+            if self.state != OPEN:
+                logger.warning("Circuit breaker for %s opened after "
+                               "%s failures: %s", self.name, self.consecutive_failures, result.error)
+            self.state = OPEN
+            self.opened_at = now
+
+    def snapshot(self) -> Dict:
+        return {
+            "state": self.state,
+            "ewma_latency": self.ewma_latency,
+            "error_rate": round(self.error_rate, 3),
+            "consecutive_failures": self.consecutive_failures,
+        }
+
+
+class ProviderRouter:
+    """
+    Route fact requests to the fastest healthy provider.
+
+    `providers` maps a provider name to a client exposing
+    `async generate_fact(latitude, longitude, place) -> FactResult`, in static
+    priority order used to break ties.
+    """
+    def __init__(self, providers: Dict[str, object]):
+        self.providers = providers
+        alpha = float(os.getenv('PROVIDER_EWMA_ALPHA', '0.3'))
+        failure_threshold = int(os.getenv('PROVIDER_FAILURE_THRESHOLD', '3'))
+        open_seconds = float(os.getenv('PROVIDER_OPEN_SECONDS', '30'))
+        half_life = float(os.getenv('PROVIDER_STATS_HALF_LIFE', '300'))
+        self.health = {
+            name: ProviderHealth(name, alpha, failure_threshold, open_seconds, half_life)
+            for name in providers
+        }
+        self._priority = {name: index for index, name in enumerate(providers)}
+
+    def order(self) -> List[str]:
+        """Available providers, best first"""
+        now = time.monotonic()
+        available = [name for name, health in self.health.items() if health.is_available(now)]
+        return sorted(available, key=lambda name: (self.health[name].score(now), self._priority[name]))
+
+    async def call(self, name: str, latitude: float, longitude: float, place: Optional[str] = None) -> FactResult:
+        """Request a fact from a provider and record the outcome"""
+        return await self._call(name, self.providers[name].generate_fact(latitude, longitude, place))
+    
+    async def call_batch(self, name: str, coordinates: List[Tuple[float, float]],
+                         places: Optional[List[Optional[str]]] = None) -> FactResult:
+        """Request facts for several locations from a provider and record the outcome"""
+        return await self._call(name, self.providers[name].generate_facts_batch(coordinates, places), batch=True)
+    
+    async def _call(self, name: str, request: Awaitable[FactResult], batch: bool = False) -> FactResult:
+        self.begin(name)
+        started = time.monotonic()
+        try:
+            result = await request
+        except BaseException:
+            # Cancelled (e.g. lost a hedge race): free the probe slot without judging the provider
+            self.health[name].probe_in_flight = False
+            raise
+        if not result.latency:
+            result.latency = time.monotonic() - started
+        self.record(name, result, batch)
+        return result
+    
+    def begin(self, name: str):
+        """Mark a request to a provider as started"""
+        self.health[name].acquire(time.monotonic())
+    
+    def record(self, name: str, result: FactResult, batch: bool = False):
+        """Record the outcome of a request started with begin()"""
+        self.health[name].record(result, time.monotonic(), batch)
+        if batch:
+            outcome = "batch_ok" if result.ok else "batch_unparseable" if result.unparseable else "batch_error"
+        else:
+            outcome = "ok" if result.ok else "error"
+        UPSTREAM_LATENCY.observe(result.latency, provider=name, outcome=outcome)
+        if result.prompt_tokens:
+            UPSTREAM_TOKENS.inc(result.prompt_tokens, provider=name, kind="prompt")
+        if result.completion_tokens:
+            UPSTREAM_TOKENS.inc(result.completion_tokens, provider=name, kind="completion")
+    
+    def stats(self) -> Dict[str, Dict]:
+        return {name: health.snapshot() for name, health in self.health.items()}
@@ -0,0 +1,187 @@
+import asyncio
+import logging
+import os
+import time
+from email.utils import parsedate_to_datetime
+from typing import Dict, Optional
+
+from metrics import RATE_LIMIT_WAIT
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """Token bucket refilled continuously at `rate` tokens per second"""
+    __slots__ = ("capacity", "rate", "tokens", "updated")
+
+    def __init__(self, capacity: float, rate: float):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        # `now` may be slightly older than `updated` when read before the bucket was created
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        """Seconds until `amount` tokens are available"""
+        self._refill(now)
+        # Requests larger than the bucket only need a full bucket
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def consume(self, amount: float):
+        # May go negative when actual usage exceeds the estimate; that debt is repaid by refill
+        self.tokens -= amount
+
+    def scale(self, factor: float):
+        """Shrink or grow capacity and rate, e.g. to split a shared quota between processes"""
+        self.capacity = max(1.0, self.capacity * factor)
+        self.rate *= factor
+        self.tokens = min(self.tokens, self.capacity)
+
+
+class RateLimiter:
+    """
+    Asyncio rate limiter with requests-per-minute and tokens-per-minute budgets.
+
+    Waiters are served strictly in arrival order: the head of the queue holds
+    the lock while it sleeps, so later callers cannot overtake it. A Retry-After
+    from the provider blocks every caller until it expires.
+    """
+    def __init__(self, name: str, requests_per_minute: float, tokens_per_minute: float = 0,
+                 burst_seconds: float = 60):
+        self.name = name
+        self.requests = TokenBucket(max(1.0, requests_per_minute * burst_seconds / 60), requests_per_minute / 60) \
+            if requests_per_minute > 0 else None
+        self.tokens = TokenBucket(max(1.0, tokens_per_minute * burst_seconds / 60), tokens_per_minute / 60) \
+            if tokens_per_minute > 0 else None
+        self.blocked_until = 0.0
+        self._lock = asyncio.Lock()
+
+        self.total_wait = 0.0
+        self.total_acquired = 0
+
+    @classmethod
+    def from_env(cls, prefix: str, default_rpm: float = 60) -> "RateLimiter":
+        """Build a limiter from <PREFIX>_RPM, <PREFIX>_TPM and <PREFIX>_BURST_SECONDS"""
+        return cls(
+            prefix.lower(),
+            requests_per_minute=float(os.getenv(f'{prefix}_RPM', str(default_rpm))),
+            tokens_per_minute=float(os.getenv(f'{prefix}_TPM', '0')),
+            burst_seconds=float(os.getenv(f'{prefix}_BURST_SECONDS', '60'))
+        )
+
+    def _wait_time(self, tokens: int, now: float) -> float:
+        wait = self.blocked_until - now
+        if self.requests:
+            wait = max(wait, self.requests.wait_time(1, now))
+        if self.tokens and tokens:
+            wait = max(wait, self.tokens.wait_time(tokens, now))
+        return wait
+
+    async def acquire(self, tokens: int = 0) -> float:
+        """Wait for budget for one request using about `tokens` tokens; returns seconds waited"""
+        started = time.monotonic()
+        async with self._lock:
+            while True:
+                wait = self._wait_time(tokens, time.monotonic())
+                if wait <= 0:
+                    break
+                await asyncio.sleep(wait)
+
+            if self.requests:
+                self.requests.consume(1)
+            if self.tokens and tokens:
+                self.tokens.consume(tokens)
+
+        waited = time.monotonic() - started
+        self.total_wait += waited
+        RATE_LIMIT_WAIT.observe(waited, limiter=self.name)
+        self.total_acquired += 1
+        return waited
+
+    def has_headroom(self, tokens: int = 0, reserve: float = 0.5) -> bool:
+        """
+        True if a request could start now while leaving `reserve` (a fraction of
+        each bucket) for foreground requests. Used to schedule optional work.
+        """
+        now = time.monotonic()
+        if now < self.blocked_until or self._lock.locked():
+            return False
+        if self.requests and self.requests.wait_time(1 + reserve * self.requests.capacity, now) > 0:
+            return False
+        if self.tokens and self.tokens.wait_time(tokens + reserve * self.tokens.capacity, now) > 0:
+            return False
+        return True
+
+    def record_usage(self, estimated_tokens: int, actual_tokens: int):
+        """Correct the token budget once the real usage is known"""
+        if self.tokens and actual_tokens:
+            self.tokens.consume(actual_tokens - estimated_tokens)
+
+    def retry_after(self, seconds: float):
+        """Block all requests for `seconds` after a 429 from the provider"""
+        until = time.monotonic() + max(seconds, 0.0)
+        if until > self.blocked_until:
+            self.blocked_until = until
+            logger.warning("%s rate limited by provider, pausing requests for %.1fs", self.name, seconds)
+
+    def scale(self, factor: float):
+        """Scale both budgets by `factor`"""
+        for bucket in (self.requests, self.tokens):
+            if bucket is not None:
+                bucket.scale(factor)
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "acquired": self.total_acquired,
+            "total_wait": round(self.total_wait, 3),
+            "blocked_for": round(max(0.0, self.blocked_until - time.monotonic()), 3),
+        }
+
+
+def parse_retry_after(value: Optional[str], default: float = 1.0) -> float:
+    """Parse a Retry-After header given in seconds or as an HTTP date"""
+    if not value:
+        return default
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return default
+
+
+_limiters: Dict[str, RateLimiter] = {}
+
+
+def get_rate_limiter(prefix: str, default_rpm: float = 60) -> RateLimiter:
+    """Get the process-wide limiter for a provider, creating it on first use"""
+    if prefix not in _limiters:
+        _limiters[prefix] = RateLimiter.from_env(prefix, default_rpm)
+    return _limiters[prefix]
+
+
+def scale_rate_limiters(factor: float):
+    """Scale every limiter created in this process, e.g. 1/N in each of N worker processes"""
+    for limiter in _limiters.values():
+        limiter.scale(factor)
+
+
+def estimate_tokens(messages) -> int:
+    """Rough token count of chat messages before the provider reports real usage"""
+    # Cyrillic text averages about 2-3 characters per token; err on the high side
+    return sum(estimate_text_tokens(message["content"]) + 4 for message in messages)
+
+
+def estimate_text_tokens(text: str) -> int:
+    """Rough token count of text, for completions whose usage is not reported"""
+    return len(text) // 2
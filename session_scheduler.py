@@ -0,0 +1,126 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+import time
+from typing import Awaitable, Callable, Dict, Hashable, List, Optional, Tuple
+
+from metrics import SCHEDULER_LAG
+
+logger = logging.getLogger(__name__)
+
+
+class SessionScheduler:
+    """
+    Single timer for all live sessions.
+
+    Due times live in a min-heap; one dispatcher task sleeps until the earliest
+    due time (or until an earlier entry is scheduled) and hands due keys to a
+    fixed pool of workers through a bounded queue. The handler returns the next
+    due time for the key, or None when the key should not run again.
+    Rescheduling and cancellation mark older heap entries stale instead of
+    removing them.
+    """
+    def __init__(self, handler: Callable[[Hashable], Awaitable[Optional[float]]],
+                 workers: Optional[int] = None):
+        self.handler = handler
+        self.worker_count = workers if workers is not None else int(os.getenv('LIVE_SESSION_WORKERS', '8'))
+
+        self._heap: List[Tuple[float, int, Hashable]] = []
+        self._entries: Dict[Hashable, int] = {}
+        self._counter = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+
+    def schedule(self, key: Hashable, due_at: float):
+        """Run key at monotonic time due_at, replacing any earlier schedule"""
+        seq = next(self._counter)
+        self._entries[key] = seq
+        heapq.heappush(self._heap, (due_at, seq, key))
+        if self._heap[0][1] == seq:
+            self._wakeup.set()
+        self._compact()
+
+    def cancel(self, key: Hashable):
+        """Drop the pending run of key, if any"""
+        self._entries.pop(key, None)
+        self._compact()
+
+    def pending(self) -> int:
+        """Get number of scheduled keys"""
+        return len(self._entries)
+
+    def _compact(self):
+        # Rebuild the heap when stale entries dominate it
+        if len(self._heap) > 2 * len(self._entries) + 64:
+            self._heap = [entry for entry in self._heap if self._entries.get(entry[2]) == entry[1]]
+            heapq.heapify(self._heap)
+
+    def start(self):
+        """Start the dispatcher and worker tasks"""
+        if self._tasks:
+            return
+        self._queue = asyncio.Queue(maxsize=self.worker_count * 4)
+        self._tasks.append(asyncio.create_task(self._dispatch()))
+        for _ in range(self.worker_count):
+            self._tasks.append(asyncio.create_task(self._worker()))
+        logger.info("Session scheduler started with %s workers", self.worker_count)
+
+    async def stop(self, timeout: float = 0.0):
+        """Stop the dispatcher, give queued and running handlers up to `timeout` seconds, then stop the workers"""
+        if not self._tasks:
+            return
+        dispatcher, workers = self._tasks[0], self._tasks[1:]
+        dispatcher.cancel()
+        await asyncio.gather(dispatcher, return_exceptions=True)
+        if timeout > 0:
+            try:
+                await asyncio.wait_for(self._queue.join(), timeout)
+            except asyncio.TimeoutError:
+                logger.warning("Session scheduler stopped with %s queued sessions", self._queue.qsize())
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        self._tasks = []
+
+    async def _dispatch(self):
+        while True:
+            self._wakeup.clear()
+            now = time.monotonic()
+            while self._heap and self._heap[0][0] <= now:
+                due_at, seq, key = heapq.heappop(self._heap)
+                if self._entries.get(key) != seq:
+                    continue
+                del self._entries[key]
+
+                self.last_lag = now - due_at
+                self.max_lag = max(self.max_lag, self.last_lag)
+                SCHEDULER_LAG.observe(self.last_lag)
+
+                # Blocks when all workers are busy, which shows up as scheduler lag
+                await self._queue.put(key)
+                now = time.monotonic()
+
+            timeout = self._heap[0][0] - now if self._heap else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _worker(self):
+        while True:
+            key = await self._queue.get()
+            try:
+                next_due = await self.handler(key)
+                # Keep a schedule made while the handler was running
+                if next_due is not None and key not in self._entries:
+                    self.schedule(key, next_due)
+            except Exception as e:
+                logger.error("Error processing scheduled session %s: %s", key, e)
+            finally:
+                self._queue.task_done()
@@ -0,0 +1,124 @@
+import heapq
+import time
+from typing import Dict, Iterator, List, Optional, Tuple
+
+SessionKey = Tuple[int, int]
+
+
+class LiveLocationSession:
+    """
+    State of one live location share. Timestamps are time.monotonic() values.
+    """
+    __slots__ = (
+        "chat_id", "message_id", "latitude", "longitude", "live_period",
+        "started_at", "last_update_at",
+        # Coordinates and time of the last fact sent for this session
+        "fact_latitude", "fact_longitude", "last_fact_at",
+        # Current interval between facts and the next scheduled run
+        "interval", "next_run_at",
+        # Smoothed speed in meters per second
+        "speed",
+    )
+
+    def __init__(self, chat_id: int, message_id: int, latitude: float, longitude: float,
+                 live_period: int, started_at: Optional[float] = None, last_update_at: Optional[float] = None,
+                 fact_latitude: Optional[float] = None, fact_longitude: Optional[float] = None,
+                 last_fact_at: float = 0.0, interval: float = 0.0, next_run_at: float = 0.0,
+                 speed: float = 0.0):
+        now = time.monotonic()
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.latitude = latitude
+        self.longitude = longitude
+        self.live_period = live_period
+        self.started_at = now if started_at is None else started_at
+        self.last_update_at = now if last_update_at is None else last_update_at
+        self.fact_latitude = fact_latitude
+        self.fact_longitude = fact_longitude
+        self.last_fact_at = last_fact_at
+        self.interval = interval
+        self.next_run_at = next_run_at
+        self.speed = speed
+
+    @property
+    def key(self) -> SessionKey:
+        return (self.chat_id, self.message_id)
+
+    @property
+    def expires_at(self) -> float:
+        return self.started_at + self.live_period
+
+    def __repr__(self) -> str:
+        return (f"LiveLocationSession(chat_id={self.chat_id}, message_id={self.message_id}, "
+                f"latitude={self.latitude}, longitude={self.longitude}, live_period={self.live_period})")
+
+
+class SessionStore:
+    """
+    Live sessions indexed by (chat_id, message_id), by chat and by expiry.
+
+    The expiry index is a heap with lazy deletion: entries are validated
+    against the current session when popped, so updates are O(log n).
+    Next runs are timed by SessionScheduler, which keeps its own heap.
+    """
+    def __init__(self):
+        self._sessions: Dict[SessionKey, LiveLocationSession] = {}
+        self._by_chat: Dict[int, Dict[int, LiveLocationSession]] = {}
+        self._expiry: List[Tuple[float, SessionKey]] = []
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def __contains__(self, key: SessionKey) -> bool:
+        return key in self._sessions
+
+    def __iter__(self) -> Iterator[LiveLocationSession]:
+        return iter(list(self._sessions.values()))
+
+    def get(self, chat_id: int, message_id: int) -> Optional[LiveLocationSession]:
+        return self._sessions.get((chat_id, message_id))
+
+    def add(self, session: LiveLocationSession):
+        """Add or replace a session"""
+        self._sessions[session.key] = session
+        self._by_chat.setdefault(session.chat_id, {})[session.message_id] = session
+        heapq.heappush(self._expiry, (session.expires_at, session.key))
+        self._compact()
+
+    def remove(self, chat_id: int, message_id: int) -> Optional[LiveLocationSession]:
+        """Remove a session and return it"""
+        session = self._sessions.pop((chat_id, message_id), None)
+        if session is not None:
+            chat_sessions = self._by_chat.get(chat_id)
+            if chat_sessions is not None:
+                chat_sessions.pop(message_id, None)
+                if not chat_sessions:
+                    del self._by_chat[chat_id]
+            self._compact()
+        return session
+
+    def set_next_run(self, session: LiveLocationSession, run_at: float):
+        """Record when the session runs next"""
+        session.next_run_at = run_at
+
+    def by_chat(self, chat_id: int) -> List[LiveLocationSession]:
+        """Sessions of one chat"""
+        return list(self._by_chat.get(chat_id, {}).values())
+
+    def expire(self, now: Optional[float] = None) -> List[LiveLocationSession]:
+        """Remove and return sessions whose live period is over"""
+        now = time.monotonic() if now is None else now
+        expired = []
+        while self._expiry and self._expiry[0][0] <= now:
+            expires_at, key = heapq.heappop(self._expiry)
+            session = self._sessions.get(key)
+            if session is not None and session.expires_at == expires_at:
+                self.remove(*key)
+                expired.append(session)
+        return expired
+
+    def _compact(self):
+        # Rebuild the heap when stale entries dominate it
+        if len(self._expiry) > 2 * len(self._sessions) + 64:
+            self._expiry = [(s.expires_at, key) for key, s in self._sessions.items()]
+            heapq.heapify(self._expiry)
@@ -0,0 +1,131 @@
+import asyncio
+import bisect
+import hashlib
+import logging
+import multiprocessing
+import queue
+import signal
+from typing import Any, Callable, List, Optional
+
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+
+logger = logging.getLogger(__name__)
+
+
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    """
+    Consistent hash ring over shard indexes 0..shards-1.
+
+    Each shard owns `replicas` points on the ring; a chat belongs to the first
+    point at or after its hash. Changing the shard count only moves about 1/N
+    of the chats.
+    """
+    def __init__(self, shards: int, replicas: int = 100):
+        self.shards = shards
+        points = sorted((_hash(f"shard-{shard}-{replica}"), shard)
+                        for shard in range(shards) for replica in range(replicas))
+        self._hashes = [point for point, _ in points]
+        self._shards = [shard for _, shard in points]
+
+    def shard_for(self, chat_id: int) -> int:
+        index = bisect.bisect(self._hashes, _hash(str(chat_id))) % len(self._hashes)
+        return self._shards[index]
+
+
+def update_chat_id(update: Update) -> Optional[int]:
+    """Chat (or user) an update belongs to, used as the sharding key"""
+    event = update.event
+    chat = getattr(event, 'chat', None) or getattr(getattr(event, 'message', None), 'chat', None)
+    if chat is not None:
+        return chat.id
+    user = getattr(event, 'from_user', None)
+    return user.id if user is not None else None
+
+
+class ShardingDispatcher(Dispatcher):
+    """
+    Front-process dispatcher that forwards every update to the worker owning its chat.
+
+    Works with both polling and webhooks, since both deliver through feed_update.
+    Updates travel as JSON-compatible dicts over multiprocessing queues.
+    """
+    def __init__(self, queues: List[multiprocessing.Queue], workers_dispatcher: Dispatcher):
+        super().__init__()
+        self.queues = queues
+        self.ring = HashRing(len(queues))
+        # The dispatcher with the real handlers, for allowed_updates
+        self.workers_dispatcher = workers_dispatcher
+        self.forwarded = [0] * len(queues)
+
+    def resolve_used_update_types(self, skip_events=None) -> List[str]:
+        return self.workers_dispatcher.resolve_used_update_types(skip_events)
+
+    async def feed_update(self, bot: Bot, update: Update, **kwargs: Any) -> Any:
+        chat_id = update_chat_id(update)
+        shard = self.ring.shard_for(chat_id) if chat_id is not None else 0
+        self.queues[shard].put(update.model_dump(mode="json", exclude_unset=True))
+        self.forwarded[shard] += 1
+
+    def close(self):
+        """Tell every worker to finish"""
+        for worker_queue in self.queues:
+            worker_queue.put(None)
+
+
+async def consume_updates(update_queue: multiprocessing.Queue, dispatcher: Dispatcher, bot: Bot,
+                          drain_timeout: float = 10.0):
+    """Worker loop: feed queued updates to the dispatcher until the front sends None or exits"""
+    parent = multiprocessing.parent_process()
+    tasks = set()
+
+    async def handle(raw_update):
+        try:
+            await dispatcher.feed_raw_update(bot, raw_update)
+        except Exception as e:
+            logger.error("Error handling update %s: %s", raw_update.get('update_id'), e)
+
+    while True:
+        try:
+            raw_update = await asyncio.to_thread(update_queue.get, True, 1.0)
+        except queue.Empty:
+            if parent is not None and not parent.is_alive():
+                logger.warning("Front process is gone, stopping worker")
+                break
+            continue
+        if raw_update is None:
+            break
+        task = asyncio.create_task(handle(raw_update))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+    if tasks:
+        done, pending = await asyncio.wait(set(tasks), timeout=drain_timeout)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+
+def ignore_shutdown_signals():
+    """Workers shut down when the front tells them to, not on the terminal's Ctrl+C"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+
+def start_workers(count: int, target: Callable[[int, int, multiprocessing.Queue], None]):
+    """Start `count` worker processes; returns (processes, queues)"""
+    # spawn: workers build their own event loop, connection pools and bot session
+    context = multiprocessing.get_context('spawn')
+    queues = [context.Queue() for _ in range(count)]
+    processes = []
+    for index in range(count):
+        process = context.Process(target=target, args=(index, count, queues[index]),
+                                  name=f"shard-{index}", daemon=True)
+        process.start()
+        processes.append(process)
+    logger.info("Started %s shard worker processes", count)
+    return processes, queues
@@ -0,0 +1,75 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, Hashable, Tuple, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class _Call:
+    __slots__ = ("task", "waiters")
+
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+    Deduplicate concurrent calls for the same key.
+
+    The first caller starts the upstream call as a separate task and every
+    concurrent caller with the same key awaits that task. A cancelled caller
+    only stops waiting; the shared call is cancelled once no caller is left.
+    """
+    def __init__(self):
+        self._calls: Dict[Hashable, _Call] = {}
+
+    def in_flight(self) -> int:
+        """Get number of distinct calls in flight"""
+        return len(self._calls)
+
+    async def do(self, key: Hashable, func: Callable[[], Awaitable[T]]) -> T:
+        """Run func() for key, or join the call already in flight"""
+        task, _ = self.join(key, func)
+        try:
+            return await asyncio.shield(task)
+        finally:
+            self.leave(key, task)
+
+    def join(self, key: Hashable, func: Callable[[], Awaitable[T]]) -> Tuple[asyncio.Task, bool]:
+        """
+        Register as a waiter of the call for key, starting func() if none is in
+        flight. Returns the call's task (await it through asyncio.shield) and
+        whether this caller started it; every join() must be paired with leave().
+        """
+        call = self._calls.get(key)
+        started = call is None
+        if started:
+            call = _Call(asyncio.create_task(func()))
+            self._calls[key] = call
+            call.task.add_done_callback(lambda task: self._finish(key, call))
+        else:
+            logger.info("Joining in-flight request for %s", key)
+        call.waiters += 1
+        return call.task, started
+
+    def leave(self, key: Hashable, task: asyncio.Task):
+        """Stop waiting for a joined call; the call is cancelled if no waiter is left"""
+        call = self._calls.get(key)
+        if call is None or call.task is not task:
+            # Already finished or cancelled by its last waiter
+            return
+        call.waiters -= 1
+        if call.waiters == 0 and not task.done():
+            # Unregister first so a new caller starts a fresh call instead of joining this one
+            del self._calls[key]
+            task.cancel()
+
+    def _finish(self, key: Hashable, call: _Call):
+        if self._calls.get(key) is call:
+            del self._calls[key]
+        # Mark the exception as retrieved when every waiter was cancelled
+        if not call.task.cancelled():
+            call.task.exception()
@@ -0,0 +1,141 @@
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Dict, List, Tuple
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+# Id of the update or live session the current task is working on
+request_id: contextvars.ContextVar = contextvars.ContextVar("request_id", default=None)
+
+# Attributes every LogRecord has; anything else was passed with extra={...}
+_RECORD_ATTRS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime", "request_id", "suppressed"}
+
+
+@contextmanager
+def request_context(value: str):
+    """Tag log records emitted inside the block (and tasks it starts) with `value`"""
+    token = request_id.set(value)
+    try:
+        yield
+    finally:
+        request_id.reset(token)
+
+
+class RequestContextFilter(logging.Filter):
+    """Stamp records with the request id of the emitting task"""
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = request_id.get()
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Cap INFO records per message template and logger at `per_second`.
+    Templates are the unformatted messages, so a call site logging
+    "Requesting fact for coordinates: %s, %s" on every request is one
+    template. Dropped records are counted and reported as `suppressed` on
+    the first record of the template in the next second.
+    """
+    def __init__(self, per_second: float):
+        super().__init__()
+        self.per_second = per_second
+        # (logger, template) -> [window start, emitted, dropped]
+        self._windows: Dict[Tuple[str, str], List[float]] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno != logging.INFO or self.per_second <= 0:
+            return True
+        key = (record.name, str(record.msg))
+        window = self._windows.get(key)
+        if window is None or record.created - window[0] >= 1.0:
+            if window is not None and window[2]:
+                record.suppressed = int(window[2])
+            window = self._windows[key] = [record.created, 0, 0]
+        if window[1] >= self.per_second:
+            window[2] += 1
+            return False
+        window[1] += 1
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line with the message, request id and any `extra` fields"""
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if getattr(record, "request_id", None):
+            entry["request_id"] = record.request_id
+        if getattr(record, "suppressed", 0):
+            entry["suppressed"] = record.suppressed
+        for name, value in record.__dict__.items():
+            if name not in _RECORD_ATTRS:
+                entry[name] = value
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Hand records to the writer thread without formatting them.
+    The queue is bounded; when the writer falls behind, records are dropped
+    instead of blocking the event loop.
+    """
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Records stay in this process, so message formatting (and its cost)
+        # is left to the writer thread
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def setup_logging() -> NonBlockingQueueHandler:
+    """
+    Route all logging through a bounded queue to a background writer thread.
+    LOG_FORMAT is "json" (default) or "text"; LOG_INFO_RATE caps INFO records
+    per message template per second (0 disables sampling).
+    Calling it again returns the handler that is already installed.
+    """
+    root = logging.getLogger()
+    for handler in root.handlers:
+        if isinstance(handler, NonBlockingQueueHandler):
+            return handler
+
+    output = logging.StreamHandler(sys.stderr)
+    if os.getenv('LOG_FORMAT', 'json').lower() == 'text':
+        output.setFormatter(logging.Formatter(TEXT_FORMAT))
+    else:
+        output.setFormatter(JsonFormatter())
+
+    handler = NonBlockingQueueHandler(queue.Queue(maxsize=int(os.getenv('LOG_QUEUE_SIZE', '10000'))))
+    handler.addFilter(SamplingFilter(float(os.getenv('LOG_INFO_RATE', '20'))))
+    handler.addFilter(RequestContextFilter())
+
+    root.handlers = [handler]
+    root.setLevel(os.getenv('LOG_LEVEL', 'INFO').upper())
+
+    listener = logging.handlers.QueueListener(handler.queue, output)
+    listener.start()
+    # Flush what is queued when the process exits
+    atexit.register(listener.stop)
+    return handler
@@ -0,0 +1,240 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from aiogram.exceptions import TelegramRetryAfter
+
+from metrics import TELEGRAM_API_LATENCY, TELEGRAM_QUEUE_LATENCY
+from rate_limiter import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Lower value is sent first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_PERIODIC = 1
+PRIORITY_NAMES = {PRIORITY_INTERACTIVE: "interactive", PRIORITY_PERIODIC: "periodic"}
+
+
+class _Job:
+    __slots__ = ("chat_id", "priority", "call", "future", "chat_limited", "attempts", "queued_at")
+
+    def __init__(self, chat_id: int, priority: int, call: Callable[[], Awaitable],
+                 future: asyncio.Future, chat_limited: bool):
+        self.chat_id = chat_id
+        self.priority = priority
+        self.call = call
+        self.future = future
+        self.chat_limited = chat_limited
+        self.attempts = 0
+        self.queued_at = time.monotonic()
+
+
+class OutboundSender:
+    """
+    Rate-limited outbound queue for Telegram Bot API calls.
+
+    Jobs are dispatched by priority (interactive replies before periodic facts)
+    and arrival order, subject to a global token bucket and one bucket per chat.
+    A job whose chat is out of budget waits in a delayed heap without holding
+    up other chats. TelegramRetryAfter pauses the affected chat and requeues
+    the job. Repeated "typing" actions for the same chat are coalesced.
+
+    Exposes send_message / edit_message_text / send_chat_action so it can be
+    used in place of the Bot for sending.
+    """
+    def __init__(self, bot):
+        self.bot = bot
+        self.global_rate = float(os.getenv('TELEGRAM_GLOBAL_RATE', '30'))
+        self.chat_rate = float(os.getenv('TELEGRAM_CHAT_RATE', '1'))
+        self.chat_burst = float(os.getenv('TELEGRAM_CHAT_BURST', '3'))
+        self.max_attempts = int(os.getenv('TELEGRAM_MAX_ATTEMPTS', '5'))
+        # Telegram shows a chat action for about 5 seconds
+        self.action_ttl = 4.0
+
+        self._global = TokenBucket(self.global_rate, self.global_rate)
+        self._chats: Dict[int, TokenBucket] = {}
+        self._chat_blocked_until: Dict[int, float] = {}
+        self._last_action: Dict[Tuple[int, str], float] = {}
+
+        self._ready: List[Tuple[int, int, _Job]] = []
+        self._delayed: List[Tuple[float, int, _Job]] = []
+        self._counter = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._in_flight = set()
+
+        self.sent = 0
+        self.retried = 0
+        self.coalesced_actions = 0
+
+    def start(self):
+        """Start the dispatcher task"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._dispatch())
+
+    async def stop(self, timeout: float = 5.0):
+        """Give queued jobs up to `timeout` seconds to go out, then stop"""
+        deadline = time.monotonic() + timeout
+        while (self._ready or self._delayed or self._in_flight) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        for _, _, job in self._ready + self._delayed:
+            if not job.future.done():
+                job.future.cancel()
+        self._ready = []
+        self._delayed = []
+
+    def scale_global_rate(self, factor: float):
+        """Take a share of the bot-wide rate when several processes send for the same bot"""
+        self.global_rate *= factor
+        self._global.scale(factor)
+
+    def queue_size(self) -> int:
+        return len(self._ready) + len(self._delayed)
+
+    async def send_message(self, chat_id: int, text: str, priority: int = PRIORITY_INTERACTIVE, **kwargs):
+        """Queue bot.send_message and wait for the sent Message"""
+        return await self._submit(chat_id, priority, lambda: self.bot.send_message(chat_id, text, **kwargs))
+
+    async def edit_message_text(self, chat_id: int, message_id: int, text: str,
+                                priority: int = PRIORITY_INTERACTIVE, **kwargs):
+        """Queue bot.edit_message_text and wait for the result"""
+        return await self._submit(
+            chat_id, priority,
+            lambda: self.bot.edit_message_text(text, chat_id=chat_id, message_id=message_id, **kwargs)
+        )
+
+    async def send_chat_action(self, chat_id: int, action: str = "typing", priority: int = PRIORITY_INTERACTIVE):
+        """Queue a chat action without waiting; skipped if one is still showing"""
+        now = time.monotonic()
+        key = (chat_id, action)
+        if now - self._last_action.get(key, -self.action_ttl) < self.action_ttl:
+            self.coalesced_actions += 1
+            return
+        self._last_action[key] = now
+        if len(self._last_action) > 10000:
+            self._last_action = {k: t for k, t in self._last_action.items() if now - t < self.action_ttl}
+
+        # Chat actions do not count against the per-chat message limit
+        future = self._enqueue(chat_id, priority, lambda: self.bot.send_chat_action(chat_id, action),
+                               chat_limited=False)
+        future.add_done_callback(self._log_action_failure)
+
+    def _log_action_failure(self, future: asyncio.Future):
+        if not future.cancelled() and future.exception() is not None:
+            logger.warning("Failed to send chat action: %s", future.exception())
+
+    async def _submit(self, chat_id: int, priority: int, call: Callable[[], Awaitable]):
+        return await self._enqueue(chat_id, priority, call, chat_limited=True)
+
+    def _enqueue(self, chat_id: int, priority: int, call: Callable[[], Awaitable],
+                 chat_limited: bool) -> asyncio.Future:
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        job = _Job(chat_id, priority, call, future, chat_limited)
+        self._push_ready(job)
+        return future
+
+    def _push_ready(self, job: _Job):
+        heapq.heappush(self._ready, (job.priority, next(self._counter), job))
+        self._wakeup.set()
+
+    def _push_delayed(self, job: _Job, ready_at: float):
+        heapq.heappush(self._delayed, (ready_at, next(self._counter), job))
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) > 10000:
+                self._prune_chats()
+            bucket = TokenBucket(self.chat_burst, self.chat_rate)
+            self._chats[chat_id] = bucket
+        return bucket
+
+    def _prune_chats(self):
+        # Full buckets carry no state worth keeping
+        now = time.monotonic()
+        self._chats = {chat_id: bucket for chat_id, bucket in self._chats.items()
+                       if bucket.wait_time(bucket.capacity, now) > 0}
+        self._chat_blocked_until = {chat_id: until for chat_id, until in self._chat_blocked_until.items()
+                                    if until > now}
+
+    async def _dispatch(self):
+        while True:
+            now = time.monotonic()
+            while self._delayed and self._delayed[0][0] <= now:
+                _, _, job = heapq.heappop(self._delayed)
+                self._push_ready(job)
+
+            if not self._ready:
+                self._wakeup.clear()
+                timeout = self._delayed[0][0] - now if self._delayed else None
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            _, _, job = heapq.heappop(self._ready)
+            if job.future.done():
+                continue
+
+            if job.chat_limited:
+                wait = max(self._chat_blocked_until.get(job.chat_id, 0.0) - now,
+                           self._chat_bucket(job.chat_id).wait_time(1, now))
+                if wait > 0:
+                    self._push_delayed(job, now + wait)
+                    continue
+
+            wait = self._global.wait_time(1, now)
+            if wait > 0:
+                heapq.heappush(self._ready, (job.priority, next(self._counter), job))
+                await asyncio.sleep(wait)
+                continue
+
+            self._global.consume(1)
+            if job.chat_limited:
+                self._chat_bucket(job.chat_id).consume(1)
+
+            task = asyncio.create_task(self._execute(job))
+            self._in_flight.add(task)
+            task.add_done_callback(self._in_flight.discard)
+
+    async def _execute(self, job: _Job):
+        job.attempts += 1
+        priority = PRIORITY_NAMES.get(job.priority, str(job.priority))
+        started = time.monotonic()
+        if job.attempts == 1:
+            TELEGRAM_QUEUE_LATENCY.observe(started - job.queued_at, priority=priority)
+        try:
+            result = await job.call()
+        except TelegramRetryAfter as e:
+            TELEGRAM_API_LATENCY.observe(time.monotonic() - started, priority=priority, outcome="retry_after")
+            # Flood control: pause this chat and try again later
+            self.retried += 1
+            ready_at = time.monotonic() + e.retry_after
+            self._chat_blocked_until[job.chat_id] = max(self._chat_blocked_until.get(job.chat_id, 0.0), ready_at)
+            logger.warning("Telegram flood control for chat %s, retrying in %ss", job.chat_id, e.retry_after)
+            if job.attempts < self.max_attempts and not job.future.done():
+                self._push_delayed(job, ready_at)
+                self._wakeup.set()
+            elif not job.future.done():
+                job.future.set_exception(e)
+            return
+        except Exception as e:
+            TELEGRAM_API_LATENCY.observe(time.monotonic() - started, priority=priority, outcome="error")
+            if not job.future.done():
+                job.future.set_exception(e)
+            return
+
+        TELEGRAM_API_LATENCY.observe(time.monotonic() - started, priority=priority, outcome="ok")
+        self.sent += 1
+        if not job.future.done():
+            job.future.set_result(result)
@@ -0,0 +1,61 @@
+import asyncio
+
+from admission import ADMITTED, EXPIRED, REJECTED, SUPERSEDED, AdmissionController
+
+
+def test_admits_up_to_max_concurrent_then_queues():
+    async def scenario():
+        controller = AdmissionController(max_concurrent=1, max_queue=4, deadline=5)
+        first = await controller.acquire("a")
+        waiting = asyncio.create_task(controller.acquire("b"))
+        await asyncio.sleep(0)
+        queued = controller.queue_size()
+        controller.release(first)
+        second = await waiting
+        controller.release(second)
+        return first.outcome, queued, second.outcome, controller.active
+
+    assert asyncio.run(scenario()) == (ADMITTED, 1, ADMITTED, 0)
+
+
+def test_newer_request_supersedes_waiting_one_with_same_key():
+    async def scenario():
+        controller = AdmissionController(max_concurrent=1, max_queue=4, deadline=5)
+        holder = await controller.acquire("other")
+        old = asyncio.create_task(controller.acquire("chat"))
+        await asyncio.sleep(0)
+        new = asyncio.create_task(controller.acquire("chat"))
+        await asyncio.sleep(0)
+        superseded = await old
+        controller.release(holder)
+        admitted = await new
+        controller.release(admitted)
+        return superseded.outcome, admitted.outcome
+
+    assert asyncio.run(scenario()) == (SUPERSEDED, ADMITTED)
+
+
+def test_full_queue_rejects_immediately():
+    async def scenario():
+        controller = AdmissionController(max_concurrent=1, max_queue=1, deadline=5)
+        holder = await controller.acquire("a")
+        waiting = asyncio.create_task(controller.acquire("b"))
+        await asyncio.sleep(0)
+        rejected = await controller.acquire("c")
+        waiting.cancel()
+        await asyncio.gather(waiting, return_exceptions=True)
+        controller.release(holder)
+        return rejected.outcome, controller.active, controller.queue_size()
+
+    assert asyncio.run(scenario()) == (REJECTED, 0, 0)
+
+
+def test_waiter_expires_at_deadline():
+    async def scenario():
+        controller = AdmissionController(max_concurrent=1, max_queue=4, deadline=0.05)
+        holder = await controller.acquire("a")
+        expired = await controller.acquire("b")
+        controller.release(holder)
+        return expired.outcome, controller.active
+
+    assert asyncio.run(scenario()) == (EXPIRED, 0)
@@ -0,0 +1,54 @@
+from fact_cache import GeoFactCache
+
+
+def make_cache(**kwargs):
+    options = dict(radius_m=500, ttl=3600, max_entries=100, facts_per_cell=2)
+    options.update(kwargs)
+    return GeoFactCache(**options)
+
+
+def test_misses_until_cell_holds_enough_facts():
+    cache = make_cache()
+    cache.put(55.75, 37.62, "first")
+    assert cache.get(55.75, 37.62) is None
+    cache.put(55.7501, 37.6201, "second")
+    assert cache.get(55.75, 37.62) in ("first", "second")
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_rotates_through_cached_facts():
+    cache = make_cache()
+    cache.put(55.75, 37.62, "first")
+    cache.put(55.75, 37.62, "second")
+    facts = [cache.get(55.75, 37.62) for _ in range(4)]
+    assert set(facts) == {"first", "second"}
+    assert facts[0] != facts[1]
+
+
+def test_peek_does_not_count_or_rotate():
+    cache = make_cache()
+    assert not cache.peek(55.75, 37.62)
+    cache.put(55.75, 37.62, "first")
+    cache.put(55.75, 37.62, "second")
+    assert cache.peek(55.75, 37.62)
+    assert (cache.hits, cache.misses) == (0, 0)
+    assert cache.get(55.75, 37.62) == "first"
+
+
+def test_far_points_do_not_share_facts():
+    cache = make_cache(facts_per_cell=1)
+    cache.put(55.75, 37.62, "moscow")
+    assert cache.get(59.94, 30.31) is None
+    assert cache.nearest(59.94, 30.31, 1000) is None
+    assert cache.nearest(55.76, 37.62, 5000) == "moscow"
+
+
+def test_evicts_least_recently_used_cells():
+    cache = make_cache(max_entries=2, facts_per_cell=1)
+    cache.put(10.0, 10.0, "a")
+    cache.put(20.0, 20.0, "b")
+    assert cache.get(10.0, 10.0) == "a"
+    cache.put(30.0, 30.0, "c")
+    assert cache.size == 2
+    assert cache.get(20.0, 20.0) is None
+    assert cache.get(10.0, 10.0) == "a"
@@ -0,0 +1,23 @@
+from sharding import HashRing
+
+
+def test_assignment_is_stable_and_in_range():
+    ring = HashRing(4)
+    shards = [ring.shard_for(chat_id) for chat_id in range(1000)]
+    assert shards == [HashRing(4).shard_for(chat_id) for chat_id in range(1000)]
+    assert set(shards) == {0, 1, 2, 3}
+
+
+def test_chats_spread_across_shards():
+    ring = HashRing(4)
+    counts = [0] * 4
+    for chat_id in range(10000):
+        counts[ring.shard_for(chat_id)] += 1
+    assert min(counts) > 10000 / 4 * 0.6
+
+
+def test_adding_a_shard_moves_few_chats():
+    before, after = HashRing(4), HashRing(5)
+    moved = sum(before.shard_for(chat_id) != after.shard_for(chat_id) for chat_id in range(10000))
+    # About 1/5 of the chats move to the new shard
+    assert moved < 10000 * 0.35
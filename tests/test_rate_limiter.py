@@ -0,0 +1,49 @@
+import asyncio
+import time
+
+from rate_limiter import RateLimiter, TokenBucket
+
+
+def test_token_bucket_refills_at_rate():
+    bucket = TokenBucket(capacity=2, rate=1)
+    now = bucket.updated
+    assert bucket.wait_time(2, now) == 0
+    bucket.consume(2)
+    assert bucket.wait_time(1, now) == 1
+    assert bucket.wait_time(1, now + 1) == 0
+
+
+def test_oversized_request_needs_only_a_full_bucket():
+    bucket = TokenBucket(capacity=10, rate=5)
+    now = bucket.updated
+    bucket.consume(10)
+    assert bucket.wait_time(100, now) == 2
+
+
+def test_requests_beyond_burst_wait_for_refill():
+    async def scenario():
+        # 600 per minute is 10 per second with a burst of 2
+        limiter = RateLimiter("test", requests_per_minute=600, burst_seconds=0.2)
+        started = time.monotonic()
+        await asyncio.gather(*(limiter.acquire() for _ in range(4)))
+        return time.monotonic() - started
+
+    # Two requests fit the burst, the other two wait 0.1s each
+    assert 0.15 <= asyncio.run(scenario()) < 1.0
+
+
+def test_retry_after_blocks_requests():
+    async def scenario():
+        limiter = RateLimiter("test", requests_per_minute=6000)
+        limiter.retry_after(0.1)
+        assert not limiter.has_headroom()
+        return await limiter.acquire()
+
+    assert asyncio.run(scenario()) >= 0.09
+
+
+def test_record_usage_corrects_token_budget():
+    limiter = RateLimiter("test", requests_per_minute=0, tokens_per_minute=600)
+    limiter.tokens.consume(100)
+    limiter.record_usage(estimated_tokens=100, actual_tokens=300)
+    assert limiter.tokens.tokens <= 600 - 300 + 1
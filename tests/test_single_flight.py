@@ -0,0 +1,106 @@
+import asyncio
+
+from single_flight import SingleFlight
+
+
+def test_concurrent_calls_share_one_upstream_call():
+    async def scenario():
+        flight = SingleFlight()
+        calls = 0
+
+        async def fetch():
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.01)
+            return "fact"
+
+        results = await asyncio.gather(*(flight.do("key", fetch) for _ in range(5)))
+        return calls, results, flight.in_flight()
+
+    calls, results, in_flight = asyncio.run(scenario())
+    assert calls == 1
+    assert results == ["fact"] * 5
+    assert in_flight == 0
+
+
+def test_cancelled_waiter_does_not_cancel_shared_call():
+    async def scenario():
+        flight = SingleFlight()
+
+        async def fetch():
+            await asyncio.sleep(0.05)
+            return "fact"
+
+        first = asyncio.create_task(flight.do("key", fetch))
+        second = asyncio.create_task(flight.do("key", fetch))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        return await second, first
+
+    result, first = asyncio.run(scenario())
+    assert result == "fact"
+    assert first.cancelled()
+
+
+def test_call_is_cancelled_when_last_waiter_leaves():
+    async def scenario():
+        flight = SingleFlight()
+        started = asyncio.Event()
+        cancelled = asyncio.Event()
+
+        async def fetch():
+            started.set()
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        waiter = asyncio.create_task(flight.do("key", fetch))
+        await started.wait()
+        waiter.cancel()
+        await asyncio.wait_for(cancelled.wait(), 1)
+        await asyncio.sleep(0)
+        return flight.in_flight()
+
+    assert asyncio.run(scenario()) == 0
+
+
+def test_errors_reach_every_waiter():
+    async def scenario():
+        flight = SingleFlight()
+
+        async def fetch():
+            await asyncio.sleep(0.01)
+            raise RuntimeError("upstream failed")
+
+        return await asyncio.gather(*(flight.do("key", fetch) for _ in range(3)), return_exceptions=True)
+
+    results = asyncio.run(scenario())
+    assert all(isinstance(result, RuntimeError) for result in results)
+
+
+def test_caller_after_cancellation_starts_a_fresh_call():
+    async def scenario():
+        flight = SingleFlight()
+        started = asyncio.Event()
+
+        async def slow():
+            started.set()
+            try:
+                await asyncio.sleep(10)
+            finally:
+                # Clean-up keeps the cancelled call in flight for a while
+                await asyncio.sleep(0.05)
+
+        async def fast():
+            return "fact"
+
+        waiter = asyncio.create_task(flight.do("key", slow))
+        await started.wait()
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        # The cancelled call is still finishing; a new caller must not join it
+        return await flight.do("key", fast)
+
+    assert asyncio.run(scenario()) == "fact"
@@ -0,0 +1,65 @@
+import asyncio
+
+from fact_result import FactResult
+from provider_router import ProviderRouter
+
+
+class FakeProvider:
+    tokens = None
+
+    async def stream_fact(self, latitude, longitude, place=None):
+        for part in ("first ", "second"):
+            await asyncio.sleep(0.01)
+            yield part
+
+    async def generate_fact(self, latitude, longitude, place=None):
+        await asyncio.sleep(0.02)
+        return FactResult(provider="openai", fact="whole", latency=0.02)
+
+
+def make_generator(monkeypatch):
+    monkeypatch.setenv("OPENAI_API_KEY", "test")
+    monkeypatch.delenv("OPENROUTER_API_KEY", raising=False)
+    monkeypatch.setenv("FACT_HEDGE_DELAY", "")
+    from ai_client import UnifiedFactGenerator
+    generator = UnifiedFactGenerator()
+    generator.router = ProviderRouter({"openai": FakeProvider()})
+    return generator
+
+
+async def collect(generator, latitude, longitude):
+    return "".join([chunk async for chunk in generator.stream_location_fact(latitude, longitude)])
+
+
+def test_plain_request_joining_a_stream_gets_its_fact(monkeypatch):
+    generator = make_generator(monkeypatch)
+
+    async def scenario():
+        return await asyncio.wait_for(asyncio.gather(
+            collect(generator, 1, 1), generator.get_location_fact(1, 1)
+        ), 1)
+
+    assert asyncio.run(scenario()) == ["first second", "first second"]
+    assert not generator._streams
+
+
+def test_stream_joining_a_plain_request_gets_its_fact(monkeypatch):
+    generator = make_generator(monkeypatch)
+
+    async def scenario():
+        return await asyncio.wait_for(asyncio.gather(
+            generator.get_location_fact(1, 1), collect(generator, 1, 1)
+        ), 1)
+
+    assert asyncio.run(scenario()) == ["whole", "whole"]
+    assert not generator._streams
+
+
+def test_concurrent_streams_share_one_stream(monkeypatch):
+    generator = make_generator(monkeypatch)
+
+    async def scenario():
+        return await asyncio.wait_for(asyncio.gather(collect(generator, 2, 2), collect(generator, 2, 2)), 1)
+
+    assert asyncio.run(scenario()) == ["first second", "first second"]
+    assert not generator._streams
@@ -0,0 +1,148 @@
+import asyncio
+import logging
+import os
+import secrets
+import signal
+from typing import Any, Callable, Dict, Optional, Set
+
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.methods import TelegramMethod
+from aiogram.webhook.aiohttp_server import setup_application
+
+logger = logging.getLogger(__name__)
+
+
+class WebhookServer:
+    """
+    Receives Telegram updates over HTTPS webhooks instead of long polling.
+
+    Updates are acknowledged immediately and handled in background tasks.
+    Requests without the configured secret token are rejected. GET on the
+    health path reports status for load balancers. On shutdown it returns 503
+    for WEBHOOK_DRAIN_GRACE seconds while updates are still accepted, so load
+    balancers move traffic to other instances before the listener closes.
+    """
+    def __init__(self, bot: Bot, dispatcher: Dispatcher,
+                 health_info: Optional[Callable[[], Dict[str, Any]]] = None):
+        self.bot = bot
+        self.dispatcher = dispatcher
+        self.health_info = health_info
+
+        # Public base URL Telegram posts to, e.g. https://bot.example.com
+        self.base_url = os.getenv('WEBHOOK_URL', '').rstrip('/')
+        self.path = os.getenv('WEBHOOK_PATH', '/webhook')
+        self.health_path = os.getenv('WEBHOOK_HEALTH_PATH', '/health')
+        self.host = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+        self.port = int(os.getenv('PORT', '8080'))
+        self.secret_token = os.getenv('WEBHOOK_SECRET', '')
+        if not self.secret_token:
+            # Fine for a single instance; instances behind a load balancer must share one
+            self.secret_token = secrets.token_urlsafe(32)
+            logger.warning("WEBHOOK_SECRET is not set, using a random secret for this instance")
+
+        # Seconds the health check reports draining before the listener closes
+        self.drain_grace = float(os.getenv('WEBHOOK_DRAIN_GRACE', '5'))
+
+        self.draining = False
+        # Updates being handled in the background
+        self._tasks: Set[asyncio.Task] = set()
+        self._runner: Optional[web.AppRunner] = None
+        self._site: Optional[web.TCPSite] = None
+        self._stop_event = asyncio.Event()
+
+    @property
+    def webhook_url(self) -> str:
+        return f"{self.base_url}{self.path}"
+
+    def _build_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post(self.path, self._webhook)
+        app.router.add_get(self.health_path, self._health)
+        setup_application(app, self.dispatcher, bot=self.bot)
+        return app
+
+    async def _webhook(self, request: web.Request) -> web.Response:
+        """Acknowledge an update right away and handle it in a background task"""
+        if not secrets.compare_digest(request.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), self.secret_token):
+            return web.Response(body="Unauthorized", status=401)
+        update = await request.json(loads=self.bot.session.json_loads)
+        task = asyncio.create_task(self._feed(update))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return web.json_response({})
+
+    async def _feed(self, update: Dict[str, Any]):
+        try:
+            result = await self.dispatcher.feed_raw_update(self.bot, update)
+            if isinstance(result, TelegramMethod):
+                await self.dispatcher.silent_call_request(self.bot, result)
+        except Exception as e:
+            logger.error("Error handling webhook update: %s", e)
+
+    async def _health(self, request: web.Request) -> web.Response:
+        info = {"status": "draining" if self.draining else "ok"}
+        if self.health_info is not None:
+            info.update(self.health_info())
+        return web.json_response(info, status=503 if self.draining else 200)
+
+    async def start(self):
+        """Start the HTTP server and register the webhook with Telegram"""
+        self._runner = web.AppRunner(self._build_app())
+        await self._runner.setup()
+        self._site = web.TCPSite(self._runner, self.host, self.port)
+        await self._site.start()
+        logger.info("Webhook server listening on %s:%s", self.host, self.port)
+
+        await self.bot.set_webhook(
+            self.webhook_url,
+            secret_token=self.secret_token,
+            allowed_updates=self.dispatcher.resolve_used_update_types()
+        )
+        logger.info("Webhook set to %s", self.webhook_url)
+
+    async def serve(self):
+        """Run until SIGINT/SIGTERM or request_stop()"""
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, self.request_stop)
+            except (NotImplementedError, RuntimeError):
+                pass
+        await self._stop_event.wait()
+
+    def request_stop(self):
+        logger.info("Webhook server shutdown requested")
+        self._stop_event.set()
+
+    def in_flight(self) -> int:
+        """Number of updates still being handled"""
+        return len(self._tasks)
+
+    async def stop(self, timeout: float = 10.0):
+        """
+        Report draining for the grace period, then stop accepting updates and
+        wait up to `timeout` seconds for in-flight handlers
+        """
+        self.draining = True
+        if self._site is not None:
+            if self.drain_grace > 0:
+                logger.info("Draining: health check returns 503 for %ss before the listener closes", self.drain_grace)
+                await asyncio.sleep(self.drain_grace)
+            await self._site.stop()
+
+        tasks = set(self._tasks)
+        if tasks:
+            logger.info("Waiting for %s in-flight updates", len(tasks))
+            done, pending = await asyncio.wait(tasks, timeout=timeout)
+            if pending:
+                logger.warning("Cancelling %s updates still running after %ss", len(pending), timeout)
+                for task in pending:
+                    task.cancel()
+                await asyncio.gather(*pending, return_exceptions=True)
+
+    async def cleanup(self):
+        """Run the dispatcher shutdown hooks and release the listener; the bot session is closed by the caller"""
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None